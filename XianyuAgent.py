@@ -1,66 +1,331 @@
 import re
-from typing import List, Dict
+import json
+import hashlib
+import random
+import threading
+import time
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass, field
+from typing import Callable, List, Dict, Optional
 import os
-from openai import OpenAI
+from llm_router import LLMRouter
+from prompt_registry import PromptRegistry
 from loguru import logger
+from utils.keyword_matcher import KeywordEngine
+from context_builder import estimate_tokens
+
+
+@dataclass
+class ReplyResult:
+    """单次回复生成的结果"""
+    text: str
+    intent: str  # price / tech / default
+    agent: str  # 生成回复的来源：Agent名、structured、reply_cache或reply_index
+    usage: Dict[str, int] = field(default_factory=dict)  # prompt_tokens、completion_tokens、cached_tokens
+    timings: Dict[str, float] = field(default_factory=dict)  # classify_ms、generate_ms、total_ms
+    deadline_hit: bool = False  # 生成超过截止时间，回复为安抚回复或已发出的部分句子
+    cancelled: bool = False  # 生成被取消（如买家发来新消息），text为空，usage为已消耗的用量
+
+
+@dataclass
+class ModelConfig:
+    """单个Agent使用的模型配置"""
+    tier: str  # fast / large
+    model: str
+    max_tokens: int
+    timeout: float  # 单次请求超时（秒）
+
+    @property
+    def key(self) -> str:
+        """按模型分层统计时使用的名称"""
+        return f"{self.tier}/{self.model}"
+
+
+# 各Agent默认使用的模型档位：分类和闲聊用快速小模型，议价和技术咨询用大模型
+AGENT_MODEL_TIERS = {
+    'classify': 'fast',
+    'default': 'fast',
+    'price': 'large',
+    'tech': 'large',
+    'structured': 'large',
+}
+# 各Agent默认的最大输出token数，未列出的使用档位默认值
+AGENT_MAX_TOKENS = {
+    'classify': 10,
+}
+
+
+# 当前请求所处的会话阶段（如post_order），在生成回复的线程中设置，供Agent确定大模型调用的优先级
+current_stage: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar('current_stage', default=None)
+# 当前请求的生成句柄，供Agent按截止时间设置请求超时、响应取消
+current_generation: contextvars.ContextVar[Optional['GenerationHandle']] = contextvars.ContextVar(
+    'current_generation', default=None
+)
+# 当前请求的商品（商品ID, itemDO），供TechAgent获取商品知识片段
+current_item: contextvars.ContextVar[Optional[tuple]] = contextvars.ContextVar('current_item', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """回复生成超过截止时间"""
+
+
+class GenerationCancelled(Exception):
+    """回复生成被取消"""
+
+
+class ReplyTruncated(Exception):
+    """回复达到max_tokens上限被截断"""
+
+
+class GenerationHandle:
+    """
+    单次回复生成的句柄：截止时间和取消信号
+
+    Agent发起大模型调用时以剩余时间作为请求超时，流式生成在截止时间到达或被取消时立即停止。
+    取消不会中断已经发出的非流式大模型调用，只在各阶段之间（如分类完成后、生成开始前）生效。
+    """
+
+    def __init__(self, deadline: Optional[float] = None):
+        """
+        Args:
+            deadline: 截止时间（time.time()时间戳），为None时不限时
+        """
+        self.deadline = deadline
+        self.cancel_event = threading.Event()
+        self.intent: Optional[str] = None  # 已确定的意图，超时时据此选择安抚回复
+
+    def remaining(self) -> Optional[float]:
+        """距离截止时间的秒数，不限时返回None"""
+        return None if self.deadline is None else self.deadline - time.time()
+
+    def expired(self) -> bool:
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def cancel(self):
+        """
+        取消生成：进行中的流式调用在收到下一段输出时停止，尚未发起的大模型调用不再发起；
+        进行中的非流式调用会继续到返回为止，其结果由调用方丢弃
+        """
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event.is_set()
+
+
+def load_model_config(agent_name: str) -> ModelConfig:
+    """
+    从环境变量读取Agent的模型配置
+
+    先取档位配置（FAST_/LARGE_前缀的MODEL_NAME、MAX_TOKENS、TIMEOUT，档位模型默认为MODEL_NAME），
+    再用Agent前缀的同名变量覆盖（如CLASSIFY_MODEL_NAME、PRICE_MAX_TOKENS）；
+    档位本身可通过<AGENT>_MODEL_TIER修改。
+    """
+    prefix = agent_name.upper()
+    tier = os.getenv(f"{prefix}_MODEL_TIER", AGENT_MODEL_TIERS.get(agent_name, 'large'))
+    tier_prefix = tier.upper()
+    model = os.getenv(f"{tier_prefix}_MODEL_NAME", os.getenv("MODEL_NAME", "qwen-max"))
+    max_tokens = int(os.getenv(f"{tier_prefix}_MAX_TOKENS", "500"))
+    timeout = float(os.getenv(f"{tier_prefix}_TIMEOUT", "20" if tier == 'fast' else "60"))
+    return ModelConfig(
+        tier=tier,
+        model=os.getenv(f"{prefix}_MODEL_NAME", model),
+        max_tokens=int(os.getenv(f"{prefix}_MAX_TOKENS", AGENT_MAX_TOKENS.get(agent_name, max_tokens))),
+        timeout=float(os.getenv(f"{prefix}_TIMEOUT", timeout)),
+    )
 
 
 class XianyuReplyBot:
-    def __init__(self):
-        # 初始化OpenAI客户端
-        self.client = OpenAI(
-            api_key=os.getenv("API_KEY"),
-            base_url=os.getenv("MODEL_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1"),
-        )
+    SAFETY_REPLY = "[安全提醒]请通过平台沟通"
+    # 可加入历史回复索引的回复来源：由大模型针对问题生成的回复。议价回复依赖议价轮次，
+    # 缓存/索引命中的回复是重复内容，安抚回复不是正式回答，都不加入
+    INDEXABLE_AGENTS = ('default', 'tech', 'structured')
+    # 提示词名称 -> prompts目录下的文件名
+    PROMPT_FILES = {
+        'classify': "classify_prompt.txt",
+        'price': "price_prompt.txt",
+        'tech': "tech_prompt.txt",
+        'default': "default_prompt.txt",
+        'structured': "structured_prompt.txt",
+        'holding_replies': "holding_replies.json",
+        'summary': "summary_prompt.txt",  # 由ConversationSummarizer读取
+        'bargain_rules': "bargain_rules.json",  # 议价引擎从该文件加载时随之热更新
+    }
+    # 影响回复内容的提示词（结构化提示词拼接了其余全部）
+    REPLY_PROMPTS = ('classify', 'price', 'tech', 'default', 'structured')
+
+    def __init__(self, reply_index=None, reply_cache=None, intent_classifier=None, intent_threshold: float = 0.8,
+                 keyword_engine=None, routing_strategy: str = "sequential", speculative_max_tokens: int = 200,
+                 context_builder=None, llm_max_concurrency: int = 0, llm_priority_aging: float = 5.0,
+                 bargain_engine=None, item_knowledge=None, reply_workers: int = 4):
+        """
+        Args:
+            reply_index: 可选的历史回复向量索引（ReplyIndex），命中时直接复用历史回复
+            reply_cache: 可选的精确匹配回复缓存（ReplyCache），命中时跳过所有大模型调用
+            intent_classifier: 可选的本地意图分类器（NaiveBayesIntentClassifier），规则未命中时优先使用
+            intent_threshold: 本地分类结果被采纳所需的最低置信度，低于该值时回退到大模型分类
+            keyword_engine: 共享的关键词引擎（KeywordEngine），未提供时从keywords目录加载
+            routing_strategy: 规则未命中时的路由策略，sequential为先分类再生成两次调用，
+                structured为一次结构化输出同时返回意图和回复（解析失败时回退到sequential），
+                speculative为意图分类与默认回复并行生成，意图不是default时取消默认回复
+            speculative_max_tokens: speculative模式下预先生成的默认回复的最大token数
+            context_builder: 可选的上下文组装器（ContextBuilder），按token预算压缩对话历史
+            llm_max_concurrency: 同时进行的大模型调用上限，超出时按优先级排队（为0时不限制）
+            llm_priority_aging: 排队每满该秒数优先级提升一级，避免低优先级调用饿死
+            bargain_engine: 可选的规则议价引擎（BargainEngine），含义明确的出价直接按规则回复，不调用大模型
+            item_knowledge: 可选的商品知识库（ItemKnowledgeStore），技术咨询时注入商品参数，有知识时不再联网搜索
+            reply_workers: 同时调用generate_reply的worker数，speculative模式按此确定预生成线程数
+        """
+        # 初始化大模型客户端（多后端路由，接口与OpenAI客户端一致）
+        self.client = LLMRouter.from_env()
+        self.keyword_engine = keyword_engine or KeywordEngine(os.getenv("KEYWORDS_DIR", "keywords"))
+        self.metrics = AgentMetrics()  # ttft: 首token延迟, ttfm: 首条消息延迟
+        self.scheduler = LLMScheduler(llm_max_concurrency, llm_priority_aging) if llm_max_concurrency > 0 else None
+        self.item_knowledge = item_knowledge
+        self.routing_strategy = routing_strategy
         self._init_system_prompts()
         self._init_agents()
-        self.router = IntentRouter(self.agents['classify'])
-        self.last_intent = None  # 记录最后一次意图
+        self.router = IntentRouter(self.agents['classify'], self.keyword_engine, intent_classifier, intent_threshold)
+        self.reply_index = reply_index
+        self.reply_cache = reply_cache
+        self.speculative_max_tokens = speculative_max_tokens
+        self.context_builder = context_builder
+        self.bargain_engine = bargain_engine
+        self._context_token_lock = threading.Lock()
+        self.context_token_stats = {}  # Agent -> {'calls', 'tokens_before', 'tokens_after'}
+        self._speculation_lock = threading.Lock()
+        self.speculation_stats = {
+            'runs': 0,
+            'wins': 0,  # 意图为default，直接使用预先生成的回复
+            'losses': 0,  # 意图为price/tech，预先生成的回复被丢弃
+            'fallbacks': 0,  # 预生成失败或被截断，按已识别的意图重新生成
+            'speculative_tokens': 0,
+            'wasted_tokens': 0,
+        }
+        # 每个worker同一时刻最多一个预生成任务，线程数与worker数一致，预生成不会在线程池中排队
+        self._executor = (ThreadPoolExecutor(max_workers=max(1, reply_workers), thread_name_prefix="speculative")
+                          if routing_strategy == "speculative" else None)
 
 
     def _init_agents(self):
         """初始化各领域Agent"""
         self.agents = {
-            'classify':ClassifyAgent(self.client, self.classify_prompt, self._safe_filter),
-            'price': PriceAgent(self.client, self.price_prompt, self._safe_filter),
-            'tech': TechAgent(self.client, self.tech_prompt, self._safe_filter),
-            'default': DefaultAgent(self.client, self.default_prompt, self._safe_filter),
+            'classify':ClassifyAgent(self.client, self.classify_prompt, self._safe_filter, self.metrics),
+            'price': PriceAgent(self.client, self.price_prompt, self._safe_filter, self.metrics),
+            'tech': TechAgent(self.client, self.tech_prompt, self._safe_filter, self.metrics),
+            'default': DefaultAgent(self.client, self.default_prompt, self._safe_filter, self.metrics),
+            'structured': StructuredAgent(self.client, self._build_structured_prompt(), self._safe_filter, self.metrics),
         }
+        for agent in self.agents.values():
+            agent.scheduler = self.scheduler
+        self.agents['tech'].knowledge_store = self.item_knowledge
+        logger.info("Agent模型配置: " + ", ".join(
+            f"{name}={agent.model_config.key}(max_tokens={agent.model_config.max_tokens}, timeout={agent.model_config.timeout:.0f}s)"
+            for name, agent in self.agents.items()
+        ))
+        # 重新加载提示词时同步更新路由器持有的分类Agent
+        if hasattr(self, 'router'):
+            self.router.classify_agent = self.agents['classify']
+
+    def _build_structured_prompt(self) -> str:
+        """拼接结构化模式的系统提示词：输出格式要求 + 分类规则 + 各角色要求"""
+        return "\n\n".join([
+            self.structured_prompt,
+            f"【意图分类规则】\n{self.classify_prompt}",
+            f"【price角色要求】\n{self.price_prompt}",
+            f"【tech角色要求】\n{self.tech_prompt}",
+            f"【default角色要求】\n{self.default_prompt}",
+        ])
 
     def _init_system_prompts(self):
-        """初始化各Agent专用提示词，直接从文件中加载"""
-        prompt_dir = "prompts"
-        
+        """初始化各Agent专用提示词：从prompts目录加载到提示词注册表，文件变化时由注册表通知更新"""
         try:
-            # 加载分类提示词
-            with open(os.path.join(prompt_dir, "classify_prompt.txt"), "r", encoding="utf-8") as f:
-                self.classify_prompt = f.read()
-                logger.debug(f"已加载分类提示词，长度: {len(self.classify_prompt)} 字符")
-            
-            # 加载价格提示词
-            with open(os.path.join(prompt_dir, "price_prompt.txt"), "r", encoding="utf-8") as f:
-                self.price_prompt = f.read()
-                logger.debug(f"已加载价格提示词，长度: {len(self.price_prompt)} 字符")
-            
-            # 加载技术提示词
-            with open(os.path.join(prompt_dir, "tech_prompt.txt"), "r", encoding="utf-8") as f:
-                self.tech_prompt = f.read()
-                logger.debug(f"已加载技术提示词，长度: {len(self.tech_prompt)} 字符")
-            
-            # 加载默认提示词
-            with open(os.path.join(prompt_dir, "default_prompt.txt"), "r", encoding="utf-8") as f:
-                self.default_prompt = f.read()
-                logger.debug(f"已加载默认提示词，长度: {len(self.default_prompt)} 字符")
-                
+            self.prompt_registry = PromptRegistry("prompts", self.PROMPT_FILES)
+            self.prompt_registry.load()
+            self._apply_prompts(initial=True)
+            self.reply_prompt_versions = self._build_reply_prompt_versions()
+            self.prompt_registry.subscribe(self._on_prompts_changed)
             logger.info("成功加载所有提示词")
         except Exception as e:
             logger.error(f"加载提示词时出错: {e}")
             raise
 
+    def _apply_prompts(self, initial: bool = False):
+        """
+        从提示词注册表读取当前版本
+
+        Args:
+            initial: 是否为启动时加载，启动时安抚回复模板解析失败直接抛出异常，
+                重新加载时保留旧模板
+        """
+        registry = self.prompt_registry
+        try:
+            # 超时安抚回复模板（意图 -> 候选回复列表）
+            self.holding_replies = json.loads(registry.text('holding_replies'))
+        except json.JSONDecodeError as e:
+            if initial:
+                raise
+            logger.error(f"安抚回复模板解析失败，保留旧模板: {e}")
+        self.classify_prompt = registry.text('classify')
+        self.price_prompt = registry.text('price')
+        self.tech_prompt = registry.text('tech')
+        self.default_prompt = registry.text('default')
+        self.structured_prompt = registry.text('structured')
+
+    def _build_reply_prompt_versions(self) -> Dict[str, str]:
+        """
+        各意图缓存回复所依赖的提示词版本，只有相关提示词变化时对应意图的缓存回复才失效
+
+        两步生成的回复依赖分类提示词和对应Agent的提示词；结构化模式的提示词拼接了所有角色要求，
+        任一提示词变化都会失效。
+        """
+        versions = self.prompt_registry.versions()
+        if self.routing_strategy == "structured":
+            dependencies = {intent: list(self.REPLY_PROMPTS) for intent in ('price', 'tech', 'default')}
+        else:
+            dependencies = {intent: ['classify', intent] for intent in ('price', 'tech', 'default')}
+        return {
+            intent: hashlib.sha1("\x1f".join(versions[name] for name in names).encode("utf-8")).hexdigest()[:12]
+            for intent, names in dependencies.items()
+        }
+
+    def _on_prompts_changed(self, changed: List[str]):
+        """
+        提示词文件变化后按Agent替换系统提示词，不重建Agent
+
+        进行中的生成已组装好消息，不受影响；之后的调用使用新版本。
+        先替换Agent的提示词再发布新的提示词版本，缓存不会把旧提示词生成的回复记在新版本下。
+        """
+        self._apply_prompts()
+        for name in ('classify', 'price', 'tech', 'default'):
+            if name in changed:
+                self.agents[name].system_prompt = self.prompt_registry.text(name)
+        if set(changed) & set(self.REPLY_PROMPTS):
+            self.agents['structured'].system_prompt = self._build_structured_prompt()
+        self.reply_prompt_versions = self._build_reply_prompt_versions()
+        if 'bargain_rules' in changed:
+            self._reload_bargain_rules()
+        logger.info(f"提示词已更新: {changed}")
+
+    def _reload_bargain_rules(self):
+        """议价引擎使用的是prompts目录下的规则文件时，应用新规则；解析失败时保留旧规则"""
+        engine = self.bargain_engine
+        if engine is None or not engine.path:
+            return
+        path = os.path.join(self.prompt_registry.prompt_dir, self.PROMPT_FILES['bargain_rules'])
+        try:
+            if not os.path.samefile(engine.path, path):
+                return
+            engine.update(json.loads(self.prompt_registry.text('bargain_rules')))
+        except (OSError, json.JSONDecodeError) as e:
+            logger.error(f"议价规则更新失败，保留旧规则: {e}")
+
     def _safe_filter(self, text: str) -> str:
         """安全过滤模块"""
-        blocked_phrases = ["微信", "QQ", "支付宝", "银行卡", "线下"]
-        return "[安全提醒]请通过平台沟通" if any(p in text for p in blocked_phrases) else text
+        return self.SAFETY_REPLY if self.keyword_engine.contains(text, 'blocked') else text
 
     def format_history(self, context: List[Dict]) -> str:
         """格式化对话历史，返回完整的对话记录"""
@@ -68,44 +333,345 @@ class XianyuReplyBot:
         user_assistant_msgs = [msg for msg in context if msg['role'] in ['user', 'assistant']]
         return "\n".join([f"{msg['role']}: {msg['content']}" for msg in user_assistant_msgs])
 
-    def generate_reply(self, user_msg: str, item_desc: str, context: List[Dict]) -> str:
-        """生成回复主流程"""
+    def generate_reply(self, user_msg: str, item_desc: str, context: List[Dict], item_id: str = None,
+                       on_sentence: Callable[[str], None] = None,
+                       handle: Optional[GenerationHandle] = None, item_info: Optional[Dict] = None) -> 'ReplyResult':
+        """
+        生成回复主流程
+
+        每次调用的意图、用量等状态都保存在返回的ReplyResult中，同一个实例可被任意多个并发worker共用。
+
+        Args:
+            on_sentence: 可选的逐句回调。提供时回复以流式方式生成，每个经过安全过滤的完整句子
+                生成后立即回调；缓存命中等非流式路径的回复也会按句回调，调用方无需再单独发送
+            handle: 可选的生成句柄。到达截止时间时中止大模型调用，返回按意图选择的安抚回复
+            item_info: 可选的商品信息（itemDO），提供时议价引擎按挂牌价处理含义明确的出价，
+                TechAgent从中提取商品知识
+
+        Returns:
+            ReplyResult: 回复文本、意图、生成回复的Agent、token用量和耗时
+        """
         # 记录用户消息
         # logger.debug(f'用户所发消息: {user_msg}')
+        start_time = time.time()
+        usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0}
+        timings = {}
+
+        # 记录流式路径已回调的句子，用于判断是否需要补充回调
+        emitted = []
+        stream_callback = None
+        if on_sentence is not None:
+            def stream_callback(sentence: str):
+                emitted.append(sentence)
+                on_sentence(sentence)
         
-        formatted_context = self.format_history(context)
-        # logger.debug(f'对话历史: {formatted_context}')
+        rule_intent = self.router.match_rules(user_msg, record=True)
+        bargain_count = self._extract_bargain_count(context)
+        current_stage.set(self._detect_stage(user_msg, context))
+        current_generation.set(handle)
+        current_item.set((item_id, item_info) if item_info else None)
+        if handle is not None:
+            handle.intent = rule_intent
+
+        # 0. 规则议价引擎（售后阶段的金额多为退款等，不按出价处理）
+        if (self.bargain_engine is not None and item_info and rule_intent != 'tech'
+                and current_stage.get() != 'post_order'):
+            decision = self.bargain_engine.decide(
+                user_msg, item_id, item_info, bargain_count, price_intent=rule_intent == 'price'
+            )
+            if decision is not None:
+                logger.info(f'议价引擎回复: {decision.action}, 出价: {decision.offer}, 价格: {decision.price}')
+                self._emit_sentences(decision.reply, on_sentence)
+                timings['total_ms'] = (time.time() - start_time) * 1000
+                return ReplyResult(decision.reply, 'price', 'bargain_engine', usage, timings)
+        
+        # 0.1 精确匹配回复缓存（提示词版本取本次生成开始时的版本，生成期间提示词更新时写入的条目随即失效）
+        # 缓存键不含对话历史：议价回复依赖议价轮次，依赖上下文的简短跟进也不缓存
+        prompt_versions = self.reply_prompt_versions
+        cache_key = None
+        has_prior_reply = any(msg['role'] == 'assistant' for msg in context)
+        if (self.reply_cache is not None and item_id and rule_intent != 'price'
+                and self.reply_cache.cacheable(user_msg, has_prior_reply)):
+            item_version = self._item_version(item_id, item_desc, item_info)
+            cache_key = self.reply_cache.make_key(item_id, user_msg, rule_intent, bargain_count)
+            hit = self.reply_cache.get(cache_key, item_version, prompt_versions)
+            if hit:
+                reply, intent = hit
+                logger.info(f'命中回复缓存，意图: {intent}')
+                self._emit_sentences(reply, on_sentence)
+                timings['total_ms'] = (time.time() - start_time) * 1000
+                return ReplyResult(reply, intent, 'reply_cache', usage, timings)
         
-        # 1. 路由决策
-        detected_intent = self.router.detect(user_msg, item_desc, formatted_context)
+        # 0.5 历史回复复用（议价回复依赖议价轮次，不复用）
+        if self.reply_index is not None and item_id and rule_intent != 'price':
+            # 关键词未命中时还会省去一次意图分类调用
+            hit = self.reply_index.lookup(item_id, user_msg, skipped_llm_calls=1 if rule_intent else 2)
+            if hit:
+                reply, score = hit
+                logger.info(f'复用历史回复，相似度: {score:.3f}')
+                self._emit_sentences(reply, on_sentence)
+                timings['total_ms'] = (time.time() - start_time) * 1000
+                return ReplyResult(reply, rule_intent or 'default', 'reply_index', usage, timings)
+        
+        if self.context_builder is not None:
+            formatted_context, history_before, history_after = self.context_builder.build(context)
+        else:
+            formatted_context = self.format_history(context)
+            history_before = history_after = estimate_tokens(formatted_context)
+        # logger.debug(f'对话历史: {formatted_context}')
+        logger.info(f'议价次数: {bargain_count}')
 
+        # 1. 规则和本地分类器都无法判断时，按路由策略减少大模型串行调用
+        deadline_hit = False
+        try:
+            result = None
+            if rule_intent is None and self.routing_strategy in ("structured", "speculative"):
+                rule_intent = self.router.classify_local(user_msg)
+                if rule_intent is None and self.routing_strategy == "structured":
+                    # 一次调用同时完成意图识别和回复生成
+                    structured = self.agents['structured'].generate_structured(
+                        user_msg=user_msg,
+                        item_desc=item_desc,
+                        context=formatted_context,
+                        bargain_count=bargain_count,
+                        usage=usage
+                    )
+                    if structured is not None:
+                        logger.info(f'意图识别完成(结构化): {structured[0]}')
+                        result = (structured[0], 'structured', structured[1])
+                elif rule_intent is None:
+                    # 意图分类与默认回复并行
+                    result = self._generate_speculative(user_msg, item_desc, formatted_context, bargain_count,
+                                                        stream_callback, usage, timings)
 
+            if result is None:
+                result = self._generate_sequential(user_msg, item_desc, formatted_context, rule_intent, bargain_count,
+                                                   stream_callback, usage, timings)
+            intent, agent_name, reply = result
+        except GenerationCancelled:
+            logger.info("回复生成已取消")
+            timings['total_ms'] = (time.time() - start_time) * 1000
+            intent = (handle.intent if handle is not None else None) or 'default'
+            return ReplyResult("", intent, 'cancelled', usage, timings, cancelled=True)
+        except DeadlineExceeded as e:
+            deadline_hit = True
+            intent = (handle.intent if handle is not None else None) or 'default'
+            if emitted:
+                # 流式路径已发出部分句子，不再追加安抚回复
+                logger.warning(f"回复生成超过截止时间，已发出 {len(emitted)} 句: {e}")
+                agent_name, reply = intent, "".join(emitted)
+            else:
+                logger.warning(f"回复生成超过截止时间，发送安抚回复: {e}")
+                agent_name, reply = 'holding', self._holding_reply(intent)
 
-        # 2. 获取对应Agent
+        # 非流式路径生成的回复补充逐句回调
+        if not emitted:
+            self._emit_sentences(reply, on_sentence)
 
-        internal_intents = {'classify'}  # 定义不对外开放的Agent
+        if not deadline_hit:
+            self._record_context_tokens(agent_name, user_msg, item_desc, history_before, history_after)
 
-        if detected_intent in self.agents and detected_intent not in internal_intents:
-            agent = self.agents[detected_intent]
-            logger.info(f'意图识别完成: {detected_intent}')
-            self.last_intent = detected_intent  # 保存当前意图
-        else:
-            agent = self.agents['default']
-            logger.info(f'意图识别完成: default')
-            self.last_intent = 'default'  # 保存当前意图
-        
-        # 3. 获取议价次数
-        bargain_count = self._extract_bargain_count(context)
-        logger.info(f'议价次数: {bargain_count}')
+        # 安全提醒、超时回复和议价回复不缓存，避免一次误判、慢响应或某一轮的报价长期生效
+        if (cache_key is not None and reply and intent != 'price'
+                and self.SAFETY_REPLY not in reply and not deadline_hit):
+            self.reply_cache.put(cache_key, reply, intent, item_version, prompt_versions.get(intent, ""))
+        timings['total_ms'] = (time.time() - start_time) * 1000
+        return ReplyResult(reply, intent, agent_name, usage, timings, deadline_hit)
+
+    @classmethod
+    def should_index(cls, result: 'ReplyResult') -> bool:
+        """判断回复能否作为历史回复加入索引"""
+        return (result.agent in cls.INDEXABLE_AGENTS and result.intent != 'price'
+                and not result.deadline_hit and bool(result.text) and cls.SAFETY_REPLY not in result.text)
+
+    def _holding_reply(self, intent: str) -> str:
+        """按会话阶段和意图选择安抚回复"""
+        key = 'post_order' if current_stage.get() == 'post_order' else intent
+        candidates = self.holding_replies.get(key) or self.holding_replies.get('default') or ["稍等，马上回复您~"]
+        return random.choice(candidates)
+    
+    def _record_context_tokens(self, agent_name: str, user_msg: str, item_desc: str,
+                               history_before: int, history_after: int):
+        """记录并输出每个Agent压缩前后的提示词token估算"""
+        agent = self.agents.get(agent_name) or self.agents['default']
+        static = estimate_tokens(agent.system_prompt) + estimate_tokens(item_desc) + estimate_tokens(user_msg)
+        before, after = static + history_before, static + history_after
+        logger.info(f'提示词token估算[{agent_name}]: {before} -> {after}')
+        with self._context_token_lock:
+            stats = self.context_token_stats.setdefault(
+                agent_name, {'calls': 0, 'tokens_before': 0, 'tokens_after': 0}
+            )
+            stats['calls'] += 1
+            stats['tokens_before'] += before
+            stats['tokens_after'] += after
+
+    def _emit_sentences(self, reply: str, on_sentence: Callable[[str], None] = None) -> str:
+        """将完整回复按句回调，返回原回复"""
+        if on_sentence is not None and reply:
+            for sentence in SentenceStreamFilter.SENTENCE_PATTERN.findall(reply) + [
+                SentenceStreamFilter.SENTENCE_PATTERN.sub('', reply)
+            ]:
+                if sentence.strip():
+                    on_sentence(sentence.strip())
+        return reply
+
+    def _item_version(self, item_id: str, item_desc: str, item_info: Optional[Dict]) -> str:
+        """
+        回复缓存使用的商品版本号，仅在尝试读写回复缓存时计算
+
+        Args:
+            item_id: 商品ID
+            item_desc: 商品描述
+            item_info: 商品信息
+
+        Returns:
+            str: 商品信息或商品知识变化时随之变化的版本号
+        """
+        source = item_desc
+        if self.item_knowledge is not None and item_info:
+            # 商品知识变化时，技术咨询等依赖商品参数的缓存回复随之失效
+            source += self.item_knowledge.version(item_id, item_info)
+        return hashlib.sha1(source.encode("utf-8")).hexdigest()[:12]
+
+    def _detect_intent(self, user_msg: str, item_desc: str, formatted_context: str, usage: Dict, timings: Dict) -> str:
+        """调用路由器识别意图，记录分类耗时"""
+        classify_start = time.time()
+        intent = self.router.detect(user_msg, item_desc, formatted_context, usage=usage)
+        timings['classify_ms'] = (time.time() - classify_start) * 1000
+        handle = current_generation.get()
+        if handle is not None:
+            handle.intent = intent
+        return intent
+
+    def _generate_sequential(self, user_msg: str, item_desc: str, formatted_context: str,
+                             rule_intent: str, bargain_count: int, on_sentence: Callable[[str], None],
+                             usage: Dict, timings: Dict):
+        """
+        两步生成：先路由决策（规则已命中时无需再次匹配），再由对应Agent生成回复
+
+        Returns:
+            tuple: (意图, Agent名, 回复)
+        """
+        detected_intent = rule_intent or self._detect_intent(user_msg, item_desc, formatted_context, usage, timings)
+
+        internal_intents = {'classify', 'structured'}  # 定义不对外开放的Agent
 
-        # 4. 生成回复
-        return agent.generate(
+        if detected_intent not in self.agents or detected_intent in internal_intents:
+            detected_intent = 'default'
+        logger.info(f'意图识别完成: {detected_intent}')
+        return self._generate_with_agent(detected_intent, user_msg, item_desc, formatted_context, bargain_count,
+                                         on_sentence, usage, timings)
+
+    def _generate_with_agent(self, intent: str, user_msg: str, item_desc: str, formatted_context: str,
+                             bargain_count: int, on_sentence: Callable[[str], None], usage: Dict, timings: Dict):
+        """
+        由意图对应的Agent生成回复，记录生成耗时
+
+        Returns:
+            tuple: (意图, Agent名, 回复)
+        """
+        generate_start = time.time()
+        reply = self.agents[intent].generate(
             user_msg=user_msg,
             item_desc=item_desc,
             context=formatted_context,
-            bargain_count=bargain_count
+            bargain_count=bargain_count,
+            on_sentence=on_sentence,
+            usage=usage
         )
-    
+        timings['generate_ms'] = (time.time() - generate_start) * 1000
+        return intent, intent, reply
+
+    def _generate_speculative(self, user_msg: str, item_desc: str, formatted_context: str, bargain_count: int,
+                              on_sentence: Callable[[str], None], usage: Dict, timings: Dict):
+        """
+        意图分类的同时预先生成默认回复
+
+        Returns:
+            tuple: (意图, Agent名, 回复)。意图为default时直接使用预先生成的回复，
+            否则中止预生成并由对应的专用Agent生成回复；预生成失败或达到长度上限被截断时，
+            沿用已识别的意图重新完整生成，不再重复意图识别
+        """
+        cancel_event = threading.Event()
+        speculative_usage = {'prompt_tokens': 0, 'completion_tokens': 0, 'cached_tokens': 0}
+        # 在当前上下文中执行，使预生成调用沿用本次请求的会话阶段
+        future = self._executor.submit(
+            contextvars.copy_context().run,
+            self.agents['default'].generate_speculative,
+            user_msg=user_msg,
+            item_desc=item_desc,
+            context=formatted_context,
+            cancel_event=cancel_event,
+            usage=speculative_usage,
+            max_tokens=self.speculative_max_tokens
+        )
+
+        detected_intent = self._detect_intent(user_msg, item_desc, formatted_context, usage, timings)
+        with self._speculation_lock:
+            self.speculation_stats['runs'] += 1
+
+        if detected_intent not in ('price', 'tech'):
+            try:
+                reply = future.result()
+            except (DeadlineExceeded, GenerationCancelled):
+                raise
+            except Exception as e:
+                if isinstance(e, ReplyTruncated):
+                    logger.info(f"预生成默认回复被截断，重新完整生成: {e}")
+                else:
+                    logger.warning(f"预生成默认回复失败，重新生成: {e}")
+                for key, value in speculative_usage.items():
+                    usage[key] = usage.get(key, 0) + value
+                with self._speculation_lock:
+                    self.speculation_stats['fallbacks'] += 1
+                    self.speculation_stats['speculative_tokens'] += speculative_usage['completion_tokens']
+                    self.speculation_stats['wasted_tokens'] += speculative_usage['completion_tokens']
+                logger.info('意图识别完成: default')
+                return self._generate_with_agent('default', user_msg, item_desc, formatted_context, bargain_count,
+                                                 on_sentence, usage, timings)
+            for key, value in speculative_usage.items():
+                usage[key] = usage.get(key, 0) + value
+            with self._speculation_lock:
+                self.speculation_stats['wins'] += 1
+                self.speculation_stats['speculative_tokens'] += speculative_usage['completion_tokens']
+            logger.info('意图识别完成: default（使用预生成回复）')
+            return 'default', 'default', reply
+
+        # 意图不是default：中止预生成，已生成的token计入浪费
+        cancel_event.set()
+
+        def record_waste(_):
+            with self._speculation_lock:
+                self.speculation_stats['losses'] += 1
+                self.speculation_stats['speculative_tokens'] += speculative_usage['completion_tokens']
+                self.speculation_stats['wasted_tokens'] += speculative_usage['completion_tokens']
+        future.add_done_callback(record_waste)
+
+        logger.info(f'意图识别完成: {detected_intent}（丢弃预生成回复）')
+        return self._generate_with_agent(detected_intent, user_msg, item_desc, formatted_context, bargain_count,
+                                         on_sentence, usage, timings)
+
+    def get_speculation_stats(self) -> Dict:
+        """获取speculative模式统计信息"""
+        with self._speculation_lock:
+            runs = self.speculation_stats['runs']
+            return {
+                **self.speculation_stats,
+                'win_rate': self.speculation_stats['wins'] / runs if runs else 0.0,
+            }
+
+    def _detect_stage(self, user_msg: str, context: List[Dict], lookback: int = 10):
+        """
+        判断会话阶段：当前消息或最近的对话命中post_order关键词时视为售后阶段
+
+        Returns:
+            str: 'post_order'，其他情况返回None
+        """
+        recent = [msg['content'] for msg in context[-lookback:] if msg['role'] in ('user', 'assistant')]
+        if any(self.keyword_engine.contains(text, 'post_order') for text in [user_msg, *recent]):
+            return 'post_order'
+        return None
+
     def _extract_bargain_count(self, context: List[Dict]) -> int:
         """
         从上下文中提取议价次数信息
@@ -128,152 +694,661 @@ class XianyuReplyBot:
                     pass
         return 0
 
-    def reload_prompts(self):
-        """重新加载所有提示词"""
-        logger.info("正在重新加载提示词...")
-        self._init_system_prompts()
-        self._init_agents()
-        logger.info("提示词重新加载完成")
+    def reload_prompts(self) -> List[str]:
+        """
+        检查提示词文件变化并应用新版本（在后台线程中定期调用）
+
+        Returns:
+            list: 内容发生变化的提示词名称
+        """
+        return self.prompt_registry.poll()
 
 
 class IntentRouter:
     """意图路由决策器"""
 
-    def __init__(self, classify_agent):
-        self.rules = {
-            'tech': {  # 技术类优先判定
-                'keywords': ['参数', '规格', '型号', '连接', '对比'],
-                'patterns': [
-                    r'和.+比'             
-                ]
-            },
-            'price': {
-                'keywords': ['便宜', '价', '砍价', '少点'],
-                'patterns': [r'\d+元', r'能少\d+']
-            }
-        }
+    def __init__(self, classify_agent, keyword_engine, local_classifier=None, threshold: float = 0.8):
+        self.keyword_engine = keyword_engine
         self.classify_agent = classify_agent
+        self.local_classifier = local_classifier
+        self.threshold = threshold
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            'rule_hits': 0,
+            'local_hits': 0,
+            'llm_fallbacks': 0,
+        }
+
+    def _count(self, key: str):
+        with self._stats_lock:
+            self.stats[key] += 1
 
-    def detect(self, user_msg: str, item_desc, context) -> str:
+    def detect(self, user_msg: str, item_desc, context, usage: Dict = None) -> str:
         """三级路由策略（技术优先）"""
-        text_clean = re.sub(r'[^\w\u4e00-\u9fa5]', '', user_msg)
-        
-        # 1. 技术类关键词优先检查
-        if any(kw in text_clean for kw in self.rules['tech']['keywords']):
-            # logger.debug(f"技术类关键词匹配: {[kw for kw in self.rules['tech']['keywords'] if kw in text_clean]}")
-            return 'tech'
-            
-        # 2. 技术类正则优先检查
-        for pattern in self.rules['tech']['patterns']:
-            if re.search(pattern, text_clean):
-                # logger.debug(f"技术类正则匹配: {pattern}")
-                return 'tech'
-
-        # 3. 价格类检查
-        for intent in ['price']:
-            if any(kw in text_clean for kw in self.rules[intent]['keywords']):
-                # logger.debug(f"价格类关键词匹配: {[kw for kw in self.rules[intent]['keywords'] if kw in text_clean]}")
-                return intent
-            
-            for pattern in self.rules[intent]['patterns']:
-                if re.search(pattern, text_clean):
-                    # logger.debug(f"价格类正则匹配: {pattern}")
-                    return intent
-        
-        # 4. 大模型兜底
+        intent = self.match_rules(user_msg, record=True)
+        if intent:
+            return intent
+
+        # 4. 本地分类器，置信度足够时直接采纳
+        intent = self.classify_local(user_msg)
+        if intent:
+            return intent
+
+        # 5. 大模型兜底
         # logger.debug("使用大模型进行意图分类")
+        self._count('llm_fallbacks')
         return self.classify_agent.generate(
             user_msg=user_msg,
             item_desc=item_desc,
-            context=context
+            context=context,
+            usage=usage
         )
 
+    def classify_local(self, user_msg: str):
+        """使用本地分类器判断意图，未配置或置信度不足时返回None"""
+        if self.local_classifier is None:
+            return None
+        intent, confidence = self.local_classifier.predict(user_msg)
+        if confidence >= self.threshold:
+            self._count('local_hits')
+            return intent
+        logger.debug(f"本地意图分类置信度不足: {intent} ({confidence:.2f})，回退到大模型")
+        return None
+
+    def match_rules(self, user_msg: str, record: bool = False):
+        """
+        仅使用关键词和正则规则判断意图，未命中时返回None
+
+        Args:
+            record: 是否计入路由统计（路由回复时为True，离线标注等场景为False）
+        """
+        text_clean = re.sub(r'[^\w\u4e00-\u9fa5]', '', user_msg)
+        categories = self.keyword_engine.categories(text_clean)
+
+        intent = None
+        # 1. 技术类优先判定
+        if 'intent_tech' in categories:
+            intent = 'tech'
+
+        # 2. 价格类检查
+        elif 'intent_price' in categories:
+            intent = 'price'
+
+        if intent and record:
+            self._count('rule_hits')
+        return intent
+
+    def get_stats(self) -> Dict:
+        """获取意图路由统计信息"""
+        with self._stats_lock:
+            total = sum(self.stats.values())
+            return {
+                **self.stats,
+                'llm_fallback_rate': self.stats['llm_fallbacks'] / total if total else 0.0,
+            }
+
+
+def _accumulate_usage(usage: Optional[Dict], response_usage):
+    """将接口返回的用量累加到单次请求的用量字典中"""
+    if usage is None or response_usage is None:
+        return
+    details = getattr(response_usage, 'prompt_tokens_details', None)
+    usage['prompt_tokens'] = usage.get('prompt_tokens', 0) + (response_usage.prompt_tokens or 0)
+    usage['completion_tokens'] = usage.get('completion_tokens', 0) + (response_usage.completion_tokens or 0)
+    usage['cached_tokens'] = usage.get('cached_tokens', 0) + ((getattr(details, 'cached_tokens', 0) or 0) if details else 0)
+
+
+class LLMScheduler:
+    """
+    大模型调用优先级调度器
+
+    同时进行的调用数达到上限时，新的调用按优先级排队：售后会话最高，其次议价和意图分类，
+    技术咨询和结构化生成居中，闲聊和后台摘要最低。排队时间每满aging_seconds秒优先级提升一级，
+    低优先级调用不会被持续到来的高优先级调用饿死。
+    """
+
+    # 数值越小优先级越高
+    PRIORITIES = {
+        'post_order': 0,
+        'price': 1,
+        'classify': 1,
+        'tech': 2,
+        'structured': 2,
+        'default': 3,
+        'background': 4,
+    }
+
+    def __init__(self, max_concurrent: int = 8, aging_seconds: float = 5.0):
+        """
+        Args:
+            max_concurrent: 同时进行的大模型调用上限
+            aging_seconds: 排队每满该秒数优先级提升一级
+        """
+        self.max_concurrent = max_concurrent
+        self.aging_seconds = aging_seconds
+        self._condition = threading.Condition()
+        self._active = 0
+        self._seq = 0
+        self._waiters: Dict[int, tuple] = {}  # 序号 -> (基础优先级, 入队时间)
+        self._stats: Dict[str, Dict] = {}
+
+    def _is_next(self, seq: int, now: float) -> bool:
+        """判断seq是否为当前有效优先级最高的等待者（同优先级按入队顺序）"""
+        def effective(item):
+            waiter_seq, (base, enqueued) = item
+            return base - (now - enqueued) / self.aging_seconds, waiter_seq
+        return min(self._waiters.items(), key=effective)[0] == seq
+
+    @contextmanager
+    def slot(self, priority_class: str, timeout: Optional[float] = None, cancel_event: threading.Event = None):
+        """
+        占用一个大模型调用名额，名额不足时按优先级等待
+
+        Args:
+            priority_class: 优先级类别（PRIORITIES中的键）
+            timeout: 最长等待秒数，超时抛出DeadlineExceeded
+            cancel_event: 等待期间被设置时放弃排队，抛出GenerationCancelled；可为多个Event的列表，任一被设置即放弃
+        """
+        if isinstance(cancel_event, threading.Event):
+            cancel_events = [cancel_event]
+        else:
+            cancel_events = [event for event in cancel_event or [] if event is not None]
+        base = self.PRIORITIES.get(priority_class, self.PRIORITIES['default'])
+        enqueued = time.monotonic()
+        give_up_at = None if timeout is None else enqueued + timeout
+        with self._condition:
+            stats = self._stats.setdefault(priority_class, {
+                'calls': 0, 'waited': 0, 'timeouts': 0, 'total_wait_ms': 0.0, 'max_wait_ms': 0.0,
+            })
+            self._seq += 1
+            seq = self._seq
+            self._waiters[seq] = (base, enqueued)
+            while self._active >= self.max_concurrent or not self._is_next(seq, time.monotonic()):
+                remaining = None if give_up_at is None else give_up_at - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    del self._waiters[seq]
+                    stats['timeouts'] += 1
+                    self._condition.notify_all()
+                    raise DeadlineExceeded(f"等待大模型调用名额超时: {priority_class}")
+                if any(event.is_set() for event in cancel_events):
+                    del self._waiters[seq]
+                    self._condition.notify_all()
+                    raise GenerationCancelled(f"排队期间生成被取消: {priority_class}")
+                # 取消信号不会唤醒条件变量，可取消的等待按短间隔轮询
+                if cancel_events:
+                    remaining = 0.1 if remaining is None else min(remaining, 0.1)
+                self._condition.wait(remaining)
+            del self._waiters[seq]
+            self._active += 1
+            wait_ms = (time.monotonic() - enqueued) * 1000
+            stats['calls'] += 1
+            stats['waited'] += wait_ms >= 1
+            stats['total_wait_ms'] += wait_ms
+            stats['max_wait_ms'] = max(stats['max_wait_ms'], wait_ms)
+            # 可能还有空闲名额，唤醒其他等待者重新判断
+            self._condition.notify_all()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._active -= 1
+                self._condition.notify_all()
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """
+        Returns:
+            dict: 优先级类别 -> {'calls', 'waited', 'timeouts', 'avg_wait_ms', 'max_wait_ms'}
+        """
+        with self._condition:
+            return {
+                name: {
+                    'calls': stats['calls'],
+                    'waited': stats['waited'],
+                    'timeouts': stats['timeouts'],
+                    'avg_wait_ms': stats['total_wait_ms'] / stats['calls'] if stats['calls'] else 0.0,
+                    'max_wait_ms': stats['max_wait_ms'],
+                }
+                for name, stats in self._stats.items()
+            }
+
+
+class AgentMetrics:
+    """Agent指标记录器：延迟样本（保留最近的样本用于计算分位数）和各Agent的token用量"""
+
+    def __init__(self, window: int = 1000):
+        self._samples: Dict[str, deque] = {}
+        self._counts: Dict[str, int] = {}
+        self._usage: Dict[str, Dict[str, int]] = {}
+        self._model_stats: Dict[str, Dict] = {}
+        self._deadline_hits: Dict[tuple, int] = {}
+        self._window = window
+        self._lock = threading.Lock()
+
+    def record(self, name: str, ms: float):
+        """记录一个延迟样本（毫秒）"""
+        with self._lock:
+            self._samples.setdefault(name, deque(maxlen=self._window)).append(ms)
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def record_usage(self, agent_name: str, usage):
+        """记录一次调用的token用量，服务端返回缓存命中token数时一并记录"""
+        if usage is None:
+            return
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cached = (getattr(details, 'cached_tokens', 0) or 0) if details is not None else 0
+        with self._lock:
+            stats = self._usage.setdefault(
+                agent_name, {'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0}
+            )
+            stats['calls'] += 1
+            stats['prompt_tokens'] += usage.prompt_tokens or 0
+            stats['cached_tokens'] += cached
+            stats['completion_tokens'] += usage.completion_tokens or 0
+
+    def record_model_call(self, model_key: str, ms: Optional[float], usage=None):
+        """
+        按模型档位记录一次调用
+
+        Args:
+            model_key: ModelConfig.key
+            ms: 调用耗时（毫秒），流式生成被中途取消时为None，不计入延迟样本
+            usage: 接口返回的token用量
+        """
+        with self._lock:
+            stats = self._model_stats.setdefault(model_key, {
+                'calls': 0, 'prompt_tokens': 0, 'completion_tokens': 0, 'latencies': deque(maxlen=self._window),
+            })
+            stats['calls'] += 1
+            if ms is not None:
+                stats['latencies'].append(ms)
+            if usage is not None:
+                stats['prompt_tokens'] += usage.prompt_tokens or 0
+                stats['completion_tokens'] += usage.completion_tokens or 0
+
+    def record_deadline_hit(self, agent_name: str, model_key: str):
+        """记录一次大模型调用因截止时间被中止"""
+        with self._lock:
+            key = (agent_name, model_key)
+            self._deadline_hits[key] = self._deadline_hits.get(key, 0) + 1
+
+    def deadline_summary(self) -> Dict[tuple, int]:
+        """
+        Returns:
+            dict: (Agent名, 模型档位) -> 超时中止次数
+        """
+        with self._lock:
+            return dict(self._deadline_hits)
+
+    def model_summary(self) -> Dict[str, Dict]:
+        """
+        Returns:
+            dict: 模型档位 -> {'calls', 'p50', 'p95'（毫秒）, 'prompt_tokens', 'completion_tokens'}
+        """
+        with self._lock:
+            result = {}
+            for key, stats in self._model_stats.items():
+                ordered = sorted(stats['latencies']) or [0.0]
+                result[key] = {
+                    'calls': stats['calls'],
+                    'p50': ordered[len(ordered) // 2],
+                    'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                    'prompt_tokens': stats['prompt_tokens'],
+                    'completion_tokens': stats['completion_tokens'],
+                }
+            return result
+
+    def summary(self) -> Dict[str, Dict]:
+        """
+        Returns:
+            dict: 指标名 -> {'count', 'p50', 'p95', 'max'}（毫秒）
+        """
+        with self._lock:
+            result = {}
+            for name, samples in self._samples.items():
+                ordered = sorted(samples)
+                result[name] = {
+                    'count': self._counts[name],
+                    'p50': ordered[len(ordered) // 2],
+                    'p95': ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))],
+                    'max': ordered[-1],
+                }
+            return result
+
+    def usage_summary(self) -> Dict[str, Dict]:
+        """
+        Returns:
+            dict: Agent名 -> {'calls', 'prompt_tokens', 'cached_tokens', 'completion_tokens', 'cache_hit_ratio'}
+        """
+        with self._lock:
+            return {
+                name: {
+                    **stats,
+                    'cache_hit_ratio': stats['cached_tokens'] / stats['prompt_tokens'] if stats['prompt_tokens'] else 0.0,
+                }
+                for name, stats in self._usage.items()
+            }
+
+
+class SentenceStreamFilter:
+    """
+    流式输出的增量安全过滤
+
+    持续累积模型输出，每凑齐一个完整句子就经过安全过滤后交给回调发送；
+    未完成的句子一旦命中屏蔽词立即输出安全提醒并通知调用方停止生成。
+    """
+
+    SENTENCE_PATTERN = re.compile(r'[^。！？!?\n]*[。！？!?\n]')
+
+    def __init__(self, safety_filter: Callable[[str], str], on_sentence: Callable[[str], None]):
+        self.safety_filter = safety_filter
+        self.on_sentence = on_sentence
+        self.buffer = ""
+        self.sentences: List[str] = []
+        self.blocked = False
+
+    def feed(self, delta: str) -> bool:
+        """
+        输入一段增量文本
+
+        Returns:
+            bool: 是否继续生成，命中屏蔽词后返回False
+        """
+        if self.blocked:
+            return False
+        self.buffer += delta
+        filtered = self.safety_filter(self.buffer)
+        if filtered != self.buffer:
+            self.blocked = True
+            self.buffer = ""
+            self._emit(filtered)
+            return False
+
+        while True:
+            match = self.SENTENCE_PATTERN.match(self.buffer)
+            if not match:
+                break
+            self.buffer = self.buffer[match.end():]
+            self._emit(match.group(0))
+        return True
+
+    def close(self):
+        """生成结束，输出剩余的不完整句子"""
+        if not self.blocked and self.buffer:
+            self._emit(self.safety_filter(self.buffer))
+        self.buffer = ""
+
+    @property
+    def text(self) -> str:
+        """已输出的完整文本"""
+        return "".join(self.sentences)
+
+    def _emit(self, sentence: str):
+        sentence = sentence.strip()
+        if sentence:
+            self.sentences.append(sentence)
+            self.on_sentence(sentence)
+
 
 class BaseAgent:
     """Agent基类"""
 
-    def __init__(self, client, system_prompt, safety_filter):
+    # 读取模型配置时使用的Agent名
+    agent_name = 'default'
+
+    def __init__(self, client, system_prompt, safety_filter, metrics: Optional[AgentMetrics] = None,
+                 model_config: Optional[ModelConfig] = None):
         self.client = client
         self.system_prompt = system_prompt
         self.safety_filter = safety_filter
+        self.metrics = metrics
+        self.model_config = model_config or load_model_config(self.agent_name)
+        self.scheduler: Optional[LLMScheduler] = None
 
-    def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int = 0) -> str:
+    def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int = 0,
+                 on_sentence: Callable[[str], None] = None, usage: Dict = None) -> str:
         """生成回复模板方法"""
         messages = self._build_messages(user_msg, item_desc, context)
-        response = self._call_llm(messages)
+        response = self._call_llm(messages, on_sentence=on_sentence, usage=usage)
         return self.safety_filter(response)
 
     def _build_messages(self, user_msg: str, item_desc: str, context: str) -> List[Dict]:
-        """构建消息链"""
+        """
+        构建消息链
+
+        系统消息按变化频率由低到高排列：固定的Agent提示词、商品信息段、对话历史，
+        使同一Agent、同一商品的连续请求共享最长的前缀，便于服务端前缀缓存命中。
+        """
         return [
-            {"role": "system", "content": f"【商品信息】{item_desc}\n【你与客户对话历史】{context}\n{self.system_prompt}"},
+            {"role": "system", "content": f"{self.system_prompt}\n【商品信息】{item_desc}\n【你与客户对话历史】{context}"},
             {"role": "user", "content": user_msg}
         ]
 
-    def _call_llm(self, messages: List[Dict], temperature: float = 0.4) -> str:
-        """调用大模型"""
-        response = self.client.chat.completions.create(
-            model=os.getenv("MODEL_NAME", "qwen-max"),
-            messages=messages,
-            temperature=temperature,
-            max_tokens=500,
-            top_p=0.8
+    def _request_options(self, max_tokens: Optional[int] = None) -> Dict:
+        """按模型配置生成请求参数，当前请求设置了截止时间时超时不超过剩余时间"""
+        timeout = self.model_config.timeout
+        handle = current_generation.get()
+        remaining = handle.remaining() if handle is not None else None
+        if remaining is not None:
+            timeout = max(min(timeout, remaining), 0.1)
+        return {
+            'model': self.model_config.model,
+            'max_tokens': max_tokens or self.model_config.max_tokens,
+            'timeout': timeout,
+        }
+
+    @contextmanager
+    def _llm_call(self, cancel_event: threading.Event = None):
+        """
+        包裹一次大模型调用：按会话阶段和Agent类型占用调用名额（未配置调度器时不限制），
+        当前请求或cancel_event（如预生成任务的取消信号）被取消时抛出GenerationCancelled，
+        超过截止时间时记录命中并抛出DeadlineExceeded
+        """
+        handle = current_generation.get()
+        try:
+            if handle is not None and handle.cancelled:
+                raise GenerationCancelled("回复生成已取消")
+            if cancel_event is not None and cancel_event.is_set():
+                raise GenerationCancelled("调用开始前已取消")
+            if handle is not None and handle.expired():
+                raise DeadlineExceeded("回复生成已超过截止时间")
+            if self.scheduler is None:
+                slot = nullcontext()
+            elif handle is None:
+                slot = self.scheduler.slot(current_stage.get() or self.agent_name, cancel_event=cancel_event)
+            else:
+                slot = self.scheduler.slot(current_stage.get() or self.agent_name, timeout=handle.remaining(),
+                                           cancel_event=[handle.cancel_event, cancel_event])
+            with slot:
+                yield
+        except Exception as e:
+            if handle is not None and handle.cancelled:
+                if isinstance(e, GenerationCancelled):
+                    raise
+                raise GenerationCancelled(f"回复生成已取消: {e}") from e
+            if handle is None or not handle.expired():
+                raise
+            if self.metrics is not None:
+                self.metrics.record_deadline_hit(self.agent_name, self.model_config.key)
+            if isinstance(e, DeadlineExceeded):
+                raise
+            raise DeadlineExceeded(f"大模型调用超过截止时间: {e}") from e
+
+    def _record_call(self, start: float, response_usage, completed: bool = True):
+        """记录一次调用的Agent用量和模型档位统计"""
+        if self.metrics is None:
+            return
+        if response_usage is not None:
+            self.metrics.record_usage(type(self).__name__, response_usage)
+        self.metrics.record_model_call(
+            self.model_config.key, (time.time() - start) * 1000 if completed else None, response_usage
         )
+
+    def _call_llm(self, messages: List[Dict], temperature: float = 0.4, max_tokens: int = None, usage: Dict = None,
+                  on_sentence: Callable[[str], None] = None, **extra) -> str:
+        """
+        调用大模型
+
+        Args:
+            max_tokens: 最大输出token数，未提供时使用模型配置
+            usage: 可选的token用量累加字典（prompt_tokens、completion_tokens）
+            on_sentence: 提供时以流式方式生成，每个经过安全过滤的完整句子生成后立即回调
+            extra: 透传给接口的其他参数（如extra_body）
+        """
+        if on_sentence is not None:
+            stream_filter = SentenceStreamFilter(self.safety_filter, on_sentence)
+            self._stream_llm(messages, temperature=temperature, max_tokens=max_tokens, usage=usage,
+                             on_delta=stream_filter.feed, **extra)
+            stream_filter.close()
+            return stream_filter.text
+
+        with self._llm_call():
+            start = time.time()
+            response = self.client.chat.completions.create(
+                messages=messages,
+                temperature=temperature,
+                top_p=0.8,
+                **self._request_options(max_tokens),
+                **extra
+            )
+        self._record_call(start, response.usage)
+        _accumulate_usage(usage, response.usage)
         return response.choices[0].message.content
 
+    def _stream_llm(self, messages: List[Dict], cancel_event: threading.Event = None, temperature: float = 0.4,
+                    max_tokens: int = None, usage: Dict = None, on_delta: Callable[[str], bool] = None,
+                    finish: Dict = None, **extra) -> str:
+        """
+        以流式方式调用大模型，cancel_event被设置或on_delta返回False时立即关闭连接停止生成
+
+        Args:
+            finish: 可选的字典，生成结束时写入服务端返回的finish_reason
+
+        Returns:
+            str: 已生成的文本（被取消时为部分文本）
+        """
+        handle = current_generation.get()
+        # 流式生成期间一直占用名额；取得名额前后都检查取消，已取消的调用不再发出请求
+        with self._llm_call(cancel_event):
+            if cancel_event is not None and cancel_event.is_set():
+                raise GenerationCancelled("流式生成在请求发出前已取消")
+            start = time.time()
+            stream = self.client.chat.completions.create(
+                messages=messages,
+                temperature=temperature,
+                top_p=0.8,
+                stream=True,
+                stream_options={"include_usage": True},
+                **self._request_options(max_tokens),
+                **extra
+            )
+            parts = []
+            reported = None
+            completed = False
+            try:
+                for chunk in stream:
+                    if cancel_event is not None and cancel_event.is_set():
+                        break
+                    if handle is not None and (handle.cancelled or handle.expired()):
+                        break
+                    if finish is not None and chunk.choices and chunk.choices[0].finish_reason:
+                        finish['finish_reason'] = chunk.choices[0].finish_reason
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        delta = chunk.choices[0].delta.content
+                        if not parts and self.metrics is not None:
+                            self.metrics.record('ttft', (time.time() - start) * 1000)
+                        parts.append(delta)
+                        if on_delta is not None and not on_delta(delta):
+                            break
+                    if chunk.usage:
+                        _accumulate_usage(usage, chunk.usage)
+                        reported = chunk.usage
+                else:
+                    completed = True
+            finally:
+                close = getattr(stream, 'close', None)
+                if close:
+                    close()
+            self._record_call(start, reported, completed)
+            text = "".join(parts)
+            if usage is not None and not reported:
+                # 中途取消时服务端不返回用量，按字符数估算（中文约1字1token）
+                usage['completion_tokens'] = usage.get('completion_tokens', 0) + len(text)
+            if handle is not None and not completed:
+                if handle.cancelled:
+                    raise GenerationCancelled("流式生成已取消")
+                if handle.expired():
+                    raise DeadlineExceeded("流式生成超过截止时间")
+        return text
+
 
 class PriceAgent(BaseAgent):
     """议价处理Agent"""
 
-    def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int=0) -> str:
+    agent_name = 'price'
+
+    def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int=0,
+                 on_sentence: Callable[[str], None] = None, usage: Dict = None) -> str:
         """重写生成逻辑"""
         dynamic_temp = self._calc_temperature(bargain_count)
         messages = self._build_messages(user_msg, item_desc, context)
         messages[0]['content'] += f"\n▲当前议价轮次：{bargain_count}"
 
-        response = self.client.chat.completions.create(
-            model=os.getenv("MODEL_NAME", "qwen-max"),
-            messages=messages,
-            temperature=dynamic_temp,
-            max_tokens=500,
-            top_p=0.8
-        )
-        return self.safety_filter(response.choices[0].message.content)
+        response = self._call_llm(messages, temperature=dynamic_temp, on_sentence=on_sentence, usage=usage)
+        return self.safety_filter(response)
 
-    def _calc_temperature(self, bargain_count: int) -> float:
+    @staticmethod
+    def _calc_temperature(bargain_count: int) -> float:
         """动态温度策略"""
         return min(0.3 + bargain_count * 0.15, 0.9)
 
 
 class TechAgent(BaseAgent):
     """技术咨询Agent"""
-    def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int=0) -> str:
-        """重写生成逻辑"""
+
+    agent_name = 'tech'
+
+    # 商品知识库（ItemKnowledgeStore），由XianyuReplyBot设置
+    knowledge_store = None
+
+    def generate(self, user_msg: str, item_desc: str, context: str, bargain_count: int=0,
+                 on_sentence: Callable[[str], None] = None, usage: Dict = None) -> str:
+        """重写生成逻辑：有商品知识时注入提示词，没有时才开启联网搜索"""
+        knowledge = self._fetch_tech_specs()
+        item_desc = self.with_knowledge(item_desc, knowledge)
         messages = self._build_messages(user_msg, item_desc, context)
-        # messages[0]['content'] += "\n▲知识库：\n" + self._fetch_tech_specs()
 
-        response = self.client.chat.completions.create(
-            model=os.getenv("MODEL_NAME", "qwen-max"),
-            messages=messages,
+        response = self._call_llm(
+            messages,
             temperature=0.4,
-            max_tokens=500,
-            top_p=0.8,
+            on_sentence=on_sentence,
+            usage=usage,
             extra_body={
-                "enable_search": True,
+                "enable_search": not knowledge,
             }
         )
 
-        return self.safety_filter(response.choices[0].message.content)
+        return self.safety_filter(response)
 
+    @staticmethod
+    def with_knowledge(item_desc: str, knowledge: str) -> str:
+        """知识片段并入按商品版本缓存的商品信息段，保持提示词前缀稳定"""
+        if not knowledge:
+            return item_desc
+        return f"{item_desc}\n【商品参数】\n{knowledge}"
 
-    # def _fetch_tech_specs(self) -> str:
-    #     """模拟获取技术参数（可连接数据库）"""
-    #     return "功率：200W@8Ω\n接口：XLR+RCA\n频响：20Hz-20kHz"
+    def _fetch_tech_specs(self) -> str:
+        """从商品知识库获取当前商品的参数片段，没有可用知识时返回空字符串"""
+        item = current_item.get()
+        if self.knowledge_store is None or item is None:
+            return ""
+        return self.knowledge_store.get(*item)
 
 
 class ClassifyAgent(BaseAgent):
     """意图识别Agent"""
 
+    agent_name = 'classify'
+
     def generate(self, **args) -> str:
         response = super().generate(**args)
         return response
@@ -282,7 +1357,108 @@ class ClassifyAgent(BaseAgent):
 class DefaultAgent(BaseAgent):
     """默认处理Agent"""
 
-    def _call_llm(self, messages: List[Dict], *args) -> str:
+    def _call_llm(self, messages: List[Dict], *args, **kwargs) -> str:
         """限制默认回复长度"""
-        response = super()._call_llm(messages, temperature=0.7)
-        return response
\ No newline at end of file
+        kwargs.pop('temperature', None)
+        response = super()._call_llm(messages, temperature=0.7, **kwargs)
+        return response
+
+    def generate_speculative(self, user_msg: str, item_desc: str, context: str,
+                             cancel_event: threading.Event, usage: Dict, max_tokens: int = 200) -> str:
+        """
+        预先生成默认回复，意图确定不是default时可通过cancel_event中止
+
+        Raises:
+            ReplyTruncated: 回复达到max_tokens上限被截断，不能直接发送或缓存
+        """
+        messages = self._build_messages(user_msg, item_desc, context)
+        finish = {}
+        response = self._stream_llm(messages, cancel_event, temperature=0.7, max_tokens=max_tokens, usage=usage,
+                                    finish=finish)
+        if finish.get('finish_reason') == 'length':
+            raise ReplyTruncated(f"预生成回复达到 {max_tokens} token上限")
+        return self.safety_filter(response)
+
+
+class StructuredAgent(BaseAgent):
+    """结构化输出Agent：一次调用同时返回意图和回复"""
+
+    VALID_INTENTS = {'price', 'tech', 'default'}
+    agent_name = 'structured'
+
+    def __init__(self, client, system_prompt, safety_filter, metrics: Optional[AgentMetrics] = None,
+                 model_config: Optional[ModelConfig] = None):
+        super().__init__(client, system_prompt, safety_filter, metrics, model_config)
+        self._stats_lock = threading.Lock()
+        self.stats = {
+            'calls': 0,
+            'fallbacks': 0,
+        }
+
+    def generate_structured(self, user_msg: str, item_desc: str, context: str, bargain_count: int = 0,
+                            usage: Dict = None):
+        """
+        生成结构化回复
+
+        Returns:
+            tuple: (意图, 安全过滤后的回复)，调用失败或输出无法解析时返回None，由调用方回退到两步生成
+        """
+        with self._stats_lock:
+            self.stats['calls'] += 1
+        messages = self._build_messages(user_msg, item_desc, context)
+        messages[0]['content'] += f"\n▲当前议价轮次：{bargain_count}"
+        # 调用前无法得知意图，已进入议价阶段时沿用PriceAgent的动态温度策略
+        temperature = PriceAgent._calc_temperature(bargain_count) if bargain_count > 0 else 0.4
+
+        try:
+            with self._llm_call():
+                start = time.time()
+                response = self.client.chat.completions.create(
+                    messages=messages,
+                    temperature=temperature,
+                    top_p=0.8,
+                    response_format={"type": "json_object"},
+                    **self._request_options()
+                )
+            self._record_call(start, response.usage)
+            _accumulate_usage(usage, response.usage)
+            result = self.parse(response.choices[0].message.content)
+        except (DeadlineExceeded, GenerationCancelled):
+            raise
+        except Exception as e:
+            logger.warning(f"结构化生成调用失败: {e}")
+            result = None
+
+        if result is None:
+            with self._stats_lock:
+                self.stats['fallbacks'] += 1
+            return None
+        intent, reply = result
+        return intent, self.safety_filter(reply)
+
+    @classmethod
+    def parse(cls, text: str):
+        """
+        解析模型输出的JSON，兼容代码块包裹和前后多余文字
+
+        Returns:
+            tuple: (意图, 回复)，格式不正确时返回None
+        """
+        if not text:
+            return None
+        match = re.search(r'\{.*\}', text, re.S)
+        if not match:
+            logger.warning(f"结构化输出中未找到JSON: {text[:100]}")
+            return None
+        try:
+            data = json.loads(match.group(0))
+        except json.JSONDecodeError:
+            logger.warning(f"结构化输出JSON解析失败: {text[:100]}")
+            return None
+
+        intent = str(data.get('intent', '')).strip().lower()
+        reply = data.get('reply')
+        if intent not in cls.VALID_INTENTS or not isinstance(reply, str):
+            logger.warning(f"结构化输出字段不合法: {text[:100]}")
+            return None
+        return intent, reply.strip()
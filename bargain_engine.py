@@ -0,0 +1,249 @@
+import json
+import math
+import re
+import threading
+import unicodedata
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+
+_NUMBER = r'(?<![A-Za-z\d.])(\d+(?:\.\d+)?)'
+# 降价：能少20、便宜20块、再优惠20元
+_DISCOUNT_PATTERN = re.compile(r'(?:能|可以|再)?(?:少|便宜|优惠|减)' + _NUMBER + r'(?:块|元)?')
+# 折扣：打8折、9.5折
+_PERCENT_PATTERN = re.compile(r'(?<![A-Za-z\d.])(\d(?:\.\d)?)折')
+# 直接出价：带货币单位（100元、90块、¥80）或出价动词（100出吗、80包邮、90成交）
+_OFFER_PATTERN = re.compile(
+    r'¥' + _NUMBER
+    + r'|' + _NUMBER + r'(?:元|块)'
+    + r'|' + _NUMBER + r'(?:包邮|出|卖|能出|成交|拍)'
+)
+# 弱出价：80行吗、90可以吗，只有消息已被识别为价格意图时才视为出价
+_WEAK_OFFER_PATTERN = re.compile(_NUMBER + r'(?:行|可以|能)')
+# 数字后跟计量单位或前面有“第”时不是价格：第3行、1行代码、3天、2个、5点
+_UNIT_PATTERN = re.compile(
+    r'第\d|\d(?:个|天|分钟|点|次|号|年|月|小时|周|台|岁|人|页|楼|层|寸|件|行(?!吗|不|吧))'
+)
+# 询问底价：最低多少、最低价、底价多少
+_LOWEST_PATTERN = re.compile(r'最低(?:多少|价|能|几)|底价|最少多少')
+# 数字指的不是出价（运费、原价等），交给PriceAgent
+_NON_OFFER_PATTERN = re.compile(r'运费|邮费|定金|押金|原价|买的|入手|多少钱买')
+_NUMBERS = re.compile(r'\d+(?:\.\d+)?')
+
+
+@dataclass
+class Offer:
+    """从买家消息中解析出的出价"""
+    kind: str  # price：直接出价，discount：要求降价，percent：折扣，ask_lowest：询问底价
+    amount: Optional[float]  # 折算后的出价，ask_lowest时为None
+
+
+@dataclass
+class BargainRule:
+    """单个商品的议价规则"""
+    floor: float  # 底价
+    concessions: List[float]  # 第n轮议价时让到的比例（相对挂牌价到底价的差），超出长度时取最后一项
+    lowball_ratio: float = 0.5  # 出价低于挂牌价的该比例时直接拒绝
+
+
+@dataclass
+class BargainDecision:
+    """议价引擎的回复决策"""
+    action: str  # no_need / accept / counter / floor / reject
+    offer: Optional[float]
+    price: float  # 回复中给出的价格
+    reply: str
+
+
+def parse_offer(text: str, list_price: float, price_intent: bool = False) -> Optional[Offer]:
+    """
+    解析买家消息中的出价
+
+    只处理含义明确的消息：消息中恰好出现一个数字（询问底价时没有数字），
+    数字不是运费、原价、行号、数量等，且折算后的出价在(0, 挂牌价的2倍]范围内，其余情况返回None。
+    没有货币单位或出价动词的数字（如“80行吗”）只在消息已被识别为价格意图时视为出价。
+
+    Args:
+        text: 买家消息
+        list_price: 商品挂牌价
+        price_intent: 关键词规则是否已识别为价格意图
+
+    Returns:
+        Offer: 解析结果，无法明确解析时返回None
+    """
+    text = re.sub(r'[^\w\u4e00-\u9fa5.¥]', '', unicodedata.normalize('NFKC', text))
+    if _NON_OFFER_PATTERN.search(text) or _UNIT_PATTERN.search(text):
+        return None
+    numbers = _NUMBERS.findall(text)
+    if not numbers:
+        return Offer('ask_lowest', None) if _LOWEST_PATTERN.search(text) else None
+    if len(numbers) > 1:
+        return None
+
+    match = _DISCOUNT_PATTERN.search(text)
+    if match:
+        offer = Offer('discount', list_price - float(match.group(1)))
+    else:
+        match = _PERCENT_PATTERN.search(text)
+        if match:
+            offer = Offer('percent', list_price * float(match.group(1)) / 10)
+        else:
+            match = _OFFER_PATTERN.search(text) or (_WEAK_OFFER_PATTERN.search(text) if price_intent else None)
+            if not match:
+                return None
+            offer = Offer('price', float(next(group for group in match.groups() if group)))
+    if not 0 < offer.amount <= list_price * 2:
+        return None
+    return offer
+
+
+def format_price(price: float) -> str:
+    """整数价格不带小数，其余保留两位小数"""
+    return str(int(price)) if price == int(price) else f"{price:.2f}"
+
+
+class BargainEngine:
+    """
+    基于规则的议价引擎
+
+    在PriceAgent之前处理含义明确的出价（如“100元出吗”、“能少20吗”、“最低多少”）：
+    按商品底价和让价梯度决定接受、还价或拒绝，并用固定模板立即回复；
+    无法明确解析的议价消息交给PriceAgent。相同输入总是得到相同回复。
+    """
+
+    def __init__(self, config: Dict):
+        """
+        Args:
+            config: 议价规则配置，包含default（默认规则：floor_ratio、concessions、lowball_ratio）、
+                items（商品ID -> 规则，可指定floor或floor_ratio，enabled为false时该商品不使用引擎）
+                和replies（决策 -> 回复模板列表，模板中的{price}替换为价格）
+        """
+        self.path = None  # 由load设置，用于判断热更新的规则文件是否就是当前使用的文件
+        self._config = config
+        self._lock = threading.Lock()
+        self.stats = {
+            'messages': 0,  # 议价消息数（关键词识别为价格意图或解析出出价）
+            'handled': 0,
+            'deferred': 0,  # 交给PriceAgent
+        }
+        self.action_stats: Dict[str, int] = {}
+
+    @classmethod
+    def load(cls, path: str) -> 'BargainEngine':
+        """从JSON文件加载议价规则"""
+        with open(path, "r", encoding="utf-8") as f:
+            config = json.load(f)
+        logger.info(f"已加载议价规则: {path}，单独配置的商品数: {len(config.get('items', {}))}")
+        engine = cls(config)
+        engine.path = path
+        return engine
+
+    def update(self, config: Dict):
+        """整体替换议价规则，进行中的决策继续使用旧规则"""
+        self._config = config
+        logger.info(f"议价规则已更新，单独配置的商品数: {len(config.get('items', {}))}")
+
+    @property
+    def default(self) -> Dict:
+        return self._config.get('default', {})
+
+    @property
+    def items(self) -> Dict:
+        return self._config.get('items', {})
+
+    @property
+    def replies(self) -> Dict:
+        return self._config.get('replies', {})
+
+    def rule_for(self, item_id: str, list_price: float) -> Optional[BargainRule]:
+        """
+        获取商品的议价规则
+
+        Returns:
+            BargainRule: 议价规则，商品禁用引擎时返回None
+        """
+        rules = self._config
+        config = {**rules.get('default', {}), **rules.get('items', {}).get(item_id, {})}
+        if not config.get('enabled', True):
+            return None
+        floor = config.get('floor')
+        if floor is None:
+            floor = list_price * config.get('floor_ratio', 1.0)
+        return BargainRule(
+            floor=min(float(floor), list_price),
+            concessions=config.get('concessions') or [1.0],
+            lowball_ratio=config.get('lowball_ratio', 0.5),
+        )
+
+    @staticmethod
+    def counter_price(rule: BargainRule, list_price: float, bargain_count: int) -> float:
+        """第bargain_count轮议价时的还价（向上取整，不低于底价）"""
+        step = rule.concessions[min(bargain_count, len(rule.concessions) - 1)]
+        price = math.ceil(list_price - step * (list_price - rule.floor))
+        return max(price, rule.floor)
+
+    def decide(self, user_msg: str, item_id: str, item_info: Dict, bargain_count: int = 0,
+               price_intent: bool = False) -> Optional[BargainDecision]:
+        """
+        对买家消息做出议价决策
+
+        Args:
+            user_msg: 买家消息
+            item_id: 商品ID
+            item_info: 商品信息（items表中保存的itemDO，soldPrice为挂牌价）
+            bargain_count: 之前的议价轮次
+            price_intent: 关键词规则是否已识别为价格意图，用于统计议价消息数，
+                并允许解析没有货币单位的出价
+
+        Returns:
+            BargainDecision: 回复决策，消息含义不明确或商品未启用时返回None（交给PriceAgent）
+        """
+        try:
+            list_price = float(item_info.get('soldPrice') or 0)
+        except (TypeError, ValueError):
+            list_price = 0
+        offer = parse_offer(user_msg, list_price, price_intent) if list_price > 0 else None
+        if offer is None and not price_intent:
+            return None
+
+        rule = self.rule_for(item_id, list_price) if offer is not None else None
+        decision = self._decide(offer, rule, list_price, bargain_count) if rule is not None else None
+        with self._lock:
+            self.stats['messages'] += 1
+            if decision is None:
+                self.stats['deferred'] += 1
+            else:
+                self.stats['handled'] += 1
+                self.action_stats[decision.action] = self.action_stats.get(decision.action, 0) + 1
+        return decision
+
+    def _decide(self, offer: Offer, rule: BargainRule, list_price: float, bargain_count: int) -> Optional[BargainDecision]:
+        counter = self.counter_price(rule, list_price, bargain_count)
+        if offer.amount is None:
+            action, price = 'floor' if counter <= rule.floor else 'counter', counter
+        elif offer.amount >= list_price:
+            action, price = 'no_need', list_price
+        elif offer.amount >= counter:
+            action, price = 'accept', offer.amount
+        elif offer.amount < list_price * rule.lowball_ratio:
+            action, price = 'reject', counter
+        else:
+            action, price = 'floor' if counter <= rule.floor else 'counter', counter
+
+        templates = self.replies.get(action)
+        if not templates:
+            return None
+        # 按议价轮次轮换模板，保证结果确定
+        reply = templates[bargain_count % len(templates)].format(price=format_price(price))
+        return BargainDecision(action, offer.amount, price, reply)
+
+    def get_stats(self) -> Dict:
+        """获取议价引擎统计信息"""
+        with self._lock:
+            return {
+                **self.stats,
+                'actions': dict(self.action_stats),
+                'handled_rate': self.stats['handled'] / self.stats['messages'] if self.stats['messages'] else 0.0,
+            }
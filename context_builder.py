@@ -0,0 +1,244 @@
+import os
+import re
+import threading
+from contextlib import nullcontext
+from typing import Dict, List, Tuple
+
+from loguru import logger
+
+
+_CJK_PATTERN = re.compile(r'[\u4e00-\u9fa5\u3000-\u303f\uff00-\uffef]')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    本地估算token数（无需分词器）
+
+    中文字符及全角标点按每字1个token计，其余字符按每4个字符1个token计。
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def split_turns(messages: List[Dict]) -> List[List[Dict]]:
+    """按轮次切分对话：每个用户消息开始新的一轮，随后的助手消息归入同一轮"""
+    turns = []
+    for msg in messages:
+        if msg['role'] == 'user' or not turns:
+            turns.append([msg])
+        else:
+            turns[-1].append(msg)
+    return turns
+
+
+def format_messages(messages: List[Dict]) -> str:
+    """与XianyuReplyBot.format_history相同的对话格式"""
+    return "\n".join([f"{msg['role']}: {msg['content']}" for msg in messages])
+
+
+class ContextBuilder:
+    """
+    按token预算组装对话上下文
+
+    最近keep_turns轮对话原样保留，更早的对话由会话摘要替代；
+    摘要尚未覆盖的较早消息在预算允许时原样保留，超出预算时从最早的开始丢弃。
+    """
+
+    SUMMARY_HEADER = "【早期对话摘要】"
+
+    def __init__(self, token_budget: int = 1200, keep_turns: int = 6):
+        """
+        Args:
+            token_budget: 对话历史部分的token预算（本地估算）
+            keep_turns: 优先原样保留的最近对话轮数
+        """
+        self.token_budget = token_budget
+        self.keep_turns = keep_turns
+
+    def build(self, context: List[Dict]) -> Tuple[str, int, int]:
+        """
+        组装对话历史文本
+
+        Args:
+            context: get_context_by_chat返回的上下文（可能包含摘要系统消息）
+
+        Returns:
+            tuple: (对话历史文本, 原始完整历史的token估算, 组装后的token估算)
+        """
+        summary, summary_upto = None, 0
+        for msg in context:
+            if msg['role'] == 'system' and 'last_message_id' in msg:
+                summary = msg['content'].split(': ', 1)[-1]
+                summary_upto = msg['last_message_id']
+
+        dialog = [msg for msg in context if msg['role'] in ('user', 'assistant')]
+        before = estimate_tokens(format_messages(dialog))
+
+        turns = split_turns(dialog)
+        recent = turns[-self.keep_turns:] if self.keep_turns > 0 else []
+        # 摘要已覆盖的较早消息不再原样发送
+        older = [
+            turn for turn in turns[:len(turns) - len(recent)]
+            if not summary or any(msg.get('id', 0) > summary_upto for msg in turn)
+        ]
+
+        parts = []
+        budget = self.token_budget
+        if summary:
+            summary_text = self.SUMMARY_HEADER + summary
+            # 摘要最多占预算的一半，避免挤掉最近的对话
+            summary_text = self._truncate(summary_text, self.token_budget // 2)
+            parts.append(summary_text)
+            budget -= estimate_tokens(summary_text)
+
+        # 从最近的轮次开始向前填充，超出预算时停止
+        kept: List[List[Dict]] = []
+        for turn in reversed(older + recent):
+            cost = estimate_tokens(format_messages(turn)) + 1
+            if cost > budget:
+                if not kept:
+                    # 至少保留最后一轮（截断到预算内）
+                    kept.append([{**msg, 'content': self._truncate(msg['content'], max(budget, 0) // len(turn))}
+                                 for msg in turn])
+                break
+            kept.append(turn)
+            budget -= cost
+
+        for turn in reversed(kept):
+            parts.append(format_messages(turn))
+        text = "\n".join(parts)
+        return text, before, estimate_tokens(text)
+
+    @staticmethod
+    def _truncate(text: str, max_tokens: int) -> str:
+        """截断文本到指定token数以内（保留开头）"""
+        if estimate_tokens(text) <= max_tokens:
+            return text
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if estimate_tokens(text[:mid]) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low]
+
+
+class ConversationSummarizer:
+    """
+    会话滚动摘要
+
+    回复生成后登记会话，由后台任务批量刷新摘要：把摘要尚未覆盖、且不在最近keep_turns轮内的
+    消息与已有摘要合并生成新摘要，写入chat_summaries表。不在回复路径上调用大模型。
+    """
+
+    def __init__(self, client, context_manager, keep_turns: int = 6, min_new_messages: int = 6,
+                 max_summary_tokens: int = 300, prompt_path: str = "prompts/summary_prompt.txt", scheduler=None,
+                 prompt_registry=None):
+        """
+        Args:
+            client: OpenAI兼容客户端
+            context_manager: ChatContextManager实例
+            keep_turns: 不参与摘要的最近对话轮数（与ContextBuilder保持一致）
+            min_new_messages: 触发刷新所需的最少未摘要消息数
+            max_summary_tokens: 摘要生成的最大token数
+            prompt_path: 摘要提示词文件
+            scheduler: 可选的大模型调用调度器（LLMScheduler），摘要调用以最低优先级排队
+            prompt_registry: 可选的提示词注册表（PromptRegistry），提供时使用其中的summary提示词并随文件热更新，
+                不再读取prompt_path
+        """
+        self.client = client
+        self.context_manager = context_manager
+        self.keep_turns = keep_turns
+        self.min_new_messages = min_new_messages
+        self.max_summary_tokens = max_summary_tokens
+        self.scheduler = scheduler
+        self.prompt_registry = prompt_registry
+        self._prompt = None
+        if prompt_registry is None:
+            with open(prompt_path, "r", encoding="utf-8") as f:
+                self._prompt = f.read()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self.stats = {
+            'refreshed': 0,
+            'skipped': 0,
+            'failed': 0,
+        }
+
+    @property
+    def prompt(self) -> str:
+        """当前的摘要提示词"""
+        if self.prompt_registry is not None:
+            return self.prompt_registry.text('summary')
+        return self._prompt
+
+    def schedule(self, chat_id: str):
+        """登记需要检查摘要的会话（在回复路径上调用，仅做内存操作）"""
+        with self._lock:
+            self._pending.add(chat_id)
+
+    def refresh_pending(self) -> int:
+        """
+        刷新所有已登记会话的摘要（在后台线程中调用）
+
+        Returns:
+            int: 实际刷新的会话数
+        """
+        with self._lock:
+            pending, self._pending = self._pending, set()
+        refreshed = 0
+        for chat_id in pending:
+            try:
+                if self.refresh(chat_id):
+                    refreshed += 1
+            except Exception as e:
+                self.stats['failed'] += 1
+                logger.error(f"刷新会话摘要失败 {chat_id}: {e}")
+        return refreshed
+
+    def refresh(self, chat_id: str) -> bool:
+        """
+        刷新单个会话的摘要
+
+        Returns:
+            bool: 是否生成了新摘要
+        """
+        # 后台读取不影响回复路径的缓存统计和淘汰顺序
+        context = self.context_manager.peek_context_by_chat(chat_id)
+        summary, summary_upto = None, 0
+        for msg in context:
+            if msg['role'] == 'system' and 'last_message_id' in msg:
+                summary = msg['content'].split(': ', 1)[-1]
+                summary_upto = msg['last_message_id']
+
+        dialog = [msg for msg in context if msg['role'] in ('user', 'assistant')]
+        turns = split_turns(dialog)
+        older = turns[:-self.keep_turns] if self.keep_turns > 0 else turns
+        new_messages = [msg for turn in older for msg in turn if msg.get('id', 0) > summary_upto]
+        if len(new_messages) < self.min_new_messages:
+            self.stats['skipped'] += 1
+            return False
+
+        user_content = f"【已有摘要】\n{summary or '无'}\n\n【新增对话】\n{format_messages(new_messages)}"
+        with self.scheduler.slot('background') if self.scheduler is not None else nullcontext():
+            response = self.client.chat.completions.create(
+                model=os.getenv("SUMMARY_MODEL_NAME", os.getenv("MODEL_NAME", "qwen-max")),
+                messages=[
+                    {"role": "system", "content": self.prompt},
+                    {"role": "user", "content": user_content}
+                ],
+                temperature=0.2,
+                max_tokens=self.max_summary_tokens,
+            )
+        new_summary = (response.choices[0].message.content or "").strip()
+        if not new_summary:
+            self.stats['failed'] += 1
+            return False
+
+        self.context_manager.save_summary(chat_id, new_summary, new_messages[-1]['id'])
+        self.stats['refreshed'] += 1
+        logger.debug(f"会话 {chat_id} 摘要已更新，覆盖到消息 {new_messages[-1]['id']}")
+        return True
@@ -1,29 +1,147 @@
 import sqlite3
 import os
+import re
+import sys
 import json
+import time
+import threading
+import zlib
+from collections import OrderedDict, deque
 from datetime import datetime
 from loguru import logger
 
 
+# 全文检索分词：连续的中文字符切成二元组，英文和数字按整词处理
+_FTS_RUN_PATTERN = re.compile(r'[\u4e00-\u9fff]+|[A-Za-z0-9_]+')
+_CJK_PATTERN = re.compile(r'[\u4e00-\u9fff]')
+
+
+def _ngram_runs(text):
+    """将文本切分为词段，每个词段是一组连续的检索词"""
+    runs = []
+    for run in _FTS_RUN_PATTERN.findall(text):
+        if _CJK_PATTERN.match(run):
+            if len(run) == 1:
+                runs.append([run])
+            else:
+                runs.append([run[i:i + 2] for i in range(len(run) - 1)])
+        else:
+            runs.append([run.lower()])
+    return runs
+
+
+def _fts_document(text):
+    """生成写入全文索引的二元组文本"""
+    return " ".join(token for run in _ngram_runs(text) for token in run)
+
+
+def _fts_query(text):
+    """将检索文本转换为FTS5查询：每个词段作为一个短语，多个词段之间为AND关系"""
+    phrases = []
+    for run in _ngram_runs(text):
+        if len(run) == 1 and len(run[0]) == 1 and _CJK_PATTERN.match(run[0]):
+            # 单个汉字只能作为二元组前缀匹配
+            phrases.append(f'"{run[0]}"*')
+        else:
+            phrases.append('"' + " ".join(run) + '"')
+    return " ".join(phrases)
+
+
+class _ChatBuffer:
+    """单个会话的内存环形缓冲区，保存最近max_history条消息"""
+    
+    # 每条消息除内容字符串外的额外开销估计（元组、字典槽位等）
+    MESSAGE_OVERHEAD = 96
+    
+    def __init__(self, max_history, rows, bargain_count):
+        self.messages = deque(maxlen=max_history)
+        self.bytes = 0
+        self.last_id = 0
+        self.bargain_count = bargain_count
+        self.summary = None
+        self.summary_upto = 0
+        self.last_access = time.time()
+        for row in rows:
+            self.append(*row)
+    
+    def append(self, msg_id, role, content):
+        """追加一条消息，返回内存占用的变化量；已存在的消息（id不大于last_id）会被忽略"""
+        if msg_id <= self.last_id:
+            return 0
+        delta = self._size(content)
+        if len(self.messages) == self.messages.maxlen:
+            delta -= self._size(self.messages[0][2])
+        self.messages.append((msg_id, role, content))
+        self.last_id = msg_id
+        self.bytes += delta
+        return delta
+    
+    @classmethod
+    def _size(cls, content):
+        return sys.getsizeof(content) + cls.MESSAGE_OVERHEAD
+
+
 class ChatContextManager:
     """
     聊天上下文管理器
     
     负责存储和检索用户与商品之间的对话历史，使用SQLite数据库进行持久化存储。
     支持按会话ID检索对话历史，以及议价次数统计。
-    """
     
-    def __init__(self, max_history=100, db_path="data/chat_history.db"):
+    最近活跃会话的历史保存在内存环形缓冲区中（写穿透到SQLite），
+    读取时命中缓存则无需访问磁盘；缓存按LRU和空闲时间在内存预算内淘汰。
+    """
+
+    # 加载期间会话持续有写入时，最多重新加载的次数
+    LOAD_ATTEMPTS = 3
+
+    # 沿(chat_id, id)索引倒序读取会话最近的消息，无需临时排序
+    RECENT_MESSAGES_SQL = "SELECT id, role, content FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT ?"
+    LATEST_ITEM_SQL = "SELECT item_id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT 1"
+
+    def __init__(self, max_history=100, db_path="data/chat_history.db", trim_interval=20,
+                 cache_max_bytes=8 * 1024 * 1024, cache_idle_timeout=1800, enable_auto_vacuum=False):
         """
         初始化聊天上下文管理器
         
         Args:
             max_history: 每个对话保留的最大消息数
             db_path: SQLite数据库文件路径
+            trim_interval: 每个会话每插入多少条消息清理一次旧消息
+            cache_max_bytes: 会话缓存的内存预算（字节）
+            cache_idle_timeout: 会话缓存空闲多少秒后被淘汰
+            enable_auto_vacuum: 已有数据库尚未启用增量VACUUM时，是否在启动时执行一次完整VACUUM来启用
+                （耗时与数据库大小成正比，期间阻塞其他读写）；新建的数据库总是直接启用
         """
         self.max_history = max_history
         self.db_path = db_path
+        self.trim_interval = max(1, trim_interval)
+        self._inserts_since_trim = {}  # 记录各会话自上次清理以来插入的消息数
+        
+        # 会话缓存（chat_id -> _ChatBuffer），按最近访问顺序排列
+        self.cache_max_bytes = cache_max_bytes
+        self.cache_idle_timeout = cache_idle_timeout
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_lock = threading.RLock()
+        self._cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        # 正在锁外从数据库加载的会话（chat_id -> 各次加载的状态），加载期间有写入的结果不放入缓存
+        self._loads = {}
+        
+        self.fts_enabled = False  # 由_init_db根据SQLite是否支持FTS5设置
         self._init_db()
+        if enable_auto_vacuum:
+            self.enable_incremental_vacuum()
+        
+        # 已知买家集合，启动时从buyers表加载，收到买家第一条消息时即加入（不等回复提交）
+        self._known_buyers = self._load_known_buyers()
+        self._buyers_lock = threading.Lock()
+        
+        # 已归档会话ID集合，读取历史时据此决定是否需要查询归档表
+        self._archived_chats = self._load_archived_chats()
+        
+        # 商品信息变化回调（如使回复缓存中该商品的条目失效）
+        self._item_listeners = []
         
     def _init_db(self):
         """初始化数据库表结构"""
@@ -35,6 +153,10 @@ class ChatContextManager:
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
+        # 启用增量VACUUM，使后台任务可以逐步归还归档后释放的页面；
+        # 只对尚未建表的新数据库直接生效，已有数据库需要完整VACUUM，见enable_incremental_vacuum
+        cursor.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        
         # 创建消息表
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS messages (
@@ -60,8 +182,14 @@ class ChatContextManager:
         CREATE INDEX IF NOT EXISTS idx_user_item ON messages (user_id, item_id)
         ''')
         
+        # (chat_id, id)索引：按会话读取最近N条消息时只需读取索引尾部，无需排序
         cursor.execute('''
-        CREATE INDEX IF NOT EXISTS idx_chat_id ON messages (chat_id)
+        CREATE INDEX IF NOT EXISTS idx_chat_id_id ON messages (chat_id, id)
+        ''')
+        
+        # 旧的单列chat_id索引是上面索引的前缀，已无用处
+        cursor.execute('''
+        DROP INDEX IF EXISTS idx_chat_id
         ''')
         
         cursor.execute('''
@@ -88,15 +216,189 @@ class ChatContextManager:
         )
         ''')
         
+        # 创建买家表，记录每个买家的首次/最近发消息时间和消息数
+        # 与messages不同，这里的记录不会被历史清理删除
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS buyers (
+            user_id TEXT PRIMARY KEY,
+            first_seen DATETIME,
+            last_seen DATETIME,
+            message_count INTEGER DEFAULT 0
+        )
+        ''')
+        
+        # 首次创建时从已有的用户消息中回填
+        cursor.execute("SELECT 1 FROM buyers LIMIT 1")
+        if cursor.fetchone() is None:
+            cursor.execute('''
+            INSERT INTO buyers (user_id, first_seen, last_seen, message_count)
+            SELECT user_id, MIN(timestamp), MAX(timestamp), COUNT(*)
+            FROM messages WHERE role = 'user'
+            GROUP BY user_id
+            ''')
+            if cursor.rowcount > 0:
+                logger.info(f"已从历史消息回填 {cursor.rowcount} 个买家")
+        
+        # 创建冷会话归档表，每个会话的历史消息压缩为一个数据块
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_chats (
+            chat_id TEXT PRIMARY KEY,
+            item_id TEXT,
+            message_count INTEGER NOT NULL,
+            first_timestamp DATETIME,
+            last_timestamp DATETIME,
+            archived_at DATETIME,
+            codec TEXT NOT NULL,
+            data BLOB NOT NULL
+        )
+        ''')
+        
+        # 创建会话摘要表，last_message_id之前（含）的消息已被摘要覆盖
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            chat_id TEXT PRIMARY KEY,
+            summary TEXT NOT NULL,
+            last_message_id INTEGER NOT NULL,
+            updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        ''')
+        
+        self._init_fts(cursor)
+        
         conn.commit()
+        
+        cursor.execute("PRAGMA auto_vacuum")
+        if cursor.fetchone()[0] != 2:
+            logger.info("数据库未启用增量VACUUM，归档释放的空间不会归还给文件系统（设置DB_ENABLE_AUTO_VACUUM=true后重启可启用）")
+        
         conn.close()
         logger.info(f"聊天历史数据库初始化完成: {self.db_path}")
+
+    def enable_incremental_vacuum(self):
+        """
+        为已有数据库启用增量VACUUM：需要执行一次完整VACUUM重写整个数据库文件，
+        耗时与数据库大小成正比，期间阻塞其他读写，已启用时直接返回
+        
+        Returns:
+            bool: 本次是否执行了VACUUM
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] == 2:
+                return False
+            size = os.path.getsize(self.db_path)
+            logger.info(f"开始为数据库启用增量VACUUM（完整VACUUM），数据库大小: {size / 1024 / 1024:.1f}MB")
+            start = time.time()
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+            logger.info(f"已为数据库启用增量VACUUM，耗时: {time.time() - start:.1f}s")
+            return True
+        except Exception as e:
+            logger.error(f"启用增量VACUUM时出错: {e}")
+            return False
+        finally:
+            conn.close()
+
+    def _init_fts(self, cursor):
+        """
+        初始化聊天记录全文索引
         
+        messages_fts的rowid与messages.id一致，保存二元组切分后的文本以支持中文检索。
+        新消息由写入路径同步索引，删除（历史清理、归档）由触发器同步。
+        """
+        try:
+            cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(grams, tokenize = 'unicode61')
+            ''')
+            cursor.execute('''
+            CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+            BEGIN
+                DELETE FROM messages_fts WHERE rowid = old.id;
+            END
+            ''')
+        except sqlite3.OperationalError as e:
+            logger.warning(f"当前SQLite不支持FTS5，聊天记录全文检索不可用: {e}")
+            return
+        
+        self.fts_enabled = True
+        
+        # 首次创建时为已有消息建立索引
+        cursor.execute("SELECT 1 FROM messages_fts LIMIT 1")
+        if cursor.fetchone() is None:
+            cursor.execute("SELECT id, content FROM messages")
+            rows = [(msg_id, _fts_document(content)) for msg_id, content in cursor.fetchall()]
+            cursor.executemany("INSERT INTO messages_fts (rowid, grams) VALUES (?, ?)", rows)
+            if rows:
+                logger.info(f"已为 {len(rows)} 条历史消息建立全文索引")
 
+    def _load_known_buyers(self):
+        """从buyers表加载所有已知买家ID"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return {row[0] for row in conn.execute("SELECT user_id FROM buyers")}
+        finally:
+            conn.close()
+
+    def _load_archived_chats(self):
+        """从archived_chats表加载所有已归档会话ID"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return {row[0] for row in conn.execute("SELECT chat_id FROM archived_chats")}
+        finally:
+            conn.close()
+
+    def is_known_buyer(self, user_id):
+        """
+        判断买家是否曾经发过消息（纯内存查询，不访问数据库）
+        
+        Args:
+            user_id: 用户ID
             
+        Returns:
+            bool: 已知买家返回True
+        """
+        return user_id in self._known_buyers
+
+    def mark_buyer_seen(self, user_id):
+        """
+        收到买家消息时立即登记为已知买家
+        
+        消息本身要等回复生成后与回复一起提交，期间同一买家的后续消息不应再被当作新买家。
+        buyers表中先写入消息数为0的记录，消息提交时再累加。
+        
+        Args:
+            user_id: 用户ID
+            
+        Returns:
+            bool: 该买家此前未知（本次为首次登记）时返回True
+        """
+        with self._buyers_lock:
+            if user_id in self._known_buyers:
+                return False
+            self._known_buyers.add(user_id)
+        conn = sqlite3.connect(self.db_path)
+        try:
+            now = datetime.now().isoformat()
+            conn.execute(
+                "INSERT OR IGNORE INTO buyers (user_id, first_seen, last_seen, message_count) VALUES (?, ?, ?, 0)",
+                (user_id, now, now)
+            )
+            conn.commit()
+        except Exception as e:
+            logger.error(f"登记买家时出错: {e}")
+        finally:
+            conn.close()
+        return True
+        
+
+            
+    def subscribe_item_updates(self, callback):
+        """注册商品信息变化回调，参数为商品ID；仅在已保存的商品信息内容发生变化时调用"""
+        self._item_listeners.append(callback)
+
     def save_item_info(self, item_id, item_data):
         """
-        保存商品信息到数据库
+        保存商品信息到数据库，已有的商品信息内容变化时通知订阅者
         
         Args:
             item_id: 商品ID
@@ -104,6 +406,7 @@ class ChatContextManager:
         """
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
+        changed = False
         
         try:
             # 从商品数据中提取有用信息
@@ -113,6 +416,10 @@ class ChatContextManager:
             # 将整个商品数据转换为JSON字符串
             data_json = json.dumps(item_data, ensure_ascii=False)
             
+            cursor.execute("SELECT data FROM items WHERE item_id = ?", (item_id,))
+            row = cursor.fetchone()
+            changed = row is not None and row[0] != data_json
+            
             cursor.execute(
                 """
                 INSERT INTO items (item_id, data, price, description, last_updated) 
@@ -131,8 +438,16 @@ class ChatContextManager:
         except Exception as e:
             logger.error(f"保存商品信息时出错: {e}")
             conn.rollback()
+            return
         finally:
             conn.close()
+        
+        if changed:
+            for callback in self._item_listeners:
+                try:
+                    callback(item_id)
+                except Exception as e:
+                    logger.error(f"处理商品信息变化时出错: {e}")
     
     def get_item_info(self, item_id):
         """
@@ -163,6 +478,26 @@ class ChatContextManager:
         finally:
             conn.close()
 
+    def get_item_id_by_chat(self, chat_id):
+        """
+        获取会话最近一条消息对应的商品ID
+        
+        Args:
+            chat_id: 会话ID
+            
+        Returns:
+            str: 商品ID，会话没有消息时返回None
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            row = conn.execute(self.LATEST_ITEM_SQL, (chat_id,)).fetchone()
+            return row[0] if row else None
+        except Exception as e:
+            logger.error(f"获取会话商品ID时出错: {e}")
+            return None
+        finally:
+            conn.close()
+
     def add_message_by_chat(self, chat_id, user_id, item_id, role, content):
         """
         基于会话ID添加新消息到对话历史
@@ -179,33 +514,173 @@ class ChatContextManager:
         
         try:
             # 插入新消息，使用chat_id作为额外标识
+            msg_id = self._insert_message(cursor, chat_id, user_id, item_id, role, content)
+            
+            # 检查是否需要清理旧消息（基于chat_id）
+            self._trim_history(cursor, chat_id)
+            
+            conn.commit()
+            self._cache_write(chat_id, [(msg_id, role, content)])
+            if role == "user":
+                self._known_buyers.add(user_id)
+        except Exception as e:
+            logger.error(f"添加消息到数据库时出错: {e}")
+            conn.rollback()
+        finally:
+            conn.close()
+
+    def commit_turn(self, chat_id, user_id, item_id, user_msg, seller_id=None, reply=None, is_bargain=False):
+        """
+        在单个事务中记录一轮完整对话
+        
+        一轮对话包括用户消息、（可选的）助手回复以及议价次数的更新，
+        要么全部写入，要么全部回滚，避免出现只写了一半的对话轮次。
+        
+        Args:
+            chat_id: 会话ID
+            user_id: 用户ID
+            item_id: 商品ID
+            user_msg: 用户消息内容，一轮合并回复多条消息时传入列表，按顺序逐条记录
+            seller_id: 卖家ID，记录助手回复时使用
+            reply: 助手回复内容，为None时只记录用户消息
+            is_bargain: 本轮是否为议价，为True时议价次数加一
+            
+        Returns:
+            int: 本轮提交后的议价次数，提交失败时返回None
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            written = []
+            for content in (user_msg if isinstance(user_msg, (list, tuple)) else [user_msg]):
+                msg_id = self._insert_message(cursor, chat_id, user_id, item_id, "user", content)
+                written.append((msg_id, "user", content))
+            
+            if is_bargain:
+                now = datetime.now().isoformat()
+                cursor.execute(
+                    """
+                    INSERT INTO chat_bargain_counts (chat_id, count, last_updated)
+                    VALUES (?, 1, ?)
+                    ON CONFLICT(chat_id) 
+                    DO UPDATE SET count = count + 1, last_updated = ?
+                    """,
+                    (chat_id, now, now)
+                )
+            
+            if reply is not None:
+                msg_id = self._insert_message(cursor, chat_id, seller_id, item_id, "assistant", reply)
+                written.append((msg_id, "assistant", reply))
+            
+            self._trim_history(cursor, chat_id, inserted=len(written))
+            
             cursor.execute(
-                "INSERT INTO messages (user_id, item_id, role, content, timestamp, chat_id) VALUES (?, ?, ?, ?, ?, ?)",
-                (user_id, item_id, role, content, datetime.now().isoformat(), chat_id)
+                "SELECT count FROM chat_bargain_counts WHERE chat_id = ?",
+                (chat_id,)
             )
+            result = cursor.fetchone()
+            bargain_count = result[0] if result else 0
             
-            # 检查是否需要清理旧消息（基于chat_id）
+            conn.commit()
+            self._cache_write(chat_id, written, bargain_count)
+            self._known_buyers.add(user_id)
+            return bargain_count
+        except Exception as e:
+            logger.error(f"提交对话轮次时出错: {e}")
+            conn.rollback()
+            return None
+        finally:
+            conn.close()
+
+    def _insert_message(self, cursor, chat_id, user_id, item_id, role, content):
+        """在当前事务中插入一条消息，用户消息同时更新买家表，返回消息ID"""
+        now = datetime.now().isoformat()
+        cursor.execute(
+            "INSERT INTO messages (user_id, item_id, role, content, timestamp, chat_id) VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, item_id, role, content, now, chat_id)
+        )
+        msg_id = cursor.lastrowid
+        
+        if self.fts_enabled:
+            cursor.execute(
+                "INSERT INTO messages_fts (rowid, grams) VALUES (?, ?)",
+                (msg_id, _fts_document(content))
+            )
+        
+        if role == "user":
             cursor.execute(
                 """
+                INSERT INTO buyers (user_id, first_seen, last_seen, message_count)
+                VALUES (?, ?, ?, 1)
+                ON CONFLICT(user_id) 
+                DO UPDATE SET last_seen = ?, message_count = message_count + 1
+                """,
+                (user_id, now, now, now)
+            )
+        return msg_id
+
+    def _trim_history(self, cursor, chat_id, inserted=1):
+        """
+        在当前事务中清理超出max_history的旧消息
+        
+        清理是摊销进行的：每个会话每插入trim_interval条消息才真正执行一次删除。
+        读取时只取最近max_history条，两次清理之间多保留的消息不影响上下文。
+        """
+        pending = self._inserts_since_trim.get(chat_id, 0) + inserted
+        if pending < self.trim_interval:
+            self._inserts_since_trim[chat_id] = pending
+            return
+        
+        self._inserts_since_trim.pop(chat_id, None)
+        self._delete_old_messages(cursor, chat_id)
+
+    def _delete_old_messages(self, cursor, chat_id):
+        """删除会话中最近max_history条之前的所有消息"""
+        cursor.execute(
+            """
+            DELETE FROM messages 
+            WHERE chat_id = ? AND id <= (
                 SELECT id FROM messages 
                 WHERE chat_id = ? 
-                ORDER BY timestamp DESC 
-                LIMIT ?, 1
-                """, 
-                (chat_id, self.max_history)
+                ORDER BY id DESC 
+                LIMIT 1 OFFSET ?
             )
+            """,
+            (chat_id, chat_id, self.max_history)
+        )
+
+    def trim_all_history(self):
+        """
+        清理所有会话中超出max_history的旧消息，供后台任务定期调用
+        
+        Returns:
+            int: 删除的消息数
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute(
+                "SELECT chat_id FROM messages WHERE chat_id IS NOT NULL GROUP BY chat_id HAVING COUNT(*) > ?",
+                (self.max_history,)
+            )
+            chat_ids = [row[0] for row in cursor.fetchall()]
             
-            oldest_to_keep = cursor.fetchone()
-            if oldest_to_keep:
-                cursor.execute(
-                    "DELETE FROM messages WHERE chat_id = ? AND id < ?",
-                    (chat_id, oldest_to_keep[0])
-                )
+            deleted = 0
+            for chat_id in chat_ids:
+                self._delete_old_messages(cursor, chat_id)
+                deleted += cursor.rowcount
+                self._inserts_since_trim.pop(chat_id, None)
             
             conn.commit()
+            if deleted:
+                logger.info(f"已清理 {len(chat_ids)} 个会话的 {deleted} 条旧消息")
+            return deleted
         except Exception as e:
-            logger.error(f"添加消息到数据库时出错: {e}")
+            logger.error(f"清理历史消息时出错: {e}")
             conn.rollback()
+            return 0
         finally:
             conn.close()
 
@@ -213,43 +688,504 @@ class ChatContextManager:
         """
         基于会话ID获取对话历史
         
+        优先从内存缓存读取；未命中时从数据库加载并放入缓存。
+        
         Args:
             chat_id: 会话ID
             
         Returns:
             list: 包含对话历史的列表
         """
+        with self._cache_lock:
+            buffer = self._cache.get(chat_id)
+            if buffer is not None:
+                self._cache_stats['hits'] += 1
+                self._cache.move_to_end(chat_id)
+                buffer.last_access = time.time()
+                return self._buffer_messages(buffer)
+            self._cache_stats['misses'] += 1
+        
+        # 未命中时在锁外读取数据库，不阻塞其他会话的缓存读取和写穿透
+        for _ in range(self.LOAD_ATTEMPTS):
+            state = self._begin_load(chat_id)
+            buffer = self._load_buffer(chat_id)
+            with self._cache_lock:
+                self._end_load(chat_id, state)
+                if buffer is None:
+                    return []
+                cached = self._cache.get(chat_id)
+                if cached is not None:
+                    # 其他线程已先加载，缓存中的缓冲区由写穿透保持最新
+                    self._cache.move_to_end(chat_id)
+                    cached.last_access = time.time()
+                    return self._buffer_messages(cached)
+                if not state['stale']:
+                    self._cache[chat_id] = buffer
+                    self._cache_bytes += buffer.bytes
+                    messages = self._buffer_messages(buffer)
+                    self._evict()
+                    return messages
+            # 加载期间该会话有写入，读取结果可能缺少新消息，重新加载
+        
+        # 会话持续有写入，本次结果不放入缓存
+        return self._buffer_messages(buffer)
+
+    def _begin_load(self, chat_id):
+        """登记一次锁外加载，返回加载状态，写穿透期间会将其标记为过期"""
+        state = {'stale': False}
+        with self._cache_lock:
+            self._loads.setdefault(chat_id, []).append(state)
+        return state
+
+    def _end_load(self, chat_id, state):
+        """注销一次锁外加载（调用方需持有锁，并在同一次持锁期间决定是否放入缓存）"""
+        states = self._loads[chat_id]
+        states.remove(state)
+        if not states:
+            del self._loads[chat_id]
+
+    def _mark_loads_stale(self, chat_id):
+        """会话有写入时，将正在进行的锁外加载标记为过期（调用方需持有锁）"""
+        for state in self._loads.get(chat_id, ()):
+            state['stale'] = True
+
+    def peek_context_by_chat(self, chat_id):
+        """
+        基于会话ID获取对话历史，供后台任务（如摘要刷新）使用
+        
+        与get_context_by_chat返回相同的内容，但不计入缓存命中统计、不调整LRU顺序，
+        未缓存的会话直接从数据库读取，不放入缓存。
+        
+        Args:
+            chat_id: 会话ID
+            
+        Returns:
+            list: 包含对话历史的列表
+        """
+        with self._cache_lock:
+            buffer = self._cache.get(chat_id)
+            if buffer is not None:
+                return self._buffer_messages(buffer)
+        # 未缓存的会话在锁外读取数据库
+        buffer = self._load_buffer(chat_id)
+        return self._buffer_messages(buffer) if buffer is not None else []
+
+    @staticmethod
+    def _buffer_messages(buffer):
+        """将缓冲区转换为对话历史列表，末尾附加会话摘要和议价次数"""
+        messages = [{"id": msg_id, "role": role, "content": content} for msg_id, role, content in buffer.messages]
+        
+        # 添加会话摘要到上下文中，last_message_id之前的消息已被摘要覆盖
+        if buffer.summary:
+            messages.append({
+                "role": "system",
+                "content": f"对话摘要: {buffer.summary}",
+                "last_message_id": buffer.summary_upto
+            })
+        
+        # 添加议价次数到上下文中
+        if buffer.bargain_count > 0:
+            messages.append({
+                "role": "system", 
+                "content": f"议价次数: {buffer.bargain_count}"
+            })
+        return messages
+
+    def _load_buffer(self, chat_id):
+        """从数据库加载会话最近的消息和议价次数，出错时返回None"""
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
         try:
+            # 沿(chat_id, id)索引倒序读取最近max_history条，再在内存中恢复时间顺序
+            cursor.execute(self.RECENT_MESSAGES_SQL, (chat_id, self.max_history))
+            
+            rows = cursor.fetchall()
+            rows.reverse()
+            
+            # 热数据不足时用归档中的最近消息补齐
+            if len(rows) < self.max_history and chat_id in self._archived_chats:
+                archived = self._read_archive(cursor, chat_id)
+                missing = self.max_history - len(rows)
+                rows = [(row[0], row[3], row[4]) for row in archived[-missing:]] + rows
+            
+            cursor.execute(
+                "SELECT count FROM chat_bargain_counts WHERE chat_id = ?",
+                (chat_id,)
+            )
+            result = cursor.fetchone()
+            bargain_count = result[0] if result else 0
+            
+            buffer = _ChatBuffer(self.max_history, rows, bargain_count)
             cursor.execute(
+                "SELECT summary, last_message_id FROM chat_summaries WHERE chat_id = ?",
+                (chat_id,)
+            )
+            result = cursor.fetchone()
+            if result:
+                buffer.summary, buffer.summary_upto = result
+            return buffer
+        except Exception as e:
+            logger.error(f"获取对话历史时出错: {e}")
+            return None
+        finally:
+            conn.close()
+
+    def _cache_write(self, chat_id, rows, bargain_count=None):
+        """
+        写穿透：数据库提交成功后同步更新已缓存的会话
+        
+        未缓存的会话不做处理，下次读取时再从数据库加载。
+        """
+        with self._cache_lock:
+            self._mark_loads_stale(chat_id)
+            buffer = self._cache.get(chat_id)
+            if buffer is None:
+                return
+            for msg_id, role, content in rows:
+                self._cache_bytes += buffer.append(msg_id, role, content)
+            if bargain_count is not None:
+                buffer.bargain_count = bargain_count
+            self._evict()
+
+    def _evict(self):
+        """按空闲时间和内存预算淘汰最久未访问的会话缓存（调用方需持有锁）"""
+        now = time.time()
+        while self._cache:
+            chat_id, buffer = next(iter(self._cache.items()))
+            idle = now - buffer.last_access > self.cache_idle_timeout
+            if not idle and self._cache_bytes <= self.cache_max_bytes:
+                break
+            self._cache.popitem(last=False)
+            self._cache_bytes -= buffer.bytes
+            self._cache_stats['evictions'] += 1
+
+    def save_summary(self, chat_id, summary, last_message_id):
+        """
+        保存会话摘要并同步更新缓存
+        
+        Args:
+            chat_id: 会话ID
+            summary: 摘要文本
+            last_message_id: 摘要覆盖到的最后一条消息ID
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute(
                 """
-                SELECT role, content FROM messages 
-                WHERE chat_id = ? 
-                ORDER BY timestamp ASC
-                LIMIT ?
-                """, 
-                (chat_id, self.max_history)
+                INSERT INTO chat_summaries (chat_id, summary, last_message_id, updated_at)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT(chat_id) DO UPDATE SET
+                    summary = excluded.summary,
+                    last_message_id = excluded.last_message_id,
+                    updated_at = excluded.updated_at
+                """,
+                (chat_id, summary, last_message_id, datetime.now().isoformat())
             )
+            conn.commit()
+        except Exception as e:
+            logger.error(f"保存会话摘要时出错: {e}")
+            return
+        finally:
+            conn.close()
+        
+        with self._cache_lock:
+            self._mark_loads_stale(chat_id)
+            buffer = self._cache.get(chat_id)
+            if buffer is not None:
+                buffer.summary = summary
+                buffer.summary_upto = last_message_id
+
+    def invalidate_chat_cache(self, chat_id):
+        """从缓存中移除指定会话"""
+        with self._cache_lock:
+            self._mark_loads_stale(chat_id)
+            buffer = self._cache.pop(chat_id, None)
+            if buffer is not None:
+                self._cache_bytes -= buffer.bytes
+
+    def get_cache_stats(self):
+        """
+        获取会话缓存统计信息
+        
+        Returns:
+            dict: 命中/未命中次数、命中率、淘汰次数、缓存会话数和内存占用
+        """
+        with self._cache_lock:
+            lookups = self._cache_stats['hits'] + self._cache_stats['misses']
+            return {
+                **self._cache_stats,
+                'hit_ratio': self._cache_stats['hits'] / lookups if lookups else 0.0,
+                'resident_chats': len(self._cache),
+                'resident_bytes': self._cache_bytes,
+            }
+
+    def search_messages(self, query, item_id=None, since=None, until=None, role=None, limit=20):
+        """
+        全文检索聊天记录（不含已归档会话）
+        
+        Args:
+            query: 检索文本
+            item_id: 只检索指定商品的消息
+            since: 起始时间（ISO格式字符串）
+            until: 截止时间（ISO格式字符串）
+            role: 只检索指定角色（user/assistant）的消息
+            limit: 最多返回的结果数
             
-            messages = [{"role": role, "content": content} for role, content in cursor.fetchall()]
+        Returns:
+            list: 按相关度排序的结果，每项包含消息字段、snippet和score（越小越相关）
+        """
+        if not self.fts_enabled:
+            return []
+        fts_query = _fts_query(query)
+        if not fts_query:
+            return []
+        
+        sql = """
+            SELECT m.id, m.chat_id, m.item_id, m.user_id, m.role, m.content, m.timestamp, bm25(messages_fts) AS score
+            FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid
+            WHERE messages_fts MATCH ?
+        """
+        params = [fts_query]
+        if item_id is not None:
+            sql += " AND m.item_id = ?"
+            params.append(item_id)
+        if since is not None:
+            sql += " AND m.timestamp >= ?"
+            params.append(since)
+        if until is not None:
+            sql += " AND m.timestamp <= ?"
+            params.append(until)
+        if role is not None:
+            sql += " AND m.role = ?"
+            params.append(role)
+        sql += " ORDER BY score LIMIT ?"
+        params.append(limit)
+        
+        conn = sqlite3.connect(self.db_path)
+        
+        try:
+            columns = ("id", "chat_id", "item_id", "user_id", "role", "content", "timestamp", "score")
+            results = [dict(zip(columns, row)) for row in conn.execute(sql, params)]
+            for result in results:
+                result["snippet"] = self._make_snippet(result["content"], query)
+            return results
+        except Exception as e:
+            logger.error(f"全文检索时出错: {e}")
+            return []
+        finally:
+            conn.close()
+
+    def find_previous_answers(self, query, item_id=None, limit=5):
+        """
+        查找过去对相似问题的回答：检索买家消息，并取同一会话中紧随其后的卖家回复
+        
+        Args:
+            query: 买家问题
+            item_id: 只检索指定商品
+            limit: 最多返回的问答数
             
-            # 获取议价次数并添加到上下文中
-            bargain_count = self.get_bargain_count_by_chat(chat_id)
-            if bargain_count > 0:
-                messages.append({
-                    "role": "system", 
-                    "content": f"议价次数: {bargain_count}"
+        Returns:
+            list: 每项包含question、answer、chat_id、item_id、timestamp和score
+        """
+        questions = self.search_messages(query, item_id=item_id, role="user", limit=limit * 3)
+        if not questions:
+            return []
+        
+        conn = sqlite3.connect(self.db_path)
+        
+        try:
+            answers = []
+            for question in questions:
+                row = conn.execute(
+                    """
+                    SELECT content, timestamp FROM messages 
+                    WHERE chat_id = ? AND id > ? AND role = 'assistant'
+                    ORDER BY id LIMIT 1
+                    """,
+                    (question["chat_id"], question["id"])
+                ).fetchone()
+                if not row:
+                    continue
+                answers.append({
+                    "question": question["content"],
+                    "answer": row[0],
+                    "chat_id": question["chat_id"],
+                    "item_id": question["item_id"],
+                    "timestamp": row[1],
+                    "score": question["score"],
                 })
+                if len(answers) >= limit:
+                    break
+            return answers
+        except Exception as e:
+            logger.error(f"查找历史回答时出错: {e}")
+            return []
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _make_snippet(content, query, width=30):
+        """截取内容中第一个命中位置附近的片段，并用【】标出命中的词段"""
+        for run in _FTS_RUN_PATTERN.findall(query):
+            match = re.search(re.escape(run), content, re.IGNORECASE)
+            if match:
+                start = max(0, match.start() - width)
+                end = min(len(content), match.end() + width)
+                return (
+                    ("..." if start > 0 else "")
+                    + content[start:match.start()] + "【" + match.group(0) + "】" + content[match.end():end]
+                    + ("..." if end < len(content) else "")
+                )
+        return content[:width * 2]
+
+    def archive_idle_chats(self, max_idle_days=30):
+        """
+        将空闲超过指定天数的会话从messages表移入压缩归档表
+        
+        每个会话的消息序列化为JSON后用zlib压缩为一个数据块；
+        已归档的会话再次归档时会与原有数据块合并。
+        
+        Args:
+            max_idle_days: 最近一条消息早于多少天前的会话会被归档
             
+        Returns:
+            int: 归档的会话数
+        """
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            cursor.execute(
+                # timestamp为CURRENT_TIMESTAMP写入的UTC时间，截止时间同样在SQLite中按UTC计算
+                "SELECT chat_id FROM messages WHERE chat_id IS NOT NULL GROUP BY chat_id "
+                "HAVING MAX(timestamp) < datetime('now', ?)",
+                (f"-{max_idle_days} days",)
+            )
+            chat_ids = [row[0] for row in cursor.fetchall()]
         except Exception as e:
-            logger.error(f"获取对话历史时出错: {e}")
-            messages = []
+            logger.error(f"查询空闲会话时出错: {e}")
+            conn.close()
+            return 0
+        
+        archived = 0
+        for chat_id in chat_ids:
+            try:
+                cursor.execute(
+                    "SELECT id, user_id, item_id, role, content, timestamp FROM messages WHERE chat_id = ? ORDER BY id",
+                    (chat_id,)
+                )
+                rows = [list(row) for row in cursor.fetchall()]
+                if not rows:
+                    continue
+                
+                # 与已有归档合并
+                rows = self._read_archive(cursor, chat_id) + rows
+                data = zlib.compress(json.dumps(rows, ensure_ascii=False).encode('utf-8'), 9)
+                
+                cursor.execute(
+                    """
+                    INSERT OR REPLACE INTO archived_chats 
+                    (chat_id, item_id, message_count, first_timestamp, last_timestamp, archived_at, codec, data)
+                    VALUES (?, ?, ?, ?, ?, ?, 'zlib', ?)
+                    """,
+                    (chat_id, rows[-1][2], len(rows), rows[0][5], rows[-1][5], datetime.now().isoformat(), data)
+                )
+                # 只删除已归档的消息，归档期间新到达的消息保留在热表中
+                cursor.execute(
+                    "DELETE FROM messages WHERE chat_id = ? AND id <= ?",
+                    (chat_id, rows[-1][0])
+                )
+                conn.commit()
+                
+                self._archived_chats.add(chat_id)
+                self._inserts_since_trim.pop(chat_id, None)
+                self.invalidate_chat_cache(chat_id)
+                archived += 1
+            except Exception as e:
+                logger.error(f"归档会话 {chat_id} 时出错: {e}")
+                conn.rollback()
+        
+        conn.close()
+        if archived:
+            logger.info(f"已归档 {archived} 个空闲超过 {max_idle_days} 天的会话")
+        return archived
+
+    def _read_archive(self, cursor, chat_id):
+        """读取并解压会话的归档消息，返回[id, user_id, item_id, role, content, timestamp]列表"""
+        cursor.execute(
+            "SELECT codec, data FROM archived_chats WHERE chat_id = ?",
+            (chat_id,)
+        )
+        result = cursor.fetchone()
+        if not result:
+            return []
+        codec, data = result
+        if codec != 'zlib':
+            raise ValueError(f"不支持的归档编码: {codec}")
+        return json.loads(zlib.decompress(data).decode('utf-8'))
+
+    def load_archived_chat(self, chat_id):
+        """
+        按需加载已归档会话的完整历史
+        
+        Args:
+            chat_id: 会话ID
+            
+        Returns:
+            list: 按时间顺序排列的消息字典列表，未归档时返回空列表
+        """
+        if chat_id not in self._archived_chats:
+            return []
+        
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        
+        try:
+            return [
+                {"id": msg_id, "user_id": user_id, "item_id": item_id,
+                 "role": role, "content": content, "timestamp": timestamp}
+                for msg_id, user_id, item_id, role, content, timestamp in self._read_archive(cursor, chat_id)
+            ]
+        except Exception as e:
+            logger.error(f"加载归档会话时出错: {e}")
+            return []
+        finally:
+            conn.close()
+
+    def run_maintenance(self, vacuum_pages=1000):
+        """
+        执行数据库维护：增量VACUUM归还空闲页面，并更新查询优化器统计信息
+        
+        Args:
+            vacuum_pages: 本次最多归还的空闲页面数
+        """
+        conn = sqlite3.connect(self.db_path)
+        
+        try:
+            freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            # incremental_vacuum每执行一步只归还一页，用executescript才会执行完整
+            conn.executescript(f"PRAGMA incremental_vacuum({int(vacuum_pages)}); ANALYZE;")
+            logger.debug(f"数据库维护完成，空闲页面: {freelist}")
+        except Exception as e:
+            logger.error(f"数据库维护时出错: {e}")
         finally:
             conn.close()
+
+    def run_retention(self, max_idle_days=30):
+        """
+        后台保留策略任务：清理超长历史、归档冷会话并维护数据库
         
-        return messages
+        Args:
+            max_idle_days: 会话空闲多少天后归档
+            
+        Returns:
+            dict: 清理的消息数和归档的会话数
+        """
+        trimmed = self.trim_all_history()
+        archived = self.archive_idle_chats(max_idle_days)
+        self.run_maintenance()
+        return {'trimmed': trimmed, 'archived': archived}
 
     def increment_bargain_count_by_chat(self, chat_id):
         """
@@ -272,8 +1208,14 @@ class ChatContextManager:
                 """,
                 (chat_id, datetime.now().isoformat(), datetime.now().isoformat())
             )
+            cursor.execute(
+                "SELECT count FROM chat_bargain_counts WHERE chat_id = ?",
+                (chat_id,)
+            )
+            bargain_count = cursor.fetchone()[0]
             
             conn.commit()
+            self._cache_write(chat_id, [], bargain_count)
             logger.debug(f"会话 {chat_id} 议价次数已增加")
         except Exception as e:
             logger.error(f"增加议价次数时出错: {e}")
@@ -291,6 +1233,11 @@ class ChatContextManager:
         Returns:
             int: 议价次数
         """
+        with self._cache_lock:
+            buffer = self._cache.get(chat_id)
+            if buffer is not None:
+                return buffer.bargain_count
+        
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
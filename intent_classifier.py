@@ -0,0 +1,235 @@
+"""
+本地意图分类器
+
+使用字符n-gram哈希特征和多项式朴素贝叶斯（NumPy实现），单次预测耗时在1毫秒以内，
+用于在关键词规则未命中时替代大模型意图分类；置信度低于阈值时仍回退到大模型。
+
+命令行用法：
+    # 用大模型为历史买家消息打标签（离线执行一次）
+    python intent_classifier.py label --db data/chat_history.db --out data/intent_labels.jsonl
+    # 训练并输出留出会话上的准确率/延迟报告
+    python intent_classifier.py train --labels data/intent_labels.jsonl --out models/intent_nb.npz
+    # 评估已保存的模型
+    python intent_classifier.py eval --labels data/intent_labels.jsonl --model models/intent_nb.npz
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+
+INTENT_LABELS = ('price', 'tech', 'default')
+
+
+def char_ngram_indices(text: str, dim: int, max_n: int = 3) -> List[int]:
+    """将文本切分为1~max_n字符n-gram，并用crc32哈希到[0, dim)"""
+    text = re.sub(r'[^\w\u4e00-\u9fa5]', '', text).lower()
+    indices = []
+    for n in range(1, max_n + 1):
+        for i in range(len(text) - n + 1):
+            indices.append(zlib.crc32(text[i:i + n].encode('utf-8')) % dim)
+    return indices
+
+
+class NaiveBayesIntentClassifier:
+    """基于字符n-gram哈希特征的多项式朴素贝叶斯意图分类器"""
+
+    def __init__(self, labels: Tuple[str, ...] = INTENT_LABELS, dim: int = 2 ** 14, max_n: int = 3):
+        self.labels = tuple(labels)
+        self.dim = dim
+        self.max_n = max_n
+        self.class_log_prior = np.zeros(len(self.labels), dtype=np.float64)
+        self.feature_log_prob = np.zeros((len(self.labels), dim), dtype=np.float32)
+
+    def fit(self, texts: List[str], labels: List[str], alpha: float = 1.0):
+        """训练模型"""
+        counts = np.zeros((len(self.labels), self.dim), dtype=np.float64)
+        class_counts = np.zeros(len(self.labels), dtype=np.float64)
+        for text, label in zip(texts, labels):
+            row = self.labels.index(label)
+            class_counts[row] += 1
+            np.add.at(counts[row], char_ngram_indices(text, self.dim, self.max_n), 1.0)
+
+        self.class_log_prior = np.log((class_counts + 1.0) / (class_counts.sum() + len(self.labels)))
+        smoothed = counts + alpha
+        self.feature_log_prob = (np.log(smoothed) - np.log(smoothed.sum(axis=1, keepdims=True))).astype(np.float32)
+        return self
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """
+        预测意图
+
+        Returns:
+            tuple: (意图标签, 置信度)
+        """
+        indices = char_ngram_indices(text, self.dim, self.max_n)
+        scores = self.class_log_prior + self.feature_log_prob[:, indices].sum(axis=1)
+        probs = np.exp(scores - scores.max())
+        probs /= probs.sum()
+        best = int(np.argmax(probs))
+        return self.labels[best], float(probs[best])
+
+    def save(self, path: str):
+        """保存模型到npz文件"""
+        model_dir = os.path.dirname(path)
+        if model_dir and not os.path.exists(model_dir):
+            os.makedirs(model_dir)
+        np.savez_compressed(
+            path,
+            labels=np.array(self.labels),
+            dim=self.dim,
+            max_n=self.max_n,
+            class_log_prior=self.class_log_prior,
+            feature_log_prob=self.feature_log_prob,
+        )
+
+    @classmethod
+    def load(cls, path: str) -> 'NaiveBayesIntentClassifier':
+        """从npz文件加载模型"""
+        data = np.load(path)
+        model = cls(tuple(str(label) for label in data['labels']), int(data['dim']), int(data['max_n']))
+        model.class_log_prior = data['class_log_prior']
+        model.feature_log_prob = data['feature_log_prob']
+        return model
+
+
+def load_labelled(path: str) -> List[Dict]:
+    """读取标注文件（每行一个JSON：chat_id、text、label）"""
+    samples = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            sample = json.loads(line)
+            if sample.get('label') in INTENT_LABELS:
+                samples.append(sample)
+    return samples
+
+
+def split_by_chat(samples: List[Dict], holdout_ratio: float = 0.2) -> Tuple[List[Dict], List[Dict]]:
+    """按会话划分训练集和留出集，同一会话的消息不会同时出现在两边"""
+    train, holdout = [], []
+    for sample in samples:
+        bucket = zlib.crc32(str(sample.get('chat_id', '')).encode('utf-8')) % 100
+        (holdout if bucket < holdout_ratio * 100 else train).append(sample)
+    return train, holdout
+
+
+def evaluate(model: NaiveBayesIntentClassifier, samples: List[Dict], threshold: float) -> Dict:
+    """计算准确率、阈值以上的覆盖率/准确率和单次预测延迟"""
+    correct = confident = confident_correct = 0
+    latencies = []
+    for sample in samples:
+        start = time.perf_counter()
+        label, confidence = model.predict(sample['text'])
+        latencies.append((time.perf_counter() - start) * 1000)
+        correct += label == sample['label']
+        if confidence >= threshold:
+            confident += 1
+            confident_correct += label == sample['label']
+
+    total = len(samples) or 1
+    latencies = np.array(latencies) if latencies else np.zeros(1)
+    return {
+        'samples': len(samples),
+        'accuracy': correct / total,
+        'coverage': confident / total,
+        'confident_accuracy': confident_correct / confident if confident else 0.0,
+        'latency_p50_ms': float(np.percentile(latencies, 50)),
+        'latency_p99_ms': float(np.percentile(latencies, 99)),
+    }
+
+
+def print_report(title: str, report: Dict, threshold: float):
+    print(f"===== {title} =====")
+    print(f"样本数: {report['samples']}")
+    print(f"整体准确率: {report['accuracy']:.1%}")
+    print(f"置信度>={threshold} 覆盖率: {report['coverage']:.1%}，准确率: {report['confident_accuracy']:.1%}")
+    print(f"单次预测延迟 p50: {report['latency_p50_ms']:.3f}ms，p99: {report['latency_p99_ms']:.3f}ms")
+
+
+def label_history(db_path: str, out_path: str, use_llm: bool):
+    """
+    为历史买家消息生成标注：关键词规则能判断的直接使用规则结果，
+    其余消息在use_llm时调用ClassifyAgent标注，否则跳过
+    """
+    from XianyuAgent import XianyuReplyBot
+
+    bot = XianyuReplyBot()
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT chat_id, content FROM messages WHERE role = 'user' AND chat_id IS NOT NULL ORDER BY id"
+        ).fetchall()
+    finally:
+        conn.close()
+
+    seen = set()
+    written = 0
+    with open(out_path, 'w', encoding='utf-8') as f:
+        for chat_id, text in rows:
+            if (chat_id, text) in seen:
+                continue
+            seen.add((chat_id, text))
+            label = bot.router.match_rules(text)
+            if label is None and use_llm:
+                label = bot.agents['classify'].generate(user_msg=text, item_desc='', context='').strip().lower()
+            if label not in INTENT_LABELS:
+                continue
+            f.write(json.dumps({'chat_id': chat_id, 'text': text, 'label': label}, ensure_ascii=False) + '\n')
+            written += 1
+    logger.info(f"已写入 {written} 条标注到 {out_path}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="本地意图分类器训练工具")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    label_parser = subparsers.add_parser('label', help='为历史买家消息生成标注')
+    label_parser.add_argument('--db', default='data/chat_history.db')
+    label_parser.add_argument('--out', default='data/intent_labels.jsonl')
+    label_parser.add_argument('--no-llm', action='store_true', help='只使用关键词规则标注')
+
+    train_parser = subparsers.add_parser('train', help='训练模型并输出留出集报告')
+    train_parser.add_argument('--labels', default='data/intent_labels.jsonl')
+    train_parser.add_argument('--out', default='models/intent_nb.npz')
+    train_parser.add_argument('--holdout', type=float, default=0.2)
+    train_parser.add_argument('--threshold', type=float, default=0.8)
+
+    eval_parser = subparsers.add_parser('eval', help='在留出会话上评估已保存的模型')
+    eval_parser.add_argument('--labels', default='data/intent_labels.jsonl')
+    eval_parser.add_argument('--model', default='models/intent_nb.npz')
+    eval_parser.add_argument('--holdout', type=float, default=0.2)
+    eval_parser.add_argument('--threshold', type=float, default=0.8)
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'label':
+        from dotenv import load_dotenv
+        load_dotenv()
+        label_history(args.db, args.out, use_llm=not args.no_llm)
+    elif args.command == 'train':
+        samples = load_labelled(args.labels)
+        train, holdout = split_by_chat(samples, args.holdout)
+        model = NaiveBayesIntentClassifier().fit([s['text'] for s in train], [s['label'] for s in train])
+        print_report('留出会话评估', evaluate(model, holdout, args.threshold), args.threshold)
+        # 保存仅用训练集训练的模型，保证eval子命令的留出评估结果可信
+        model.save(args.out)
+        print(f"模型已保存: {args.out}")
+    elif args.command == 'eval':
+        _, holdout = split_by_chat(load_labelled(args.labels), args.holdout)
+        model = NaiveBayesIntentClassifier.load(args.model)
+        print_report('留出会话评估', evaluate(model, holdout, args.threshold), args.threshold)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from loguru import logger
+
+from context_builder import ContextBuilder, estimate_tokens
+
+
+class ItemKnowledgeStore:
+    """
+    商品知识库
+
+    从items表保存的完整itemDO中提取商品参数（标签属性、价格、库存、描述等），
+    与可选的本地参数文件（knowledge_dir/<商品ID>.txt，以#开头的行为注释）合并，
+    压缩成不超过token预算的知识片段，供TechAgent注入提示词。
+    片段按商品版本（itemDO内容和参数文件修改时间）缓存，商品信息变化后重新生成。
+    """
+
+    # itemDO中直接作为参数的标量字段
+    SCALAR_FIELDS = [
+        ('soldPrice', '售价'),
+        ('originalPrice', '原价'),
+        ('quantity', '库存'),
+        ('transportFee', '运费'),
+    ]
+
+    def __init__(self, knowledge_dir: str = "knowledge", token_budget: int = 300, max_entries: int = 1024):
+        """
+        Args:
+            knowledge_dir: 本地参数文件目录，不存在时只使用itemDO
+            token_budget: 知识片段的token预算（本地估算）
+            max_entries: 最多缓存的商品数
+        """
+        self.knowledge_dir = knowledge_dir
+        self.token_budget = token_budget
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # 商品ID -> (版本, 知识片段)
+        self._lock = threading.Lock()
+        self.stats = {
+            'lookups': 0,
+            'builds': 0,
+            'empty': 0,  # 没有可用知识的查询
+            'snippet_tokens': 0,  # 生成的知识片段token累计
+        }
+
+    def _spec_path(self, item_id: str) -> Optional[str]:
+        """本地参数文件路径，商品ID含路径字符时返回None"""
+        if not item_id or not re.fullmatch(r'[\w-]+', str(item_id)):
+            return None
+        return os.path.join(self.knowledge_dir, f"{item_id}.txt")
+
+    def version(self, item_id: str, item_info: Dict) -> str:
+        """商品知识版本号，itemDO或本地参数文件变化时随之变化"""
+        path = self._spec_path(item_id)
+        try:
+            spec_mtime = os.stat(path).st_mtime_ns if path else 0
+        except OSError:
+            spec_mtime = 0
+        data = json.dumps(item_info or {}, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha1(f"{data}\x1f{spec_mtime}".encode("utf-8")).hexdigest()[:12]
+
+    def get(self, item_id: str, item_info: Dict) -> str:
+        """
+        获取商品知识片段，未缓存或版本变化时重新生成
+
+        Returns:
+            str: 知识片段，没有可用知识时返回空字符串
+        """
+        version = self.version(item_id, item_info)
+        with self._lock:
+            self.stats['lookups'] += 1
+            entry = self._entries.get(item_id)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(item_id)
+                if not entry[1]:
+                    self.stats['empty'] += 1
+                return entry[1]
+        snippet = self._build(item_id, item_info or {})
+        with self._lock:
+            self.stats['builds'] += 1
+            self.stats['snippet_tokens'] += estimate_tokens(snippet)
+            if not snippet:
+                self.stats['empty'] += 1
+            self._entries[item_id] = (version, snippet)
+            self._entries.move_to_end(item_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return snippet
+
+    def _build(self, item_id: str, item_info: Dict) -> str:
+        """按本地参数文件、商品标签属性、价格库存、商品描述的顺序合并，压缩到token预算内"""
+        lines = self._read_spec_file(item_id) + self._extract_item_fields(item_info)
+        snippet = self._compact(lines)
+        logger.debug(f"商品 {item_id} 知识片段已生成，约 {estimate_tokens(snippet)} token")
+        return snippet
+
+    def _read_spec_file(self, item_id: str) -> List[str]:
+        path = self._spec_path(item_id)
+        if not path or not os.path.exists(path):
+            return []
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                return [line.strip() for line in f if line.strip() and not line.lstrip().startswith('#')]
+        except Exception as e:
+            logger.error(f"读取商品参数文件失败 {path}: {e}")
+            return []
+
+    def _extract_item_fields(self, item_info: Dict) -> List[str]:
+        """从itemDO中提取参数行"""
+        lines = []
+        # 商品标签属性，如 品牌：xx、成色：xx
+        for label in item_info.get('itemLabelExtList') or []:
+            if not isinstance(label, dict):
+                continue
+            name = label.get('propertyText') or label.get('properties')
+            value = label.get('text') or label.get('valueText')
+            if name and value and name != value:
+                lines.append(f"{name}：{value}")
+        for label in item_info.get('cpvLabels') or []:
+            if isinstance(label, dict) and label.get('propertyName') and label.get('valueName'):
+                lines.append(f"{label['propertyName']}：{label['valueName']}")
+        for field, name in self.SCALAR_FIELDS:
+            value = item_info.get(field)
+            if value not in (None, '', [], {}):
+                lines.append(f"{name}：{value}")
+        desc = item_info.get('desc')
+        if isinstance(desc, str) and desc.strip():
+            lines.extend(line for line in re.split(r'[\r\n]+', desc) if line.strip())
+        return lines
+
+    def _compact(self, lines: List[str]) -> str:
+        """合并空白、去除重复行，按顺序保留到token预算用完为止（最后一行截断到预算内）"""
+        kept, seen = [], set()
+        budget = self.token_budget
+        for line in lines:
+            line = re.sub(r'\s+', ' ', line).strip()
+            if not line or line in seen:
+                continue
+            seen.add(line)
+            cost = estimate_tokens(line) + 1
+            if cost > budget:
+                truncated = ContextBuilder._truncate(line, budget - 1)
+                if truncated:
+                    kept.append(truncated)
+                break
+            kept.append(line)
+            budget -= cost
+        return "\n".join(kept)
+
+    def get_stats(self) -> Dict:
+        """获取知识库统计信息"""
+        with self._lock:
+            return {
+                **self.stats,
+                'entries': len(self._entries),
+                'avg_snippet_tokens': self.stats['snippet_tokens'] / self.stats['builds'] if self.stats['builds'] else 0.0,
+            }
@@ -0,0 +1,373 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from types import SimpleNamespace
+from typing import Dict, List, Optional, Union
+
+from loguru import logger
+from openai import APIConnectionError, APIStatusError, OpenAI
+
+
+def is_backend_error(error: Exception) -> bool:
+    """
+    判断错误是否由后端自身引起（超时、连接错误、429限流、5xx），只有这类错误才故障转移并计入后端失败；
+    400（含内容审核不通过）、401、404等请求本身的问题换后端也不会成功，直接抛出
+    """
+    if isinstance(error, APIStatusError):
+        return error.status_code in (408, 429) or error.status_code >= 500
+    return isinstance(error, (APIConnectionError, TimeoutError, ConnectionError))
+
+
+class LLMBackend:
+    """单个OpenAI兼容后端及其延迟、错误统计"""
+
+    def __init__(self, name: str, base_url: str, api_key: str, model: Optional[Union[str, Dict[str, str]]] = None,
+                 timeout: float = 60.0, weight: float = 1.0, ewma_alpha: float = 0.2):
+        """
+        Args:
+            name: 后端名称（用于日志和统计）
+            base_url: 接口地址
+            api_key: API密钥
+            model: 可选的模型名，提供时覆盖请求中的model（如本地vLLM/llama.cpp的模型名）；
+                为字典时按请求的模型名映射，未列出的模型保持不变
+            timeout: 单次请求超时上限（秒），请求带有更短的剩余总超时时以后者为准
+            weight: 选择时的延迟权重，大于1表示除非明显更快否则不优先使用
+            ewma_alpha: 指数加权移动平均系数
+        """
+        self.name = name
+        self.model = model
+        self.weight = weight
+        self.timeout = timeout
+        self.client = OpenAI(api_key=api_key or "EMPTY", base_url=base_url, timeout=timeout, max_retries=0)
+        self._alpha = ewma_alpha
+        self._latencies = deque(maxlen=200)
+        self.ewma_ms: Optional[float] = None
+        # 流式请求的首字延迟单独统计，不参与EWMA和p95（流在建立连接时就返回，整体耗时不可比）
+        self._ttfts = deque(maxlen=200)
+        self.ttft_ewma_ms: Optional[float] = None
+        self.error_rate = 0.0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self.stats = {
+            'requests': 0,
+            'errors': 0,
+            'streams': 0,
+            'hedges': 0,
+            'hedge_wins': 0,
+        }
+
+    def record_success(self, latency_ms: Optional[float] = None):
+        """记录一次成功请求，latency_ms为None时（流式请求）不更新延迟统计"""
+        self.stats['requests'] += 1
+        if latency_ms is not None:
+            self._latencies.append(latency_ms)
+            self.ewma_ms = latency_ms if self.ewma_ms is None else self._alpha * latency_ms + (1 - self._alpha) * self.ewma_ms
+        self.error_rate = (1 - self._alpha) * self.error_rate
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.stats['requests'] += 1
+        self.stats['errors'] += 1
+        self.error_rate = self._alpha + (1 - self._alpha) * self.error_rate
+        self.consecutive_failures += 1
+
+    def record_ttft(self, ttft_ms: float):
+        """记录一次流式请求的首字延迟"""
+        self.stats['streams'] += 1
+        self._ttfts.append(ttft_ms)
+        self.ttft_ewma_ms = ttft_ms if self.ttft_ewma_ms is None else self._alpha * ttft_ms + (1 - self._alpha) * self.ttft_ewma_ms
+
+    @staticmethod
+    def _p95(samples) -> Optional[float]:
+        if len(samples) < 20:
+            return None
+        ordered = sorted(samples)
+        return ordered[int(len(ordered) * 0.95) - 1]
+
+    def p95_ms(self) -> Optional[float]:
+        """最近非流式请求的p95延迟，样本不足时返回None"""
+        return self._p95(self._latencies)
+
+    def ttft_p95_ms(self) -> Optional[float]:
+        """最近流式请求的p95首字延迟，样本不足时返回None"""
+        return self._p95(self._ttfts)
+
+    def score(self) -> float:
+        """选择评分，越小越优先：EWMA延迟按错误率和权重放大，尚无延迟数据的后端优先试用一次"""
+        if self.ewma_ms is None:
+            return float('inf') if self.stats['errors'] else 0.0
+        return self.ewma_ms * (1 + 4 * self.error_rate) * self.weight
+
+
+class _RoutedStream:
+    """
+    包装后端返回的流式响应
+
+    首个数据块到达时记录首字延迟，读完（或调用方提前关闭）时记为成功，
+    读取中途发生后端错误（见is_backend_error）时计为该后端的一次失败后继续抛出。
+    """
+
+    def __init__(self, router: 'LLMRouter', backend: LLMBackend, stream, start: float):
+        self._router = router
+        self._backend = backend
+        self._stream = stream
+        self._start = start
+        self._first_chunk = True
+        self._finished = False
+
+    def __iter__(self):
+        try:
+            for chunk in self._stream:
+                if self._first_chunk:
+                    self._first_chunk = False
+                    with self._router._lock:
+                        self._backend.record_ttft((time.time() - self._start) * 1000)
+                yield chunk
+        except Exception as e:
+            if is_backend_error(e):
+                self._finish(failed=True)
+            else:
+                # 请求本身的问题（如内容审核）不计入后端成功或失败
+                self._finished = True
+            raise
+        self._finish()
+
+    def _finish(self, failed: bool = False):
+        if self._finished:
+            return
+        self._finished = True
+        if failed:
+            self._router._record_failure(self._backend)
+        elif not self._first_chunk:
+            with self._router._lock:
+                self._backend.record_success()
+
+    def close(self):
+        # 调用方提前结束读取（取消生成）不算后端失败
+        self._finish()
+        close = getattr(self._stream, 'close', None)
+        if close:
+            close()
+
+
+class _Completions:
+    """模拟openai客户端的chat.completions接口"""
+
+    def __init__(self, router: 'LLMRouter'):
+        self._router = router
+
+    def create(self, **kwargs):
+        return self._router.create(**kwargs)
+
+
+class LLMRouter:
+    """
+    多后端大模型路由
+
+    对外提供与OpenAI客户端相同的chat.completions.create接口，可直接替换Agent使用的client。
+    按EWMA延迟和错误率选择后端，后端出错（超时、连接错误、429、5xx）时依次故障转移到其他后端，
+    请求本身的错误（400、401、404等）直接抛出，不计入后端失败；
+    开启对冲时，首选后端超过其p95延迟仍未返回则向次选后端再发一次请求，取先成功的结果。
+    流式请求只在建立连接失败时故障转移，不做对冲；其首字延迟单独统计，不影响后端选择的延迟数据。
+    """
+
+    def __init__(self, backends: List[LLMBackend], hedge_enabled: bool = False, hedge_default_delay: float = 3.0,
+                 hedge_min_delay: float = 0.5, max_failures: int = 3, cooldown: float = 30.0,
+                 probe_interval: int = 50):
+        """
+        Args:
+            backends: 后端列表，顺序即延迟数据不足时的优先顺序
+            hedge_enabled: 是否启用对冲请求
+            hedge_default_delay: 首选后端延迟样本不足时的对冲等待时间（秒）
+            hedge_min_delay: 对冲等待时间下限（秒）
+            max_failures: 连续失败多少次后暂停使用该后端
+            cooldown: 暂停时长（秒）
+            probe_interval: 每隔多少次请求把一个非首选后端排到首位，刷新其延迟数据（0为不探测）
+        """
+        if not backends:
+            raise ValueError("至少需要配置一个大模型后端")
+        self.backends = backends
+        self.hedge_enabled = hedge_enabled and len(backends) > 1
+        self.hedge_default_delay = hedge_default_delay
+        self.hedge_min_delay = hedge_min_delay
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.probe_interval = probe_interval
+        self._request_count = 0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge") if self.hedge_enabled else None
+        self.chat = SimpleNamespace(completions=_Completions(self))
+
+    @classmethod
+    def from_env(cls) -> 'LLMRouter':
+        """
+        从环境变量创建路由
+
+        LLM_BACKENDS为JSON数组，每项包含name、base_url、api_key或api_key_env、可选的model（字符串或模型名映射）、timeout、weight；
+        未配置时使用API_KEY和MODEL_BASE_URL作为唯一后端。
+        """
+        config = os.getenv("LLM_BACKENDS")
+        backends = []
+        if config:
+            for index, item in enumerate(json.loads(config)):
+                backends.append(LLMBackend(
+                    name=item.get('name', f"backend{index}"),
+                    base_url=item['base_url'],
+                    api_key=item.get('api_key') or os.getenv(item.get('api_key_env', 'API_KEY'), ''),
+                    model=item.get('model'),
+                    timeout=float(item.get('timeout', 60)),
+                    weight=float(item.get('weight', 1.0)),
+                ))
+        else:
+            backends.append(LLMBackend(
+                name="default",
+                base_url=os.getenv("MODEL_BASE_URL", "https://dashscope.aliyuncs.com/compatible-mode/v1"),
+                api_key=os.getenv("API_KEY"),
+            ))
+        router = cls(
+            backends,
+            hedge_enabled=os.getenv("LLM_HEDGE_ENABLED", "false").lower() == "true",
+            hedge_default_delay=float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "3.0")),
+        )
+        logger.info(f"大模型后端: {[backend.name for backend in backends]}, 对冲: {router.hedge_enabled}")
+        return router
+
+    def _ranked_backends(self) -> List[LLMBackend]:
+        """按评分排序的可用后端，全部处于暂停期时仍返回全部后端"""
+        now = time.time()
+        with self._lock:
+            self._request_count += 1
+            available = [backend for backend in self.backends if backend.cooldown_until <= now] or list(self.backends)
+            # 稳定排序：评分相同时保持配置顺序
+            ranked = sorted(available, key=lambda backend: backend.score())
+            if self.probe_interval and len(ranked) > 1 and self._request_count % self.probe_interval == 0:
+                # 定期探测：轮流把非首选后端排到首位，避免其延迟数据长期不更新
+                probe = 1 + (self._request_count // self.probe_interval) % (len(ranked) - 1)
+                ranked.insert(0, ranked.pop(probe))
+            return ranked
+
+    def _call(self, backend: LLMBackend, kwargs: Dict):
+        """向单个后端发送请求并记录统计"""
+        request = dict(kwargs)
+        if isinstance(backend.model, dict):
+            request['model'] = backend.model.get(request.get('model'), request.get('model'))
+        elif backend.model:
+            request['model'] = backend.model
+        if request.get('timeout'):
+            request['timeout'] = min(request['timeout'], backend.timeout)
+        start = time.time()
+        try:
+            response = backend.client.chat.completions.create(**request)
+        except Exception as e:
+            if is_backend_error(e):
+                self._record_failure(backend)
+            raise
+        if request.get('stream'):
+            return _RoutedStream(self, backend, response, start)
+        with self._lock:
+            backend.record_success((time.time() - start) * 1000)
+        return response
+
+    def _record_failure(self, backend: LLMBackend):
+        """记录后端失败，连续失败过多时暂停使用"""
+        with self._lock:
+            backend.record_failure()
+            if backend.consecutive_failures >= self.max_failures:
+                backend.cooldown_until = time.time() + self.cooldown
+                logger.warning(f"大模型后端 {backend.name} 连续失败 {backend.consecutive_failures} 次，暂停 {self.cooldown:.0f}s")
+
+    @staticmethod
+    def _remaining_kwargs(kwargs: Dict, give_up_at: Optional[float]) -> Optional[Dict]:
+        """按总超时计算本次尝试的请求参数，已超时返回None"""
+        if give_up_at is None:
+            return kwargs
+        remaining = give_up_at - time.time()
+        if remaining <= 0:
+            return None
+        return {**kwargs, 'timeout': remaining}
+
+    def create(self, **kwargs):
+        """
+        路由一次chat.completions请求
+
+        请求中的timeout视为包含故障转移在内的总超时，每次尝试的超时取后端超时和剩余总超时中较小的一个。
+        """
+        backends = self._ranked_backends()
+        give_up_at = time.time() + kwargs['timeout'] if kwargs.get('timeout') else None
+        if self.hedge_enabled and not kwargs.get('stream') and len(backends) > 1:
+            return self._create_hedged(backends, kwargs, give_up_at)
+
+        last_error = None
+        for backend in backends:
+            request = self._remaining_kwargs(kwargs, give_up_at)
+            if request is None:
+                break
+            try:
+                return self._call(backend, request)
+            except Exception as e:
+                if not is_backend_error(e):
+                    raise
+                last_error = e
+                logger.warning(f"大模型后端 {backend.name} 请求失败，尝试下一个后端: {e}")
+        raise last_error or TimeoutError("大模型请求超时")
+
+    def _create_hedged(self, backends: List[LLMBackend], kwargs: Dict, give_up_at: Optional[float] = None):
+        """对冲请求：首选后端超过p95延迟未返回时向次选后端再发一次，取先成功的结果"""
+        primary, rest = backends[0], backends[1:]
+        p95 = primary.p95_ms()
+        delay = max(self.hedge_min_delay, p95 / 1000 if p95 is not None else self.hedge_default_delay)
+
+        pending = {self._executor.submit(self._call, primary, kwargs): primary}
+        done, _ = wait(pending, timeout=delay)
+        hedge_request = self._remaining_kwargs(kwargs, give_up_at) if not done else None
+        if hedge_request is not None:
+            hedge_backend = rest.pop(0)
+            with self._lock:
+                hedge_backend.stats['hedges'] += 1
+            logger.debug(f"大模型后端 {primary.name} 超过 {delay:.2f}s 未返回，对冲请求 {hedge_backend.name}")
+            pending[self._executor.submit(self._call, hedge_backend, hedge_request)] = hedge_backend
+
+        last_error = None
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                backend = pending.pop(future)
+                try:
+                    response = future.result()
+                except Exception as e:
+                    if not is_backend_error(e):
+                        raise
+                    last_error = e
+                    logger.warning(f"大模型后端 {backend.name} 请求失败: {e}")
+                    continue
+                if backend is not primary:
+                    with self._lock:
+                        backend.stats['hedge_wins'] += 1
+                # 未完成的请求在后台结束，结果丢弃
+                return response
+            # 已发出的请求全部失败时，依次故障转移到剩余后端
+            request = self._remaining_kwargs(kwargs, give_up_at) if not pending and rest else None
+            if request is not None:
+                backend = rest.pop(0)
+                pending[self._executor.submit(self._call, backend, request)] = backend
+        raise last_error
+
+    def get_stats(self) -> Dict[str, Dict]:
+        """获取各后端统计信息"""
+        now = time.time()
+        with self._lock:
+            return {
+                backend.name: {
+                    **backend.stats,
+                    'ewma_ms': backend.ewma_ms or 0.0,
+                    'p95_ms': backend.p95_ms() or 0.0,
+                    'ttft_ewma_ms': backend.ttft_ewma_ms or 0.0,
+                    'ttft_p95_ms': backend.ttft_p95_ms() or 0.0,
+                    'error_rate': backend.error_rate,
+                    'cooling_down': backend.cooldown_until > now,
+                }
+                for backend in self.backends
+            }
@@ -26,6 +26,13 @@ engine = pyttsx3.init()
 from utils.xianyu_utils import generate_mid, generate_uuid, trans_cookies, generate_device_id, decrypt
 from XianyuAgent import XianyuReplyBot
 from context_manager import ChatContextManager
+from reply_index import ReplyIndex
+from reply_cache import ReplyCache
+from intent_classifier import NaiveBayesIntentClassifier
+from bargain_engine import BargainEngine
+from item_knowledge import ItemKnowledgeStore
+from utils.keyword_matcher import KeywordEngine
+from context_builder import ContextBuilder, ConversationSummarizer
 
 import smtplib
 from email.mime.text import MIMEText
@@ -209,69 +216,10 @@ def send_email_notification(subject, content, sender, recver, password):
 
 
 
-import sqlite3
-import os # 导入 os 模块，用于处理文件路径，虽然这里直接用字符串路径也可以
-msg_list_expanded = [
-    "你好", "您好", "老板", "在吗", "有人", "1", "哈喽", "Hi", "你好呀", "hi", "方便", "标价", "拍", "在", "看看", "了解", "请问", "这个", "请问", "直接", "咨询"
-]
-msg_list_2_expanded = ["报错","问题","解决","pip","vscode","pycharm","可以","作业","调试","代码","程序","运行","环境","安装","配置","异常","错误","bug","不了","不对","卡","python","库","模块","终端","命令行","依赖","怎么","如何","不会","为什么","看下","帮忙","求助","作业","写代码","实现","功能","远程","todesk","向日葵"]
-
-def check_user_exists_in_messages(db_path: str, user_id_to_check: str) -> bool:
-    """
-    检查给定用户ID是否存在于SQLite数据库的'messages'表中。
-
-    参数:
-        db_path (str): SQLite数据库文件的路径 (例如: 'data/chat_history.db')。
-                       这个路径是相对于运行脚本的当前工作目录。
-        user_id_to_check (str): 要在'user_id'列中搜索的用户ID字符串。
-
-    返回:
-        bool: 如果在'messages'表中找到该用户ID，则返回True；否则返回False。
-              如果在数据库连接或查询过程中发生错误，也返回False。
-    """
-    conn = None # 初始化数据库连接变量
-    try:
-        # 构建数据库文件的完整路径 (如果需要，这里使用了os.path.join)
-        # 但对于相对路径 'data/chat_history.db'，直接使用字符串也是可以的。
-        # 假设你的脚本和data文件夹在同一级，数据库文件在data文件夹内。
-        # full_db_path = os.path.join('.', db_path) # '.' 表示当前目录
-
-        # 连接到SQLite数据库
-        # 使用提供的相对路径连接
-        conn = sqlite3.connect(db_path)
-        cursor = conn.cursor() # 创建一个游标对象，用于执行SQL命令
-
-        # SQL查询语句：检查 messages 表中是否存在 user_id 等于给定值的记录
-        # SELECT 1 是一种高效的方式，因为它只关心是否有匹配的行存在，不关心具体数据。
-        # LIMIT 1 找到第一条匹配记录后就停止搜索，提高效率。
-        query = "SELECT 1 FROM messages WHERE user_id = ? LIMIT 1"
-
-        # 执行查询。将 user_id_to_check 作为参数传递 (必须是一个元组)，
-        # 这是防止SQL注入的标准做法。
-        cursor.execute(query, (user_id_to_check,))
-
-        # 获取查询结果的下一行。
-        # 如果找到了匹配的记录，fetchone() 会返回一行数据（这里是 (1,)）。
-        # 如果没有找到匹配的记录，fetchone() 会返回 None。
-        result = cursor.fetchone()
-
-        # 判断结果是否为 None。如果不是 None，说明找到了记录，返回 True。
-        # 如果是 None，说明没有找到记录，返回 False。
-        return result is not None
-
-    except sqlite3.Error as e:
-        # 捕获并处理数据库操作中可能发生的错误
-        # 例如：数据库文件不存在、表不存在、权限问题等
-        print(f"检查用户ID '{user_id_to_check}' 是否存在时发生数据库错误: {e}")
-        # 在错误发生时，我们无法确定用户是否存在，所以返回 False 是一个安全的做法。
-        return False
-    finally:
-        # 无论是否发生异常，都确保关闭数据库连接
-        if conn:
-            conn.close() # 关闭连接释放资源
-
-
 class XianyuLive:
+    # 消息队列工作协程数，也是同时生成回复的最大请求数
+    MESSAGE_WORKERS = 7
+
     def __init__(self, cookies_str):
         self.xianyu = XianyuApis()
         self.base_url = 'wss://wss-goofish.dingtalk.com/'
@@ -282,7 +230,12 @@ class XianyuLive:
         self.device_id = generate_device_id(self.myid)
         
         # 初始化上下文管理器
-        self.context_manager = ChatContextManager()
+        self.context_manager = ChatContextManager(
+            cache_max_bytes=int(os.getenv("CONTEXT_CACHE_MAX_BYTES", str(8 * 1024 * 1024))),  # 会话缓存内存预算，默认8MB
+            cache_idle_timeout=int(os.getenv("CONTEXT_CACHE_IDLE_TIMEOUT", "1800")),          # 会话缓存空闲淘汰时间，默认30分钟
+            # 已有数据库启用增量VACUUM需要一次完整VACUUM（大库可能耗时较长），默认不在启动时执行
+            enable_auto_vacuum=os.getenv("DB_ENABLE_AUTO_VACUUM", "false").lower() == "true"
+        )
 
         # 心跳相关配置
         self.heartbeat_interval = int(os.getenv("HEARTBEAT_INTERVAL", "15"))  # 心跳间隔，默认15秒
@@ -305,21 +258,133 @@ class XianyuLive:
         self.manual_mode_timeout = int(os.getenv("MANUAL_MODE_TIMEOUT", "3600"))  # 人工接管超时时间，默认1小时
         self.manual_mode_timestamps = {}  # 记录进入人工模式的时间
 
+        # 历史数据保留配置
+        self.archive_idle_days = int(os.getenv("ARCHIVE_IDLE_DAYS", "30"))          # 会话空闲多少天后归档，默认30天
+        self.retention_interval = int(os.getenv("RETENTION_INTERVAL", "3600"))     # 保留策略任务间隔，默认1小时
+        self.retention_task = None
+
+        # 提示词热更新：定期检查prompts目录的文件修改时间，变化的提示词按Agent替换（为0时不检查）
+        self.prompt_reload_interval = float(os.getenv("PROMPT_RELOAD_INTERVAL", "5"))
+        self.prompt_reload_task = None
+
         # 消息过期时间配置
         self.message_expire_time = int(os.getenv("MESSAGE_EXPIRE_TIME", "300000"))  # 消息过期时间，默认5分钟
 
-        # 人工接管关键词，从环境变量读取
-        self.toggle_keywords = os.getenv("TOGGLE_KEYWORDS", "。")
+        # 人工接管关键词：keywords/toggle.txt，兼容环境变量TOGGLE_KEYWORDS（英文逗号分隔，整条消息匹配）
+        toggle_keywords = [f"re:^{re.escape(kw.strip())}$" for kw in os.getenv("TOGGLE_KEYWORDS", "").split(",") if kw.strip()]
+
+        # 关键词引擎，意图路由、安全过滤、新买家问候规则和人工接管切换共用
+        self.keyword_engine = KeywordEngine(os.getenv("KEYWORDS_DIR", "keywords"),
+                                            extra_keywords={'toggle': toggle_keywords})
+
+        # 初始化历史回复向量索引（可选），相似问题直接复用历史回复
+        reply_index = None
+        if os.getenv("REPLY_INDEX_ENABLED", "false").lower() == "true":
+            reply_index = ReplyIndex(threshold=float(os.getenv("REPLY_INDEX_THRESHOLD", "0.92")))
+            reply_index.build_from_db(self.context_manager.db_path)
+
+        # 初始化精确匹配回复缓存，相同问题直接复用回复
+        reply_cache = None
+        # 默认关闭：缓存键不含对话历史，不同买家的相同问题会得到相同回复
+        if os.getenv("REPLY_CACHE_ENABLED", "false").lower() == "true":
+            reply_cache = ReplyCache(
+                max_entries=int(os.getenv("REPLY_CACHE_MAX_ENTRIES", "5000")),
+                ttl=int(os.getenv("REPLY_CACHE_TTL", "21600")),  # 缓存有效期，默认6小时
+                db_path=self.context_manager.db_path if os.getenv("REPLY_CACHE_PERSIST", "false").lower() == "true" else None,
+                min_length=int(os.getenv("REPLY_CACHE_MIN_LENGTH", "6"))  # 已有回复的会话中可缓存消息的最短长度
+            )
+            # 商品信息更新后立即清除该商品的缓存回复，不必等到下次查询时按版本判定失效
+            self.context_manager.subscribe_item_updates(reply_cache.invalidate_item)
+
+        # 加载本地意图分类器（可选），规则未命中时替代大模型意图分类
+        intent_classifier = None
+        intent_model_path = os.getenv("INTENT_MODEL_PATH", "models/intent_nb.npz")
+        if os.path.exists(intent_model_path):
+            try:
+                intent_classifier = NaiveBayesIntentClassifier.load(intent_model_path)
+                logger.info(f"已加载本地意图分类模型: {intent_model_path}")
+            except Exception as e:
+                logger.error(f"加载本地意图分类模型失败: {e}")
+
+        # 按token预算组装对话上下文：最近若干轮原样保留，更早的对话由摘要替代
+        context_builder = None
+        context_keep_turns = int(os.getenv("CONTEXT_KEEP_TURNS", "6"))
+        # 默认关闭（为0时不压缩，发送完整历史），建议值1200；开启后改变发给模型的提示词内容
+        context_token_budget = int(os.getenv("CONTEXT_TOKEN_BUDGET", "0"))
+        if context_token_budget > 0:
+            context_builder = ContextBuilder(token_budget=context_token_budget, keep_turns=context_keep_turns)
+
+        # 规则议价引擎：含义明确的出价按商品底价和让价梯度直接回复，其余交给PriceAgent
+        bargain_engine = None
+        if os.getenv("BARGAIN_ENGINE_ENABLED", "true").lower() == "true":
+            bargain_engine = BargainEngine.load(os.getenv("BARGAIN_RULES_PATH", "prompts/bargain_rules.json"))
+
+        # 商品知识库：从itemDO和本地参数文件提取商品参数，技术咨询时注入提示词，替代联网搜索
+        item_knowledge = None
+        if os.getenv("ITEM_KNOWLEDGE_ENABLED", "true").lower() == "true":
+            item_knowledge = ItemKnowledgeStore(
+                knowledge_dir=os.getenv("ITEM_KNOWLEDGE_DIR", "knowledge"),
+                token_budget=int(os.getenv("ITEM_KNOWLEDGE_TOKEN_BUDGET", "300"))
+            )
 
         # 初始化AI机器人
-        self.bot = XianyuReplyBot()
+        self.bot = XianyuReplyBot(
+            reply_index=reply_index,
+            reply_cache=reply_cache,
+            intent_classifier=intent_classifier,
+            intent_threshold=float(os.getenv("INTENT_LOCAL_THRESHOLD", "0.8")),
+            keyword_engine=self.keyword_engine,
+            routing_strategy=os.getenv("ROUTING_STRATEGY", "sequential"),  # sequential / structured / speculative
+            speculative_max_tokens=int(os.getenv("SPECULATIVE_MAX_TOKENS", "200")),
+            context_builder=context_builder,
+            llm_max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", "8")),  # 为0时不限制并发、不排队
+            llm_priority_aging=float(os.getenv("LLM_PRIORITY_AGING_SECONDS", "5")),
+            bargain_engine=bargain_engine,
+            item_knowledge=item_knowledge,
+            reply_workers=self.MESSAGE_WORKERS
+        )
+
+        # 会话滚动摘要，由后台任务刷新，不占用回复路径
+        self.summarizer = None
+        self.summary_interval = int(os.getenv("SUMMARY_INTERVAL", "60"))
+        self.summary_task = None
+        # 默认关闭：开启后后台任务会额外调用大模型生成摘要，需同时设置CONTEXT_TOKEN_BUDGET
+        if context_builder is not None and os.getenv("SUMMARY_ENABLED", "false").lower() == "true":
+            self.summarizer = ConversationSummarizer(
+                self.bot.client,
+                self.context_manager,
+                keep_turns=context_keep_turns,
+                min_new_messages=int(os.getenv("SUMMARY_MIN_NEW_MESSAGES", "6")),
+                scheduler=self.bot.scheduler,
+                prompt_registry=self.bot.prompt_registry
+            )
+
+        # 流式回复配置：开启流式生成后，是否将每个完整句子作为单独消息立即发送
+        self.stream_reply_enabled = os.getenv("STREAM_REPLY_ENABLED", "false").lower() == "true"
+        self.stream_send_enabled = os.getenv("STREAM_SEND_ENABLED", "false").lower() == "true"
+
+        # 回复截止时间：从消息进入队列开始计时，超时中止生成并发送安抚回复（为0时不限时）
+        self.reply_deadline = float(os.getenv("REPLY_DEADLINE_SECONDS", "20"))
+        # 发送安抚回复后是否在后台重新生成正式回复
+        self.reply_followup_enabled = os.getenv("REPLY_FOLLOWUP_ENABLED", "false").lower() == "true"
+        self.reply_followup_deadline = float(os.getenv("REPLY_FOLLOWUP_DEADLINE_SECONDS", "60"))
+
+        # 买家在回复生成期间发来新消息时取消进行中的生成，合并消息后重新生成
+        self.supersede_enabled = os.getenv("SUPERSEDE_ENABLED", "true").lower() == "true"
+        # 买家正在输入时同样取消，等待新消息；超过该延迟仍无新消息则按原消息重新生成
+        self.typing_cancel_enabled = os.getenv("TYPING_CANCEL_ENABLED", "true").lower() == "true"
+        self.typing_restart_delay = float(os.getenv("TYPING_RESTART_DELAY", "3"))
+
+        # 买家正在输入时预取商品信息、会话上下文和商品知识，预取结果在有效期内被回复使用
+        self.prefetch_enabled = os.getenv("PREFETCH_ENABLED", "true").lower() == "true"
+        self.prefetch_ttl = float(os.getenv("PREFETCH_TTL", "60"))
 
         # 初始化消息队列系统
-        self.message_queue = MessageQueue(max_queue_size=1000, max_workers=7)
+        self.message_queue = MessageQueue(max_queue_size=1000, max_workers=self.MESSAGE_WORKERS)
         self.message_handlers = MessageHandlers(self)
         self._register_message_handlers()
         
-        logger.info(f"消息队列系统初始化完成 - 队列大小: 1000, 工作协程数: 7")
+        logger.info(f"消息队列系统初始化完成 - 队列大小: 1000, 工作协程数: {self.MESSAGE_WORKERS}")
 
     def _register_message_handlers(self):
         """注册各种类型的消息处理器"""
@@ -522,9 +587,8 @@ class XianyuLive:
             return False
 
     def check_toggle_keywords(self, message):
-        """检查消息是否包含切换关键词"""
-        message_stripped = message.strip()
-        return message_stripped in self.toggle_keywords
+        """检查消息是否命中人工接管切换关键词（toggle分类）"""
+        return self.keyword_engine.contains(message.strip(), 'toggle')
 
     def is_manual_mode(self, chat_id):
         """检查特定会话是否处于人工接管模式"""
@@ -705,31 +769,25 @@ class XianyuLive:
 
 
             print("**"*10)
-            database_path = 'data/chat_history.db'  # 指定数据库路径
+            # 收到消息即登记为已知买家，回复生成期间的后续消息不再重复打招呼
+            is_new_buyer = self.context_manager.mark_buyer_seen(send_user_id)
 
-            if not check_user_exists_in_messages(database_path, send_user_id) and send_message !="发来一条新消息" and send_message!="快给ta一个评价吧～":
+            if is_new_buyer and send_message !="发来一条新消息" and send_message!="快给ta一个评价吧～":
                 #await self.send_msg(websocket, chat_id, send_user_id, bot_reply)
 
-                print(not check_user_exists_in_messages(database_path, send_user_id),  send_message !="发来一条新消息" , send_message!="快给ta一个评价吧～" )
+                print(is_new_buyer,  send_message !="发来一条新消息" , send_message!="快给ta一个评价吧～" )
 
                 
                 
                 ini_msg  = "您好，老板"
 
-                #msg_list_2_expanded
-
-                for i in msg_list_2_expanded:
-                    if i in send_message:
-                        bot_reply = "目前是进行到哪一步卡住了？方便的话截图或录个短视频，方便定位问题"
-                        ini_msg = bot_reply
-                        break
-
-                for i in msg_list_expanded:
-                    if i in send_message:
-                        bot_reply = "您好，请大概描述下您遇到的问题，方便发下截图吗？视频也行"
-                        ini_msg = bot_reply
-                        # await self.send_msg(websocket, chat_id, send_user_id, bot_reply)
-                        break
+                # 打招呼类关键词优先于求助类关键词
+                categories = self.keyword_engine.categories(send_message)
+                if 'greeting' in categories:
+                    ini_msg = "您好，请大概描述下您遇到的问题，方便发下截图吗？视频也行"
+                    # await self.send_msg(websocket, chat_id, send_user_id, ini_msg)
+                elif 'help_request' in categories:
+                    ini_msg = "目前是进行到哪一步卡住了？方便的话截图或录个短视频，方便定位问题"
                 await self.send_msg(websocket, chat_id, send_user_id, ini_msg)
                 #其他输入：你好老板
 
@@ -762,15 +820,14 @@ class XianyuLive:
 
 
 
-            # 添加用户消息到上下文
-            self.context_manager.add_message_by_chat(chat_id, send_user_id, item_id, "user", send_message)
-
             # 如果当前会话处于人工接管模式，不进行自动回复
             if self.is_manual_mode(chat_id):
                 logger.info(f"🔴 会话 {chat_id} 处于人工接管模式，跳过自动回复")
+                self.context_manager.commit_turn(chat_id, send_user_id, item_id, send_message)
                 return
             if self.is_system_message(message):
                 logger.debug("系统消息，跳过处理")
+                self.context_manager.commit_turn(chat_id, send_user_id, item_id, send_message)
                 return
             # 从数据库中获取商品信息，如果不存在则从API获取并保存
             item_info = self.context_manager.get_item_info(item_id)
@@ -783,6 +840,7 @@ class XianyuLive:
                     self.context_manager.save_item_info(item_id, item_info)
                 else:
                     logger.warning(f"获取商品信息失败: {api_result}")
+                    self.context_manager.commit_turn(chat_id, send_user_id, item_id, send_message)
                     return
             else:
                 logger.info(f"从数据库获取商品信息: {item_id}")
@@ -791,21 +849,33 @@ class XianyuLive:
 
             # 获取完整的对话上下文
             context = self.context_manager.get_context_by_chat(chat_id)
-            # 生成回复
-            bot_reply = self.bot.generate_reply(
-                send_message,
-                item_description,
-                context=context
+            # 生成回复（在线程中执行，避免阻塞事件循环）
+            try:
+                result = await asyncio.to_thread(
+                    self.bot.generate_reply,
+                    send_message,
+                    item_description,
+                    context=context,
+                    item_id=item_id,
+                    item_info=item_info
+                )
+            except Exception:
+                self.context_manager.commit_turn(chat_id, send_user_id, item_id, send_message)
+                raise
+            bot_reply = result.text
+
+            # 在同一事务中记录用户消息和机器人回复，价格意图时同时增加议价次数
+            is_bargain = result.intent == "price"
+            bargain_count = self.context_manager.commit_turn(
+                chat_id, send_user_id, item_id, send_message,
+                seller_id=self.myid, reply=bot_reply, is_bargain=is_bargain
             )
-
-            # 检查是否为价格意图，如果是则增加议价次数
-            if self.bot.last_intent == "price":
-                self.context_manager.increment_bargain_count_by_chat(chat_id)
-                bargain_count = self.context_manager.get_bargain_count_by_chat(chat_id)
+            if is_bargain:
                 logger.info(f"用户 {send_user_name} 对商品 {item_id} 的议价次数: {bargain_count}")
-
-            # 添加机器人回复到上下文
-            self.context_manager.add_message_by_chat(chat_id, self.myid, item_id, "assistant", bot_reply)
+            if self.summarizer is not None:
+                self.summarizer.schedule(chat_id)
+            if self.bot.reply_index is not None and self.bot.should_index(result):
+                self.bot.reply_index.add(item_id, send_message, bot_reply)
 
             #logger.info(f"机器人回复: {bot_reply}")
 
@@ -886,6 +956,13 @@ class XianyuLive:
         await self.message_queue.start()
         logger.info("消息队列系统已启动")
         
+        # 启动历史数据保留任务（与连接无关，只启动一次）
+        self.retention_task = asyncio.create_task(self._retention_loop())
+        if self.summarizer is not None:
+            self.summary_task = asyncio.create_task(self._summary_loop())
+        if self.prompt_reload_interval > 0:
+            self.prompt_reload_task = asyncio.create_task(self._prompt_reload_loop())
+        
         while True:
             try:
                 # 重置连接重启标志
@@ -1027,10 +1104,156 @@ class XianyuLive:
                         f"队列大小: {stats['queue_size']}, "
                         f"平均处理时间: {stats['processing_time_avg']:.3f}s"
                     )
+                cache_stats = self.context_manager.get_cache_stats()
+                logger.info(
+                    f"会话缓存统计 - 命中率: {cache_stats['hit_ratio']:.1%}, "
+                    f"命中: {cache_stats['hits']}, 未命中: {cache_stats['misses']}, "
+                    f"淘汰: {cache_stats['evictions']}, "
+                    f"缓存会话数: {cache_stats['resident_chats']}, "
+                    f"内存占用: {cache_stats['resident_bytes'] / 1024:.1f}KB"
+                )
+                if self.bot.reply_cache is not None:
+                    reply_cache_stats = self.bot.reply_cache.get_stats()
+                    logger.info(
+                        f"回复缓存统计 - 命中率: {reply_cache_stats['hit_rate']:.1%}, "
+                        f"命中: {reply_cache_stats['hits']}, 未命中: {reply_cache_stats['misses']}, "
+                        f"失效: {reply_cache_stats['stale']}, 条目数: {reply_cache_stats['entries']}"
+                    )
+                if self.bot.routing_strategy == "structured":
+                    structured_stats = self.bot.agents['structured'].stats
+                    logger.info(
+                        f"结构化生成统计 - 调用: {structured_stats['calls']}, "
+                        f"回退两步生成: {structured_stats['fallbacks']}"
+                    )
+                if self.bot.routing_strategy == "speculative":
+                    speculation_stats = self.bot.get_speculation_stats()
+                    logger.info(
+                        f"并行预生成统计 - 命中率: {speculation_stats['win_rate']:.1%}, "
+                        f"次数: {speculation_stats['runs']}, 丢弃: {speculation_stats['losses']}, "
+                        f"重新生成: {speculation_stats['fallbacks']}, "
+                        f"预生成token: {speculation_stats['speculative_tokens']}, "
+                        f"浪费token: {speculation_stats['wasted_tokens']}"
+                    )
+                for name, latency in self.bot.metrics.summary().items():
+                    logger.info(
+                        f"延迟统计[{name}] - 次数: {latency['count']}, p50: {latency['p50']:.0f}ms, "
+                        f"p95: {latency['p95']:.0f}ms, 最大: {latency['max']:.0f}ms"
+                    )
+                for agent_name, token_stats in list(self.bot.context_token_stats.items()):
+                    logger.info(
+                        f"提示词token统计[{agent_name}] - 调用: {token_stats['calls']}, "
+                        f"平均压缩前: {token_stats['tokens_before'] / token_stats['calls']:.0f}, "
+                        f"平均压缩后: {token_stats['tokens_after'] / token_stats['calls']:.0f}"
+                    )
+                for agent_name, usage in self.bot.metrics.usage_summary().items():
+                    logger.info(
+                        f"token用量统计[{agent_name}] - 调用: {usage['calls']}, 输入: {usage['prompt_tokens']}, "
+                        f"缓存命中: {usage['cached_tokens']} ({usage['cache_hit_ratio']:.1%}), "
+                        f"输出: {usage['completion_tokens']}"
+                    )
+                for model_key, model_stats in self.bot.metrics.model_summary().items():
+                    logger.info(
+                        f"模型分层统计[{model_key}] - 调用: {model_stats['calls']}, p50: {model_stats['p50']:.0f}ms, "
+                        f"p95: {model_stats['p95']:.0f}ms, 输入token: {model_stats['prompt_tokens']}, "
+                        f"输出token: {model_stats['completion_tokens']}"
+                    )
+                prefetch_stats = self.message_handlers.prefetch_stats
+                prefetch_lookups = prefetch_stats['hits'] + prefetch_stats['misses']
+                logger.info(
+                    f"输入预取统计 - 预取: {prefetch_stats['prefetches']}, 无商品: {prefetch_stats['no_item']}, "
+                    f"命中: {prefetch_stats['hits']}/{prefetch_lookups} "
+                    f"({prefetch_stats['hits'] / prefetch_lookups if prefetch_lookups else 0:.1%})"
+                )
+                supersede_stats = self.message_handlers.supersede_stats
+                logger.info(
+                    f"回复取代统计 - 取消: {supersede_stats['superseded']}, 输入状态取消: {supersede_stats['typing_cancels']}, "
+                    f"重新生成: {supersede_stats['restarts']}, 已消耗token: {supersede_stats['wasted_tokens']}, "
+                    f"估算节省token: {supersede_stats['saved_tokens']}"
+                )
+                for (agent_name, model_key), hits in self.bot.metrics.deadline_summary().items():
+                    logger.info(f"回复超时统计[{agent_name}/{model_key}] - 超时中止: {hits}")
+                if self.bot.scheduler is not None:
+                    for priority_class, queue_stats in self.bot.scheduler.get_stats().items():
+                        logger.info(
+                            f"大模型排队统计[{priority_class}] - 调用: {queue_stats['calls']}, 排队: {queue_stats['waited']}, "
+                            f"超时: {queue_stats['timeouts']}, 平均等待: {queue_stats['avg_wait_ms']:.0f}ms, 最长等待: {queue_stats['max_wait_ms']:.0f}ms"
+                        )
+                for backend_name, backend_stats in self.bot.client.get_stats().items():
+                    logger.info(
+                        f"大模型后端统计[{backend_name}] - 请求: {backend_stats['requests']}, "
+                        f"错误率: {backend_stats['error_rate']:.1%}, EWMA延迟: {backend_stats['ewma_ms']:.0f}ms, "
+                        f"p95: {backend_stats['p95_ms']:.0f}ms, 流式: {backend_stats['streams']}, "
+                        f"首字EWMA: {backend_stats['ttft_ewma_ms']:.0f}ms, 首字p95: {backend_stats['ttft_p95_ms']:.0f}ms, 对冲: {backend_stats['hedges']}/{backend_stats['hedge_wins']}"
+                        f"{', 暂停中' if backend_stats['cooling_down'] else ''}"
+                    )
+                if self.bot.bargain_engine is not None:
+                    bargain_stats = self.bot.bargain_engine.get_stats()
+                    logger.info(
+                        f"议价引擎统计 - 议价消息: {bargain_stats['messages']}, "
+                        f"本地处理: {bargain_stats['handled']} ({bargain_stats['handled_rate']:.1%}), "
+                        f"交给PriceAgent: {bargain_stats['deferred']}, 决策分布: {bargain_stats['actions']}"
+                    )
+                if self.bot.item_knowledge is not None:
+                    knowledge_stats = self.bot.item_knowledge.get_stats()
+                    logger.info(
+                        f"商品知识库统计 - 查询: {knowledge_stats['lookups']}, 生成: {knowledge_stats['builds']}, "
+                        f"无知识(联网搜索): {knowledge_stats['empty']}, 缓存商品数: {knowledge_stats['entries']}, "
+                        f"平均片段token: {knowledge_stats['avg_snippet_tokens']:.0f}"
+                    )
+                router_stats = self.bot.router.get_stats()
+                logger.info(
+                    f"意图路由统计 - 规则命中: {router_stats['rule_hits']}, "
+                    f"本地分类命中: {router_stats['local_hits']}, "
+                    f"大模型兜底: {router_stats['llm_fallbacks']} ({router_stats['llm_fallback_rate']:.1%})"
+                )
+                if self.bot.reply_index is not None:
+                    index_stats = self.bot.reply_index.get_stats()
+                    logger.info(
+                        f"回复索引统计 - 命中率: {index_stats['hit_rate']:.1%}, "
+                        f"查询: {index_stats['lookups']}, 命中: {index_stats['hits']}, "
+                        f"节省大模型调用: {index_stats['saved_llm_calls']}"
+                    )
             except Exception as e:
                 logger.error(f"统计循环出错: {e}")
                 await asyncio.sleep(30)
 
+    async def _retention_loop(self):
+        """历史数据保留循环：定期清理、归档冷会话并维护数据库"""
+        while True:
+            try:
+                await asyncio.sleep(self.retention_interval)
+                # 数据库操作放到线程中执行，避免阻塞消息处理
+                result = await asyncio.to_thread(self.context_manager.run_retention, self.archive_idle_days)
+                logger.info(f"保留策略任务完成 - 清理消息: {result['trimmed']}, 归档会话: {result['archived']}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"保留策略任务出错: {e}")
+
+    async def _prompt_reload_loop(self):
+        """提示词热更新循环：检查提示词文件变化并应用新版本"""
+        while True:
+            try:
+                await asyncio.sleep(self.prompt_reload_interval)
+                await asyncio.to_thread(self.bot.reload_prompts)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"提示词热更新任务出错: {e}")
+
+    async def _summary_loop(self):
+        """会话摘要刷新循环：批量刷新有新消息的会话摘要"""
+        while True:
+            try:
+                await asyncio.sleep(self.summary_interval)
+                refreshed = await asyncio.to_thread(self.summarizer.refresh_pending)
+                if refreshed:
+                    logger.info(f"会话摘要刷新完成 - 更新会话数: {refreshed}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"会话摘要任务出错: {e}")
+
 
 if __name__ == '__main__':
     # 加载环境变量
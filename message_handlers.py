@@ -2,17 +2,45 @@ import asyncio
 import json
 import time
 import base64
-from typing import Dict, Any
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional
 from loguru import logger
 from datetime import datetime
 
 from utils.xianyu_utils import decrypt
-from XianyuAgent import XianyuReplyBot
+from XianyuAgent import XianyuReplyBot, GenerationHandle
 from context_manager import ChatContextManager
+from message_queue import message_received_at
+
+
+@dataclass
+class _ChatGeneration:
+    """会话中正在进行（或被输入状态打断、等待重新开始）的回复生成"""
+    messages: List[str]  # 本轮合并回复的用户消息
+    handle: GenerationHandle
+    send_user_name: str
+    item_id: str
+    send_user_id: str
+    websocket: Any
+    superseded: bool = False
+    restart_task: Optional[asyncio.Task] = None
+    sent: List[str] = field(default_factory=list)  # 流式发送时已发给买家的句子
+    merged: bool = False  # 未回复的消息已被新一轮接管合并
+
+
+@dataclass
+class _Prefetch:
+    """输入状态触发的预取结果"""
+    item_id: str
+    item_info: Dict[str, Any]
+    fetched_at: float
 
 
 class MessageHandlers:
     """消息处理器集合"""
+
+    # 记录会话对应商品的最大会话数
+    MAX_TRACKED_CHATS = 10000
     
     def __init__(self, xianyu_live_instance=None):
         """
@@ -22,6 +50,26 @@ class MessageHandlers:
             xianyu_live_instance: XianyuLive实例，可选参数
         """
         self.xianyu_live = xianyu_live_instance
+        # 会话ID -> 进行中的回复生成，同一会话只保留最新的一个
+        self._inflight: Dict[str, _ChatGeneration] = {}
+        self._avg_reply_tokens = None  # 完整生成一次回复的平均token数，用于估算取消节省的token
+        self.supersede_stats = {
+            'superseded': 0,  # 被新消息或输入状态取消的生成
+            'typing_cancels': 0,
+            'restarts': 0,  # 输入状态取消后未等到新消息，重新生成
+            'wasted_tokens': 0,  # 被取消的生成已消耗的token
+            'saved_tokens': 0,  # 估算：平均完整生成token数 - 被取消时已消耗的token
+        }
+        # 买家输入时预取回复所需的数据：会话ID -> 预取结果
+        self._chat_items: Dict[str, str] = {}  # 会话ID -> 最近的商品ID
+        self._prefetched: Dict[str, _Prefetch] = {}
+        self._prefetching = set()
+        self.prefetch_stats = {
+            'prefetches': 0,
+            'no_item': 0,  # 无法确定会话对应的商品，未预取
+            'hits': 0,  # 回复时使用了预取结果
+            'misses': 0,
+        }
         logger.info("消息处理器初始化完成")
     
     async def handle_heartbeat(self, raw_data: Dict[str, Any], websocket: Any):
@@ -112,6 +160,9 @@ class MessageHandlers:
             # 处理输入状态
             if self._is_typing_status(decrypted_message):
                 logger.debug("用户正在输入")
+                typing_chat_id = decrypted_message["1"][0]["1"].split('@')[0]
+                self._schedule_prefetch(typing_chat_id)
+                self._on_buyer_typing(typing_chat_id)
                 # 安全的语音提醒处理
                 try:
                     # 检查是否有语音引擎可用
@@ -315,6 +366,7 @@ class MessageHandlers:
             if not item_id:
                 logger.warning("无法获取商品ID")
                 return
+            self._remember_chat_item(chat_id, item_id)
             
             # 检查是否为卖家（自己）发送的控制命令
             if send_user_id == self.xianyu_live.myid:
@@ -344,21 +396,18 @@ class MessageHandlers:
                 logger.info(f"特殊消息已处理，跳过AI回复生成")
                 return
 
-            # 添加用户消息到上下文
-            self.xianyu_live.context_manager.add_message_by_chat(
-                chat_id, send_user_id, item_id, "user", send_message
-            )
-            
             # 如果当前会话处于人工接管模式，不进行自动回复
             if self.xianyu_live.is_manual_mode(chat_id):
                 logger.info(f"🔴 会话 {chat_id} 处于人工接管模式，跳过自动回复")
+                self._record_user_message(chat_id, send_user_id, item_id, send_message)
                 return
             
             if self.xianyu_live.is_system_message(message):
                 logger.debug("系统消息，跳过处理")
+                self._record_user_message(chat_id, send_user_id, item_id, send_message)
                 return
             
-            # 生成AI回复
+            # 生成AI回复（用户消息与回复在同一事务中记录）
             await self._generate_ai_reply(
                 send_user_name, send_message, chat_id, 
                 item_id, send_user_id, websocket
@@ -368,6 +417,12 @@ class MessageHandlers:
             logger.error(f"聊天消息处理失败: {e}")
             raise
     
+    def _record_user_message(self, chat_id: str, send_user_id: str, item_id: str, send_message):
+        """只记录用户消息（未生成回复的轮次），合并轮次时send_message为消息列表"""
+        self.xianyu_live.context_manager.commit_turn(
+            chat_id, send_user_id, item_id, send_message
+        )
+    
     async def _handle_seller_message(self, send_message: str, chat_id: str, item_id: str):
         """处理卖家消息"""
         logger.debug("检测到卖家消息，检查是否为控制命令")
@@ -407,9 +462,9 @@ class MessageHandlers:
                 logger.info(f"会话 {chat_id} 处于人工接管模式，跳过自动回复")
                 return
 
-            # 检查数据库中是否已存在该用户的记录
+            # 检查是否为已知买家（收到消息即登记，回复生成期间的后续消息不再重复通知）
             import main
-            if not main.check_user_exists_in_messages("data/chat_history.db", send_user_id):
+            if self.xianyu_live.context_manager.mark_buyer_seen(send_user_id):
                 logger.info(f"新用户 {send_user_name}({send_user_id}) 首次发送消息")
                 
                 # 发送邮件通知
@@ -476,54 +531,395 @@ class MessageHandlers:
             logger.error(f"特殊消息处理失败: {e}")
             return False
     
+    def _new_generation_handle(self, deadline_seconds: float, start: float = None) -> GenerationHandle:
+        """
+        创建生成句柄，截止时间从消息进入队列时开始计算（deadline_seconds为0时不限时）
+
+        Args:
+            start: 计时起点，默认取当前消息的接收时间
+        """
+        if deadline_seconds <= 0:
+            return GenerationHandle()
+        start = start or message_received_at.get() or time.time()
+        return GenerationHandle(start + deadline_seconds)
+
+    async def _run_generation(
+        self, send_message: str, item_description: str, context: list,
+        chat_id: str, item_id: str, send_user_id: str, websocket: Any, handle: GenerationHandle,
+        item_info: Optional[Dict[str, Any]] = None, sent: Optional[List[str]] = None
+    ):
+        """
+        按配置以流式或非流式方式生成回复，返回ReplyResult
+
+        Args:
+            sent: 可选的列表，流式发送时每发出一句追加到其中
+        """
+        if self.xianyu_live.stream_reply_enabled:
+            return await self._generate_streaming_reply(
+                send_message, item_description, context, chat_id, item_id, send_user_id, websocket, handle,
+                item_info, sent
+            )
+        return await asyncio.to_thread(
+            self.xianyu_live.bot.generate_reply,
+            send_message,
+            item_description,
+            context,
+            item_id=item_id,
+            handle=handle,
+            item_info=item_info
+        )
+
+    async def _generate_followup_reply(
+        self, messages: List[str], item_description: str, holding_reply: str,
+        chat_id: str, item_id: str, send_user_id: str, websocket: Any
+    ):
+        """安抚回复发出后在后台重新生成正式回复，作为追加消息发送"""
+        try:
+            send_message = "\n".join(messages)
+            context = self.xianyu_live.context_manager.get_context_by_chat(chat_id)
+            # 去掉本轮的用户消息和安抚回复，避免历史中出现重复问题
+            turn = [msg['content'] for msg in context[-(len(messages) + 1):]]
+            if turn == messages + [holding_reply]:
+                context = context[:-(len(messages) + 1)]
+            handle = self._new_generation_handle(self.xianyu_live.reply_followup_deadline, time.time())
+            result = await self._run_generation(
+                send_message, item_description, context, chat_id, item_id, send_user_id, websocket, handle
+            )
+            if result.deadline_hit or not result.text.strip():
+                logger.warning(f"追加回复生成失败或再次超时，放弃 (会话: {chat_id})")
+                return
+            self.xianyu_live.context_manager.add_message_by_chat(
+                chat_id, self.xianyu_live.myid, item_id, "assistant", result.text
+            )
+            logger.info(f"追加回复生成完成 - 意图: {result.intent}, 回复: {result.text}")
+            #await self.xianyu_live.send_msg(websocket, chat_id, send_user_id, result.text)
+        except Exception as e:
+            logger.error(f"追加回复生成失败: {e}")
+
+    async def _generate_streaming_reply(
+        self, send_message: str, item_description: str, context: list,
+        chat_id: str, item_id: str, send_user_id: str, websocket: Any, handle: GenerationHandle = None,
+        item_info: Optional[Dict[str, Any]] = None, sent: Optional[List[str]] = None
+    ) -> str:
+        """
+        流式生成回复：在线程中生成，每个完整句子生成后立即作为单独消息发送
+
+        Returns:
+            ReplyResult: 回复生成结果
+        """
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        sentences = []
+
+        def on_sentence(sentence: str):
+            # 生成已被新消息取消时不再发送过时的句子
+            if handle is not None and handle.cancelled:
+                return
+            # 在生成线程中回调，发送协程提交回事件循环并等待完成以保证句子顺序
+            if self.xianyu_live.stream_send_enabled:
+                if sent is not None:
+                    sent.append(sentence)
+                asyncio.run_coroutine_threadsafe(
+                    self.xianyu_live.send_msg(websocket, chat_id, send_user_id, sentence), loop
+                ).result(timeout=10)
+            if not sentences:
+                self.xianyu_live.bot.metrics.record('ttfm', (time.time() - start_time) * 1000)
+            sentences.append(sentence)
+            logger.info(f"流式回复第{len(sentences)}句: {sentence}")
+
+        return await asyncio.to_thread(
+            self.xianyu_live.bot.generate_reply,
+            send_message,
+            item_description,
+            context,
+            item_id=item_id,
+            on_sentence=on_sentence,
+            handle=handle,
+            item_info=item_info
+        )
+
+    def _remember_chat_item(self, chat_id: str, item_id: str):
+        """记录会话对应的商品，供输入状态预取使用"""
+        self._chat_items.pop(chat_id, None)
+        self._chat_items[chat_id] = item_id
+        if len(self._chat_items) > self.MAX_TRACKED_CHATS:
+            del self._chat_items[next(iter(self._chat_items))]
+
+    @staticmethod
+    def _describe_item(item_info: Dict[str, Any]) -> str:
+        """生成回复时使用的商品描述"""
+        return item_info.get('title', '未知商品')
+
+    def _schedule_prefetch(self, chat_id: str):
+        """买家正在输入时在后台预取回复所需的数据，已有未过期的预取结果时跳过"""
+        if not self.xianyu_live.prefetch_enabled or chat_id in self._prefetching:
+            return
+        now = time.time()
+        for stale_chat_id in [cid for cid, entry in self._prefetched.items()
+                              if now - entry.fetched_at > self.xianyu_live.prefetch_ttl]:
+            del self._prefetched[stale_chat_id]
+        if chat_id in self._prefetched:
+            return
+        self._prefetching.add(chat_id)
+        asyncio.create_task(self._prefetch(chat_id))
+
+    def _load_item_info(self, item_id: str):
+        """从数据库读取商品信息，不存在时从API获取并保存"""
+        item_info = self.xianyu_live.context_manager.get_item_info(item_id)
+        if item_info or not hasattr(self.xianyu_live, 'xianyu'):
+            return item_info
+        api_result = self.xianyu_live.xianyu.get_item_info(item_id)
+        if 'data' in api_result and 'itemDO' in api_result['data']:
+            item_info = api_result['data']['itemDO']
+            self.xianyu_live.context_manager.save_item_info(item_id, item_info)
+            return item_info
+        return None
+
+    async def _prefetch(self, chat_id: str):
+        """
+        预取商品信息、会话上下文（加载到内存环形缓冲区）和商品知识片段，
+        消息到达后只剩大模型调用在关键路径上
+        """
+        try:
+            context_manager = self.xianyu_live.context_manager
+            item_id = self._chat_items.get(chat_id) or await asyncio.to_thread(context_manager.get_item_id_by_chat, chat_id)
+            if not item_id:
+                self.prefetch_stats['no_item'] += 1
+                return
+            item_info = await asyncio.to_thread(self._load_item_info, item_id)
+            if not item_info:
+                return
+            await asyncio.to_thread(context_manager.get_context_by_chat, chat_id)
+            knowledge_store = self.xianyu_live.bot.item_knowledge
+            if knowledge_store is not None:
+                await asyncio.to_thread(knowledge_store.get, item_id, item_info)
+            self._prefetched[chat_id] = _Prefetch(item_id, item_info, time.time())
+            self.prefetch_stats['prefetches'] += 1
+            logger.debug(f"会话 {chat_id} 预取完成 (商品: {item_id})")
+        except Exception as e:
+            logger.warning(f"会话 {chat_id} 预取失败: {e}")
+        finally:
+            self._prefetching.discard(chat_id)
+
+    def _take_prefetch(self, chat_id: str, item_id: str):
+        """
+        取出会话的预取结果并记录命中情况
+
+        Returns:
+            dict: 预取的商品信息，未预取、已过期或商品不一致时返回None
+        """
+        entry = self._prefetched.pop(chat_id, None)
+        if (entry is not None and entry.item_id == item_id
+                and time.time() - entry.fetched_at <= self.xianyu_live.prefetch_ttl):
+            self.prefetch_stats['hits'] += 1
+            return entry.item_info
+        self.prefetch_stats['misses'] += 1
+        return None
+
+    def _supersede(self, generation: _ChatGeneration):
+        """
+        取消会话中进行中的生成，其未回复的消息由下一轮合并处理
+
+        取消只在生成的各阶段之间和流式输出的分段之间生效，已发出的非流式大模型调用会继续到返回，结果被丢弃。
+        """
+        generation.superseded = True
+        generation.handle.cancel()
+        self.supersede_stats['superseded'] += 1
+
+    def _take_over_generation(self, chat_id: str, send_message: Optional[str]) -> List[str]:
+        """
+        新一轮生成接管会话：取消进行中的生成，合并其未回复的消息
+
+        Returns:
+            list: 本轮需要回复的用户消息（按接收顺序）
+        """
+        messages = [send_message] if send_message else []
+        if not self.xianyu_live.supersede_enabled:
+            return messages
+        previous = self._inflight.pop(chat_id, None)
+        if previous is None:
+            return messages
+        if not previous.superseded:
+            self._supersede(previous)
+        if previous.restart_task is not None:
+            previous.restart_task.cancel()
+        if previous.sent:
+            # 买家已看到部分回复，这些消息连同已发出的句子由原生成记录，不再合并
+            logger.info(f"会话 {chat_id} 收到新消息，取消进行中的回复生成（已发出 {len(previous.sent)} 句，不合并）")
+            return messages
+        previous.merged = True
+        logger.info(f"会话 {chat_id} 收到新消息，取消进行中的回复生成，合并 {len(previous.messages)} 条未回复消息")
+        return previous.messages + messages
+
+    def _finish_generation(self, chat_id: str, generation: _ChatGeneration):
+        if self._inflight.get(chat_id) is generation:
+            del self._inflight[chat_id]
+
+    def _record_partial_reply(self, chat_id: str, generation: _ChatGeneration, intent: Optional[str]):
+        """
+        记录被取消前已发给买家的部分回复，使对话历史与买家看到的一致
+
+        消息未被合并时与部分回复一起作为一轮提交；已被新一轮合并时（取消前后的竞争）只补记部分回复。
+        """
+        partial = "".join(generation.sent)
+        if generation.merged:
+            self.xianyu_live.context_manager.add_message_by_chat(
+                chat_id, self.xianyu_live.myid, generation.item_id, "assistant", partial
+            )
+        else:
+            # 不再等待输入状态后的重新生成
+            self._finish_generation(chat_id, generation)
+            if generation.restart_task is not None:
+                generation.restart_task.cancel()
+            self.xianyu_live.context_manager.commit_turn(
+                chat_id, generation.send_user_id, generation.item_id, generation.messages,
+                seller_id=self.xianyu_live.myid, reply=partial, is_bargain=intent == "price"
+            )
+        logger.info(f"会话 {chat_id} 的回复生成已被取代，记录已发出的 {len(generation.sent)} 句")
+
+    def _record_superseded(self, result):
+        """记录被取消的生成消耗和节省的token"""
+        spent = result.usage.get('prompt_tokens', 0) + result.usage.get('completion_tokens', 0)
+        self.supersede_stats['wasted_tokens'] += spent
+        if self._avg_reply_tokens is not None:
+            self.supersede_stats['saved_tokens'] += max(int(self._avg_reply_tokens) - spent, 0)
+
+    def _on_buyer_typing(self, chat_id: str):
+        """
+        买家正在输入：取消进行中的生成，等待新消息合并回复；
+        typing_restart_delay秒内没有新消息时按原消息重新生成
+        """
+        if not self.xianyu_live.typing_cancel_enabled:
+            return
+        generation = self._inflight.get(chat_id)
+        if generation is None:
+            return
+        if not generation.superseded:
+            self._supersede(generation)
+            self.supersede_stats['typing_cancels'] += 1
+            logger.info(f"会话 {chat_id} 买家正在输入，取消进行中的回复生成")
+        # 持续输入时推迟重新生成
+        if generation.restart_task is not None:
+            generation.restart_task.cancel()
+        generation.restart_task = asyncio.create_task(self._restart_after_typing(chat_id, generation))
+
+    async def _restart_after_typing(self, chat_id: str, generation: _ChatGeneration):
+        await asyncio.sleep(self.xianyu_live.typing_restart_delay)
+        if self._inflight.get(chat_id) is not generation:
+            return
+        generation.restart_task = None
+        self.supersede_stats['restarts'] += 1
+        logger.info(f"会话 {chat_id} 未收到新消息，重新生成回复")
+        await self._generate_ai_reply(
+            generation.send_user_name, None, chat_id,
+            generation.item_id, generation.send_user_id, generation.websocket
+        )
+
     async def _generate_ai_reply(
-        self, send_user_name: str, send_message: str, chat_id: str,
+        self, send_user_name: str, send_message: Optional[str], chat_id: str,
         item_id: str, send_user_id: str, websocket: Any
     ):
-        """生成AI回复"""
+        """
+        生成AI回复
+
+        同一会话同时只保留一个回复生成：新消息到达时取消进行中的生成，其未回复的消息与新消息合并后
+        一起生成回复。send_message为None时只重新生成未回复的消息（输入状态取消后的重新生成）。
+        """
         try:
             if not self.xianyu_live:
                 logger.warning("XianyuLive实例未初始化，无法生成AI回复")
                 return
+
+            messages = self._take_over_generation(chat_id, send_message)
+            if not messages:
+                return
+            combined_message = "\n".join(messages)
                 
-            # 从数据库获取商品信息
-            logger.info(f"从数据库获取商品信息: {item_id}")
-            item_info = self.xianyu_live.context_manager.get_item_info(item_id)
+            # 优先使用买家输入时预取的商品信息，否则从数据库获取
+            item_info = self._take_prefetch(chat_id, item_id)
+            if item_info is None:
+                logger.info(f"从数据库获取商品信息: {item_id}")
+                item_info = self.xianyu_live.context_manager.get_item_info(item_id)
             if not item_info:
                 logger.warning(f"未找到商品信息: {item_id}")
+                self._record_user_message(chat_id, send_user_id, item_id, messages)
                 return
 
-            item_description = item_info.get('title', '未知商品')
+            item_description = self._describe_item(item_info)
 
             # 获取对话历史
             context = self.xianyu_live.context_manager.get_context_by_chat(chat_id)
             
-            # 生成回复
-            bot_reply = self.xianyu_live.bot.generate_reply(
-                send_message,
-                item_description,
-                context
+            # 生成回复，失败时仍需记录用户消息
+            # 回复生成是阻塞调用，放到线程中执行，多个worker可以真正并行生成
+            # 截止时间从消息进入队列时开始计算（重新生成时从现在开始），超时后发送安抚回复
+            handle = self._new_generation_handle(
+                self.xianyu_live.reply_deadline, None if send_message else time.time()
+            )
+            generation = _ChatGeneration(messages, handle, send_user_name, item_id, send_user_id, websocket)
+            self._inflight[chat_id] = generation
+            try:
+                result = await self._run_generation(
+                    combined_message, item_description, context, chat_id, item_id, send_user_id, websocket, handle,
+                    item_info, generation.sent
+                )
+            except Exception:
+                # 已被新一轮接管时，消息由新一轮记录（已发出部分回复时由本轮记录）
+                if generation.superseded:
+                    if generation.sent:
+                        self._record_partial_reply(chat_id, generation, handle.intent)
+                    return
+                self._finish_generation(chat_id, generation)
+                self._record_user_message(chat_id, send_user_id, item_id, messages)
+                raise
+            if generation.superseded:
+                # 过时的回复不记录、不再发送，消息由新一轮合并回复；已发出的句子照实记录
+                self._record_superseded(result)
+                if generation.sent:
+                    self._record_partial_reply(chat_id, generation, result.intent)
+                else:
+                    logger.info(f"会话 {chat_id} 的回复生成已被取代，丢弃结果")
+                return
+            self._finish_generation(chat_id, generation)
+            spent = result.usage.get('prompt_tokens', 0) + result.usage.get('completion_tokens', 0)
+            if spent and not result.deadline_hit:
+                self._avg_reply_tokens = spent if self._avg_reply_tokens is None else 0.9 * self._avg_reply_tokens + 0.1 * spent
+            bot_reply = result.text
+            logger.info(
+                f"回复生成完成 - 意图: {result.intent}, 来源: {result.agent}, "
+                f"耗时: {result.timings.get('total_ms', 0):.0f}ms, "
+                f"输入token: {result.usage.get('prompt_tokens', 0)}, 输出token: {result.usage.get('completion_tokens', 0)}"
             )
 
             if not bot_reply or bot_reply.strip() == "":
                 logger.warning("AI生成的回复为空")
+                self._record_user_message(chat_id, send_user_id, item_id, messages)
                 return
 
-            # 检查是否为价格意图，如果是则增加议价次数
-            if self.xianyu_live.bot.last_intent == "price":
-                self.xianyu_live.context_manager.increment_bargain_count_by_chat(chat_id)
-                bargain_count = self.xianyu_live.context_manager.get_bargain_count_by_chat(chat_id)
+            # 在同一事务中保存用户消息、AI回复，价格意图时同时增加议价次数
+            is_bargain = result.intent == "price"
+            bargain_count = self.xianyu_live.context_manager.commit_turn(
+                chat_id, send_user_id, item_id, messages,
+                seller_id=self.xianyu_live.myid, reply=bot_reply, is_bargain=is_bargain
+            )
+            if is_bargain:
                 logger.info(f"议价次数增加到: {bargain_count}")
+            
+            # 登记会话，由后台任务刷新摘要
+            if self.xianyu_live.summarizer is not None:
+                self.xianyu_live.summarizer.schedule(chat_id)
 
-            # 保存对话历史
-            self.xianyu_live.context_manager.add_message_by_chat(
-                chat_id, send_user_id, item_id, "user", send_message
-            )
-            self.xianyu_live.context_manager.add_message_by_chat(
-                chat_id, self.xianyu_live.myid, item_id, "assistant", bot_reply
-            )
+            # 新的问答对加入历史回复索引（只加入大模型针对问题生成的回复）
+            if self.xianyu_live.bot.reply_index is not None and self.xianyu_live.bot.should_index(result):
+                self.xianyu_live.bot.reply_index.add(item_id, combined_message, bot_reply)
+
+            # 超时发送了安抚回复时，可选地在后台重新生成正式回复
+            if result.agent == 'holding' and self.xianyu_live.reply_followup_enabled:
+                asyncio.create_task(self._generate_followup_reply(
+                    messages, item_description, bot_reply, chat_id, item_id, send_user_id, websocket
+                ))
 
-            # 发送回复
+            # 发送回复（流式发送时各句已在生成过程中发出）
             logger.info(f"准备发送AI回复: {bot_reply}")
             #await self.xianyu_live.send_msg(websocket, chat_id, send_user_id, bot_reply)
 
@@ -1,4 +1,5 @@
 import asyncio
+import contextvars
 import json
 import time
 from typing import Dict, Any, Optional, Callable
@@ -7,6 +8,10 @@ from loguru import logger
 from enum import Enum
 
 
+# 当前处理的消息的接收时间，处理器据此计算回复截止时间（重试时保持首次接收的时间）
+message_received_at: contextvars.ContextVar[Optional[float]] = contextvars.ContextVar('message_received_at', default=None)
+
+
 class MessageType(Enum):
     """消息类型枚举"""
     CHAT = "chat"
@@ -199,6 +204,7 @@ class MessageQueue:
                     # 查找对应的处理器
                     handler = self.handlers.get(queued_message.message_type)
                     if handler:
+                        message_received_at.set(queued_message.timestamp)
                         # 调用处理器
                         await handler(queued_message.raw_data, queued_message.websocket)
                         
@@ -0,0 +1,126 @@
+import hashlib
+import os
+import threading
+from dataclasses import dataclass
+from typing import Callable, Dict, List
+
+from loguru import logger
+
+
+@dataclass(frozen=True)
+class PromptVersion:
+    """提示词文件的一个版本"""
+    name: str
+    text: str
+    version: str  # 内容哈希
+    mtime_ns: int
+
+
+class PromptRegistry:
+    """
+    提示词注册表
+
+    启动时加载prompts目录下的提示词文件，之后由后台任务调用poll检查文件修改时间，
+    内容变化的文件重新读取并整体替换版本表（读取方拿到的始终是完整的一组版本），
+    再通知订阅者按名称更新。读取提示词只查内存，不做文件I/O。
+    """
+
+    def __init__(self, prompt_dir: str, files: Dict[str, str]):
+        """
+        Args:
+            prompt_dir: 提示词目录
+            files: 提示词名称 -> 文件名
+        """
+        self.prompt_dir = prompt_dir
+        self.files = files
+        self._versions: Dict[str, PromptVersion] = {}
+        self._listeners: List[Callable[[List[str]], None]] = []
+        self._poll_lock = threading.Lock()
+        self.stats = {
+            'polls': 0,
+            'reloads': 0,  # 内容发生变化的文件数
+            'errors': 0,
+        }
+
+    def load(self):
+        """加载全部提示词文件，任一文件读取失败时抛出异常"""
+        versions = {}
+        for name, filename in self.files.items():
+            path = os.path.join(self.prompt_dir, filename)
+            mtime_ns = os.stat(path).st_mtime_ns
+            with open(path, "r", encoding="utf-8") as f:
+                text = f.read()
+            versions[name] = PromptVersion(name, text, self._hash(text), mtime_ns)
+            logger.debug(f"已加载提示词 {filename}，长度: {len(text)} 字符，版本: {versions[name].version}")
+        self._versions = versions
+
+    @staticmethod
+    def _hash(text: str) -> str:
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+    def get(self, name: str) -> PromptVersion:
+        """获取提示词的当前版本"""
+        return self._versions[name]
+
+    def text(self, name: str) -> str:
+        """获取提示词的当前内容"""
+        return self._versions[name].text
+
+    def versions(self) -> Dict[str, str]:
+        """各提示词的当前版本号"""
+        return {name: prompt.version for name, prompt in self._versions.items()}
+
+    def subscribe(self, callback: Callable[[List[str]], None]):
+        """注册提示词变化回调，参数为内容发生变化的提示词名称列表"""
+        self._listeners.append(callback)
+
+    def poll(self) -> List[str]:
+        """
+        检查提示词文件是否被修改，内容变化时替换为新版本并通知订阅者（在后台线程中调用）
+
+        文件为空或读取期间仍在被写入时保留旧版本，等待下一次检查。
+
+        Returns:
+            list: 内容发生变化的提示词名称
+        """
+        with self._poll_lock:
+            self.stats['polls'] += 1
+            current = self._versions
+            updated = {}
+            for name, filename in self.files.items():
+                path = os.path.join(self.prompt_dir, filename)
+                try:
+                    mtime_ns = os.stat(path).st_mtime_ns
+                    if mtime_ns == current[name].mtime_ns:
+                        continue
+                    with open(path, "r", encoding="utf-8") as f:
+                        text = f.read()
+                    if os.stat(path).st_mtime_ns != mtime_ns or not text.strip():
+                        continue
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    logger.error(f"检查提示词文件失败 {path}: {e}")
+                    continue
+                version = self._hash(text)
+                if version == current[name].version:
+                    # 仅修改时间变化，记录新的修改时间避免重复读取
+                    updated[name] = PromptVersion(name, current[name].text, version, mtime_ns)
+                    continue
+                updated[name] = PromptVersion(name, text, version, mtime_ns)
+                logger.info(f"提示词 {filename} 已更新，版本: {current[name].version} -> {version}")
+
+            if not updated:
+                return []
+            changed = [name for name, prompt in updated.items() if prompt.version != current[name].version]
+            # 整体替换版本表，读取方不会看到部分更新的状态
+            self._versions = {**current, **updated}
+            self.stats['reloads'] += len(changed)
+
+        if changed:
+            for callback in self._listeners:
+                try:
+                    callback(changed)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    logger.error(f"应用提示词更新失败: {e}")
+        return changed
@@ -0,0 +1,208 @@
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple, Union
+
+from loguru import logger
+
+
+class ReplyCache:
+    """
+    精确匹配回复缓存
+
+    以(商品ID, 归一化后的用户消息, 规则识别的意图, 议价轮次分档)为键缓存最终回复，
+    命中时跳过意图分类和回复生成两次大模型调用。
+    每个条目记录生成时的商品信息版本和提示词版本，任一变化时条目失效。
+    支持TTL过期、LRU淘汰，以及可选的SQLite持久化。
+
+    缓存键不包含对话历史，只有脱离上下文也含义明确的消息才可缓存（见cacheable）。
+    """
+
+    def __init__(self, max_entries: int = 5000, ttl: int = 21600, db_path: Optional[str] = None,
+                 min_length: int = 6):
+        """
+        初始化回复缓存
+
+        Args:
+            max_entries: 最大缓存条目数
+            ttl: 条目有效期（秒）
+            db_path: SQLite数据库路径，提供时缓存条目持久化到reply_cache表
+            min_length: 会话中已有卖家回复时，消息归一化后至少多少个字符才可缓存
+                （“可以”、“好的”、“1”等简短跟进依赖上下文）
+        """
+        self.max_entries = max_entries
+        self.min_length = min_length
+        self.ttl = ttl
+        self.db_path = db_path
+        self._entries = OrderedDict()  # key -> (reply, intent, item_version, prompt_version, created_at)
+        self._lock = threading.Lock()
+        self.stats = {
+            'hits': 0,
+            'misses': 0,
+            'stale': 0,
+            'evictions': 0,
+        }
+        if db_path:
+            self._init_db()
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """全角转半角、去除标点空白和表情、统一小写"""
+        text = unicodedata.normalize('NFKC', text)
+        return re.sub(r'[^\w\u4e00-\u9fa5]', '', text).lower()
+
+    @staticmethod
+    def bargain_bucket(bargain_count: int) -> int:
+        """议价轮次分档：0次、1-2次、3次及以上"""
+        if bargain_count <= 0:
+            return 0
+        return 1 if bargain_count <= 2 else 2
+
+    def cacheable(self, user_msg: str, has_prior_reply: bool) -> bool:
+        """
+        判断消息的回复能否缓存：会话的第一轮，或消息本身足够长、脱离上下文也含义明确
+
+        Args:
+            has_prior_reply: 会话中是否已有卖家回复
+        """
+        return not has_prior_reply or len(self.normalize(user_msg)) >= self.min_length
+
+    def make_key(self, item_id: str, user_msg: str, intent: Optional[str], bargain_count: int) -> str:
+        """生成缓存键，intent为规则识别的意图，规则未命中时为None"""
+        return "\x1f".join([
+            item_id,
+            self.normalize(user_msg),
+            intent or "",
+            str(self.bargain_bucket(bargain_count)),
+        ])
+
+    def get(self, key: str, item_version: str, prompt_version: Union[str, Dict[str, str]]) -> Optional[Tuple[str, str]]:
+        """
+        查询缓存
+
+        Args:
+            prompt_version: 当前提示词版本，为字典时按条目的意图取对应版本
+
+        Returns:
+            tuple: (回复, 意图)，未命中、过期或版本不一致时返回None
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+
+            reply, intent, entry_item_version, entry_prompt_version, created_at = entry
+            if isinstance(prompt_version, dict):
+                expected_prompt_version = prompt_version.get(intent)
+            else:
+                expected_prompt_version = prompt_version
+            stale = (time.time() - created_at > self.ttl
+                     or entry_item_version != item_version
+                     or entry_prompt_version != expected_prompt_version)
+            if stale:
+                del self._entries[key]
+                self.stats['stale'] += 1
+                self.stats['misses'] += 1
+            else:
+                self._entries.move_to_end(key)
+                self.stats['hits'] += 1
+
+        if stale:
+            self._delete_persisted("cache_key = ?", (key,))
+            return None
+        return reply, intent
+
+    def put(self, key: str, reply: str, intent: str, item_version: str, prompt_version: str):
+        """写入缓存，超出容量时淘汰最久未使用的条目"""
+        created_at = time.time()
+        with self._lock:
+            self._entries[key] = (reply, intent, item_version, prompt_version, created_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+        if self.db_path:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                conn.execute(
+                    """
+                    INSERT OR REPLACE INTO reply_cache
+                    (cache_key, item_id, reply, intent, item_version, prompt_version, created_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (key, key.split("\x1f", 1)[0], reply, intent, item_version, prompt_version, created_at)
+                )
+                conn.commit()
+            except Exception as e:
+                logger.error(f"持久化回复缓存时出错: {e}")
+            finally:
+                conn.close()
+
+    def invalidate_item(self, item_id: str):
+        """使指定商品的所有缓存条目失效"""
+        prefix = item_id + "\x1f"
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefix)]:
+                del self._entries[key]
+        self._delete_persisted("item_id = ?", (item_id,))
+
+    def get_stats(self) -> Dict:
+        """获取缓存统计信息"""
+        with self._lock:
+            lookups = self.stats['hits'] + self.stats['misses']
+            return {
+                **self.stats,
+                'hit_rate': self.stats['hits'] / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+            }
+
+    def _init_db(self):
+        """创建持久化表并加载未过期的条目"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute('''
+            CREATE TABLE IF NOT EXISTS reply_cache (
+                cache_key TEXT PRIMARY KEY,
+                item_id TEXT NOT NULL,
+                reply TEXT NOT NULL,
+                intent TEXT,
+                item_version TEXT,
+                prompt_version TEXT,
+                created_at REAL NOT NULL
+            )
+            ''')
+            conn.execute("DELETE FROM reply_cache WHERE created_at < ?", (time.time() - self.ttl,))
+            conn.commit()
+
+            rows = conn.execute(
+                """
+                SELECT cache_key, reply, intent, item_version, prompt_version, created_at
+                FROM reply_cache ORDER BY created_at DESC LIMIT ?
+                """,
+                (self.max_entries,)
+            ).fetchall()
+            for key, *entry in reversed(rows):
+                self._entries[key] = tuple(entry)
+            logger.info(f"已加载 {len(rows)} 条持久化回复缓存")
+        except Exception as e:
+            logger.error(f"初始化回复缓存表时出错: {e}")
+        finally:
+            conn.close()
+
+    def _delete_persisted(self, where: str, params: tuple):
+        """删除持久化表中的条目"""
+        if not self.db_path:
+            return
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute(f"DELETE FROM reply_cache WHERE {where}", params)
+            conn.commit()
+        except Exception as e:
+            logger.error(f"删除持久化回复缓存时出错: {e}")
+        finally:
+            conn.close()
@@ -0,0 +1,179 @@
+import re
+import sqlite3
+import threading
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from loguru import logger
+
+
+def hashing_embed(texts: List[str], dim: int = 512) -> np.ndarray:
+    """
+    基于哈希技巧的确定性文本向量化（无需模型，作为默认嵌入函数）
+
+    将字符一元组和二元组通过crc32哈希到固定维度，并用哈希的符号位减少冲突影响，
+    最后做L2归一化，因此向量点积即为余弦相似度。
+
+    Args:
+        texts: 文本列表
+        dim: 向量维度
+
+    Returns:
+        np.ndarray: 形状为(len(texts), dim)的float32矩阵
+    """
+    matrix = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        text = ReplyIndex.normalize(text)
+        grams = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+        for gram in grams:
+            h = zlib.crc32(gram.encode('utf-8'))
+            matrix[row, h % dim] += 1.0 if (h >> 31) & 1 else -1.0
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class ReplyIndex:
+    """
+    历史回复向量索引
+
+    以商品为单位，保存买家问题的向量矩阵及其对应的卖家回复。
+    新问题与同一商品下的历史问题做向量化余弦相似度计算，
+    超过阈值时直接复用历史回复，省去大模型调用。
+    """
+
+    # 含有这些内容的回复不作为回复复用（安全过滤后的提示，流式回复中可能出现在句中）
+    IGNORED_ANSWER_MARKERS = ("[安全提醒]请通过平台沟通",)
+    # 平台自动生成的消息，不作为问题索引
+    IGNORED_QUESTIONS = {"发来一条新消息", "快给ta一个评价吧～"}
+
+    def __init__(self, embed_fn: Optional[Callable[[List[str]], np.ndarray]] = None, threshold: float = 0.92):
+        """
+        初始化回复索引
+
+        Args:
+            embed_fn: 嵌入函数，输入文本列表，返回L2归一化的向量矩阵；默认使用hashing_embed
+            threshold: 复用历史回复所需的最低余弦相似度
+        """
+        self.embed_fn = embed_fn or hashing_embed
+        self.threshold = threshold
+        self._items: Dict[str, Dict] = {}  # item_id -> {'matrix', 'pending', 'answers', 'pairs'}
+        self._lock = threading.Lock()
+        self.stats = {
+            'lookups': 0,
+            'hits': 0,
+            'saved_llm_calls': 0,
+        }
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        """去除标点、空白和表情，统一小写"""
+        return re.sub(r'[^\w\u4e00-\u9fa5]', '', text).lower()
+
+    def build_from_db(self, db_path: str) -> int:
+        """
+        从messages表中的问答对构建索引：每条卖家回复与同一会话中紧邻其前的买家消息配对
+
+        Args:
+            db_path: SQLite数据库文件路径
+
+        Returns:
+            int: 加入索引的问答对数量
+        """
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute(
+                """
+                SELECT item_id, question, answer FROM (
+                    SELECT item_id, role, content AS answer,
+                           LAG(role) OVER w AS prev_role,
+                           LAG(content) OVER w AS question
+                    FROM messages
+                    WHERE chat_id IS NOT NULL
+                    WINDOW w AS (PARTITION BY chat_id ORDER BY id)
+                )
+                WHERE role = 'assistant' AND prev_role = 'user'
+                """
+            ).fetchall()
+        except Exception as e:
+            logger.error(f"构建回复索引时出错: {e}")
+            return 0
+        finally:
+            conn.close()
+
+        added = 0
+        for item_id, question, answer in rows:
+            if self.add(item_id, question, answer):
+                added += 1
+        logger.info(f"回复索引构建完成: {added} 个问答对, {len(self._items)} 个商品")
+        return added
+
+    def add(self, item_id: str, question: str, answer: str) -> bool:
+        """
+        向索引中加入一个问答对，重复或无效的问答对会被忽略
+
+        Returns:
+            bool: 是否实际加入
+        """
+        if not item_id or not answer or any(marker in answer for marker in self.IGNORED_ANSWER_MARKERS):
+            return False
+        if question in self.IGNORED_QUESTIONS or len(self.normalize(question)) < 2:
+            return False
+
+        with self._lock:
+            entry = self._items.setdefault(
+                item_id, {'matrix': None, 'pending': [], 'answers': [], 'pairs': set()}
+            )
+            pair = (self.normalize(question), answer)
+            if pair in entry['pairs']:
+                return False
+            entry['pairs'].add(pair)
+            entry['pending'].append(question)
+            entry['answers'].append(answer)
+        return True
+
+    def lookup(self, item_id: str, question: str, skipped_llm_calls: int = 1) -> Optional[Tuple[str, float]]:
+        """
+        查找与问题最相似的历史回复
+
+        Args:
+            item_id: 商品ID
+            question: 买家问题
+            skipped_llm_calls: 命中时节省的大模型调用次数（用于统计）
+
+        Returns:
+            tuple: (历史回复, 相似度)，未达到阈值时返回None
+        """
+        with self._lock:
+            self.stats['lookups'] += 1
+            entry = self._items.get(item_id)
+            if entry is None or not entry['answers']:
+                return None
+
+            # 新加入的问题批量向量化后并入矩阵
+            if entry['pending']:
+                vectors = self.embed_fn(entry['pending'])
+                entry['matrix'] = vectors if entry['matrix'] is None else np.vstack([entry['matrix'], vectors])
+                entry['pending'] = []
+
+            query = self.embed_fn([question])[0]
+            scores = entry['matrix'] @ query
+            best = int(np.argmax(scores))
+            score = float(scores[best])
+            if score < self.threshold:
+                return None
+
+            self.stats['hits'] += 1
+            self.stats['saved_llm_calls'] += skipped_llm_calls
+            return entry['answers'][best], score
+
+    def get_stats(self) -> Dict:
+        """获取索引统计信息"""
+        with self._lock:
+            return {
+                **self.stats,
+                'hit_rate': self.stats['hits'] / self.stats['lookups'] if self.stats['lookups'] else 0.0,
+                'items': len(self._items),
+                'pairs': sum(len(entry['answers']) for entry in self._items.values()),
+            }
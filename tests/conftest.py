@@ -0,0 +1,7 @@
+import os
+import sys
+
+# 测试从仓库根目录导入模块（与main.py相同的扁平布局）
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
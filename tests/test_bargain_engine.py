@@ -0,0 +1,80 @@
+import pytest
+
+from bargain_engine import BargainEngine, parse_offer
+
+
+CONFIG = {
+    'default': {'floor_ratio': 0.9, 'concessions': [0.5, 0.8, 1.0], 'lowball_ratio': 0.5},
+    'items': {'disabled': {'enabled': False}},
+    'replies': {
+        'no_need': ["直接拍"],
+        'accept': ["可以，{price}元"],
+        'counter': ["{price}元可以"],
+        'floor': ["最低{price}元"],
+        'reject': ["太低了，最低{price}元"],
+    },
+}
+ITEM = {'soldPrice': '100'}
+
+
+@pytest.mark.parametrize("text, kind, amount", [
+    ("100元出吗", 'price', 100),
+    ("90块可以吗", 'price', 90),
+    ("¥85", 'price', 85),
+    ("80包邮", 'price', 80),
+    ("能少20吗", 'discount', 80),
+    ("打9折", 'percent', 90),
+    ("最低多少", 'ask_lowest', None),
+])
+def test_parse_clear_offers(text, kind, amount):
+    offer = parse_offer(text, 100)
+    assert offer is not None
+    assert (offer.kind, offer.amount) == (kind, amount)
+
+
+@pytest.mark.parametrize("text", [
+    "代码第3行报错怎么办",
+    "报错在第12行可以帮看下吗",
+    "1行代码搞定吗",
+    "3天能到吗",
+    "要2个可以吗",
+    "是iPhone13吗",
+    "运费10元吗",
+    "2个100元",
+    "80行吗",
+    "便宜点吧",
+])
+def test_parse_rejects_non_offers(text):
+    assert parse_offer(text, 100) is None
+
+
+def test_weak_offer_needs_price_intent():
+    assert parse_offer("80行吗", 100) is None
+    assert parse_offer("80行吗", 100, price_intent=True).amount == 80
+    assert parse_offer("第3行可以吗", 100, price_intent=True) is None
+
+
+@pytest.mark.parametrize("text", ["代码第3行报错怎么办", "报错在第12行可以帮看下吗", "1行代码搞定吗"])
+def test_engine_ignores_non_price_messages(text):
+    engine = BargainEngine(CONFIG)
+    assert engine.decide(text, 'i1', ITEM) is None
+    assert engine.get_stats()['messages'] == 0
+
+
+def test_concession_schedule():
+    engine = BargainEngine(CONFIG)
+    assert engine.decide("92元出吗", 'i1', ITEM, 0).action == 'counter'
+    assert engine.decide("92元出吗", 'i1', ITEM, 0).price == 95
+    assert engine.decide("92元出吗", 'i1', ITEM, 1).action == 'accept'
+    assert engine.decide("85元出吗", 'i1', ITEM, 2).reply == "最低90元"
+    assert engine.decide("40元出吗", 'i1', ITEM, 0).action == 'reject'
+    assert engine.decide("100元出吗", 'i1', ITEM, 0).action == 'no_need'
+
+
+def test_deferred_and_stats():
+    engine = BargainEngine(CONFIG)
+    assert engine.decide("便宜点吧", 'i1', ITEM, price_intent=True) is None
+    assert engine.decide("90元出吗", 'disabled', ITEM) is None
+    assert engine.decide("能少5吗", 'i1', ITEM).action == 'accept'
+    stats = engine.get_stats()
+    assert (stats['messages'], stats['handled'], stats['deferred']) == (3, 1, 2)
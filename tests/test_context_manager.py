@@ -0,0 +1,181 @@
+import sqlite3
+import threading
+
+import pytest
+
+from context_manager import ChatContextManager
+from reply_cache import ReplyCache
+
+
+@pytest.fixture
+def manager(tmp_path):
+    return ChatContextManager(db_path=str(tmp_path / "chat.db"))
+
+
+def test_buyer_known_before_turn_commit(manager):
+    assert manager.mark_buyer_seen("u1") is True
+    assert manager.is_known_buyer("u1")
+    # 回复尚未提交时的后续消息不再被视为新买家
+    assert manager.mark_buyer_seen("u1") is False
+
+    manager.commit_turn("c1", "u1", "i1", ["在吗", "多少钱"], seller_id="me", reply="在的")
+    reloaded = ChatContextManager(db_path=manager.db_path)
+    assert reloaded.is_known_buyer("u1")
+    assert reloaded.mark_buyer_seen("u1") is False
+
+
+def test_buyer_message_count_starts_at_commit(manager):
+    manager.mark_buyer_seen("u1")
+    manager.commit_turn("c1", "u1", "i1", ["在吗", "多少钱"], seller_id="me", reply="在的")
+    conn = sqlite3.connect(manager.db_path)
+    try:
+        count = conn.execute("SELECT message_count FROM buyers WHERE user_id = 'u1'").fetchone()[0]
+    finally:
+        conn.close()
+    assert count == 2
+
+
+@pytest.mark.parametrize("sql, params", [
+    (ChatContextManager.RECENT_MESSAGES_SQL, ("c1", 100)),
+    (ChatContextManager.LATEST_ITEM_SQL, ("c1",)),
+])
+def test_history_queries_use_chat_id_index(manager, sql, params):
+    conn = sqlite3.connect(manager.db_path)
+    try:
+        plan = " | ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+    finally:
+        conn.close()
+    assert "idx_chat_id_id" in plan
+    assert "USE TEMP B-TREE" not in plan
+
+
+def test_context_returns_recent_messages_in_order(tmp_path):
+    manager = ChatContextManager(max_history=3, db_path=str(tmp_path / "chat.db"))
+    for i in range(5):
+        manager.add_message_by_chat("c1", "u1", "i1", "user", f"消息{i}")
+    reloaded = ChatContextManager(max_history=3, db_path=manager.db_path)
+    assert [m["content"] for m in reloaded.get_context_by_chat("c1")] == ["消息2", "消息3", "消息4"]
+
+
+def test_peek_context_leaves_cache_stats_and_order(manager):
+    manager.add_message_by_chat("c1", "u1", "i1", "user", "在吗")
+    manager.add_message_by_chat("c2", "u1", "i1", "user", "多少钱")
+    manager.get_context_by_chat("c1")
+    manager.get_context_by_chat("c2")
+    before, order = manager.get_cache_stats(), list(manager._cache)
+
+    assert [m["content"] for m in manager.peek_context_by_chat("c1")] == ["在吗"]
+    assert manager.get_cache_stats() == before
+    assert list(manager._cache) == order
+
+
+def test_peek_context_does_not_cache_cold_chat(manager):
+    manager.add_message_by_chat("c1", "u1", "i1", "user", "在吗")
+    reloaded = ChatContextManager(db_path=manager.db_path)
+
+    assert [m["content"] for m in reloaded.peek_context_by_chat("c1")] == ["在吗"]
+    stats = reloaded.get_cache_stats()
+    assert (stats['hits'], stats['misses'], stats['resident_chats']) == (0, 0, 0)
+
+
+def test_item_update_invalidates_reply_cache(manager):
+    cache = ReplyCache(db_path=manager.db_path)
+    manager.subscribe_item_updates(cache.invalidate_item)
+    key = cache.make_key("i1", "包邮吗", None, 0)
+    manager.save_item_info("i1", {"title": "耳机", "soldPrice": 50})
+    cache.put(key, "包邮的", "default", "v1", "p1")
+
+    # 内容未变化时保留缓存
+    manager.save_item_info("i1", {"title": "耳机", "soldPrice": 50})
+    assert cache.get_stats()['entries'] == 1
+
+    manager.save_item_info("i1", {"title": "耳机", "soldPrice": 45})
+    assert cache.get_stats()['entries'] == 0
+    assert cache.get(key, "v1", "p1") is None
+
+
+def auto_vacuum_mode(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_new_database_uses_incremental_vacuum(manager):
+    assert auto_vacuum_mode(manager.db_path) == 2
+
+
+def test_existing_database_vacuum_is_opt_in(tmp_path):
+    db_path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(db_path)
+    conn.execute("CREATE TABLE legacy (id INTEGER)")
+    conn.commit()
+    conn.close()
+
+    ChatContextManager(db_path=db_path)
+    assert auto_vacuum_mode(db_path) == 0
+
+    ChatContextManager(db_path=db_path, enable_auto_vacuum=True)
+    assert auto_vacuum_mode(db_path) == 2
+
+
+def test_write_during_cold_load_is_not_lost(manager):
+    manager.add_message_by_chat("c1", "u1", "i1", "user", "在吗")
+    load_buffer = manager._load_buffer
+    calls = []
+
+    def slow_load(chat_id):
+        buffer = load_buffer(chat_id)
+        if not calls:
+            # 读取完成后、放入缓存前有新消息写入
+            manager.add_message_by_chat("c1", "u1", "i1", "assistant", "在的")
+        calls.append(chat_id)
+        return buffer
+    manager._load_buffer = slow_load
+
+    assert [m["content"] for m in manager.get_context_by_chat("c1")] == ["在吗", "在的"]
+    assert len(calls) == 2
+    assert [m["content"] for m in manager.get_context_by_chat("c1")] == ["在吗", "在的"]
+    assert manager.get_cache_stats()['hits'] == 1
+
+
+def test_cold_load_does_not_hold_cache_lock(manager):
+    manager.add_message_by_chat("c1", "u1", "i1", "user", "在吗")
+    manager.add_message_by_chat("c2", "u1", "i1", "user", "多少钱")
+    manager.get_context_by_chat("c2")
+    load_buffer = manager._load_buffer
+    seen = []
+
+    def load_while_reading_other_chat(chat_id):
+        # 另一线程在加载期间读取已缓存的会话，不应被阻塞
+        reader = threading.Thread(target=lambda: seen.append(manager.get_context_by_chat("c2")))
+        reader.start()
+        reader.join(timeout=1)
+        return load_buffer(chat_id)
+    manager._load_buffer = load_while_reading_other_chat
+
+    manager.get_context_by_chat("c1")
+    manager.peek_context_by_chat("c3")
+    assert len(seen) == 2
+
+
+def test_archive_cutoff_uses_utc_timestamps(manager):
+    manager.add_message_by_chat("idle", "u1", "i1", "user", "在吗")
+    manager.add_message_by_chat("recent", "u2", "i1", "user", "在吗")
+    conn = sqlite3.connect(manager.db_path)
+    try:
+        conn.execute("UPDATE messages SET timestamp = datetime('now', '-30 days', '-1 hour') WHERE chat_id = 'idle'")
+        conn.execute("UPDATE messages SET timestamp = datetime('now', '-30 days', '+1 hour') WHERE chat_id = 'recent'")
+        conn.commit()
+    finally:
+        conn.close()
+
+    assert manager.archive_idle_chats(max_idle_days=30) == 1
+    assert [m["content"] for m in manager.get_context_by_chat("recent")] == ["在吗"]
+    conn = sqlite3.connect(manager.db_path)
+    try:
+        archived = [row[0] for row in conn.execute("SELECT chat_id FROM archived_chats")]
+    finally:
+        conn.close()
+    assert archived == ["idle"]
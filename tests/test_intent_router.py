@@ -0,0 +1,24 @@
+from types import SimpleNamespace
+
+from XianyuAgent import IntentRouter
+from utils.keyword_matcher import KeywordEngine
+
+
+def make_router():
+    classify_agent = SimpleNamespace(generate=lambda **kwargs: 'default')
+    return IntentRouter(classify_agent, KeywordEngine("keywords"))
+
+
+def test_rule_hits_counted_when_matched_directly():
+    router = make_router()
+    assert router.match_rules("能便宜点吗", record=True) == 'price'
+    assert router.detect("你好", "商品", "") == 'default'
+    stats = router.get_stats()
+    assert (stats['rule_hits'], stats['llm_fallbacks']) == (1, 1)
+    assert stats['llm_fallback_rate'] == 0.5
+
+
+def test_match_rules_without_record_leaves_stats():
+    router = make_router()
+    router.match_rules("能便宜点吗")
+    assert router.get_stats()['rule_hits'] == 0
@@ -0,0 +1,20 @@
+import re
+
+from utils.keyword_matcher import KeywordEngine
+
+
+def test_toggle_matches_whole_message_only():
+    engine = KeywordEngine("keywords")
+    assert engine.contains("。", 'toggle')
+    assert not engine.contains("好的，明天发货。", 'toggle')
+
+
+def test_extra_keywords_merged_and_kept_on_reload(tmp_path):
+    (tmp_path / "toggle.txt").write_text("re:^接管$\n", encoding="utf-8")
+    engine = KeywordEngine(str(tmp_path), extra_keywords={'toggle': [f"re:^{re.escape('.')}$"]})
+    assert engine.contains("接管", 'toggle')
+    assert engine.contains(".", 'toggle')
+    assert not engine.contains("a", 'toggle')
+
+    engine.reload()
+    assert engine.contains(".", 'toggle')
@@ -0,0 +1,148 @@
+import time
+from types import SimpleNamespace
+
+import openai
+import pytest
+
+from llm_router import LLMBackend, LLMRouter
+
+REQUEST = SimpleNamespace(method="POST", url="http://127.0.0.1:1/v1/chat/completions")
+
+
+def status_error(cls, status_code, message="error"):
+    response = SimpleNamespace(status_code=status_code, request=REQUEST, headers={})
+    return cls(message, response=response, body=None)
+
+
+class FakeCompletions:
+    """按预设行为返回结果的chat.completions接口"""
+
+    def __init__(self, reply="ok", delay=0.0, error=None, chunks=None, stream_error=None):
+        self.reply = reply
+        self.delay = delay
+        self.error = error
+        self.chunks = chunks or []
+        self.stream_error = stream_error
+        self.calls = []
+
+    def create(self, **kwargs):
+        self.calls.append(kwargs)
+        time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        if kwargs.get('stream'):
+            return self._stream()
+        return self.reply
+
+    def _stream(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.stream_error:
+            raise self.stream_error
+
+
+def make_backend(name, timeout=60.0, **behaviour):
+    backend = LLMBackend(name=name, base_url="http://127.0.0.1:1/v1", api_key="test", timeout=timeout)
+    backend.client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions(**behaviour)))
+    return backend
+
+
+def test_failover_to_next_backend():
+    broken = make_backend("a", error=openai.APIConnectionError(request=REQUEST))
+    healthy = make_backend("b", reply="from b")
+    router = LLMRouter([broken, healthy], probe_interval=0)
+
+    assert router.chat.completions.create(model="m", messages=[]) == "from b"
+    assert broken.stats['errors'] == 1
+    assert healthy.stats['requests'] == 1
+    # 失败的后端排到后面
+    assert router._ranked_backends()[0] is healthy
+
+
+def test_all_backends_failing_raises_last_error():
+    router = LLMRouter([make_backend("a", error=status_error(openai.InternalServerError, 500, "a")),
+                        make_backend("b", error=status_error(openai.RateLimitError, 429, "b"))],
+                       probe_interval=0)
+    with pytest.raises(openai.RateLimitError, match="b"):
+        router.chat.completions.create(model="m", messages=[])
+
+
+def test_hedge_returns_faster_backend():
+    slow = make_backend("slow", reply="slow", delay=0.5)
+    fast = make_backend("fast", reply="fast")
+    router = LLMRouter([slow, fast], hedge_enabled=True, hedge_default_delay=0.05, hedge_min_delay=0.01,
+                       probe_interval=0)
+
+    assert router.chat.completions.create(model="m", messages=[]) == "fast"
+    assert fast.stats['hedges'] == 1
+    assert fast.stats['hedge_wins'] == 1
+
+
+def test_hedge_not_sent_when_primary_is_fast():
+    primary = make_backend("a", reply="a")
+    secondary = make_backend("b", reply="b")
+    router = LLMRouter([primary, secondary], hedge_enabled=True, hedge_default_delay=1.0, probe_interval=0)
+
+    assert router.chat.completions.create(model="m", messages=[]) == "a"
+    assert secondary.stats['hedges'] == 0
+    assert secondary.client.chat.completions.calls == []
+
+
+def test_attempt_timeout_capped_by_backend_timeout():
+    backend = make_backend("a", timeout=5.0)
+    router = LLMRouter([backend], probe_interval=0)
+
+    router.chat.completions.create(model="m", messages=[], timeout=30)
+    assert backend.client.chat.completions.calls[-1]['timeout'] <= 5.0
+    router.chat.completions.create(model="m", messages=[], timeout=2)
+    assert backend.client.chat.completions.calls[-1]['timeout'] <= 2
+
+
+def test_stream_records_ttft_separately():
+    backend = make_backend("a", chunks=["x", "y"])
+    router = LLMRouter([backend], probe_interval=0)
+
+    assert list(router.chat.completions.create(model="m", messages=[], stream=True)) == ["x", "y"]
+    assert backend.stats['streams'] == 1
+    assert backend.ttft_ewma_ms is not None
+    assert backend.ewma_ms is None
+    assert backend.stats['requests'] == 1 and backend.stats['errors'] == 0
+
+
+def test_mid_stream_error_counts_as_failure():
+    backend = make_backend("a", chunks=["x"], stream_error=ConnectionError("reset"))
+    router = LLMRouter([backend], probe_interval=0)
+
+    stream = router.chat.completions.create(model="m", messages=[], stream=True)
+    with pytest.raises(ConnectionError):
+        list(stream)
+    stream.close()
+    assert backend.stats['errors'] == 1
+    assert backend.consecutive_failures == 1
+
+
+@pytest.mark.parametrize("error", [
+    status_error(openai.BadRequestError, 400, "data_inspection_failed"),
+    status_error(openai.AuthenticationError, 401),
+    status_error(openai.NotFoundError, 404),
+])
+def test_request_errors_raised_without_failover(error):
+    primary = make_backend("a", error=error)
+    secondary = make_backend("b")
+    router = LLMRouter([primary, secondary], max_failures=1, probe_interval=0)
+
+    with pytest.raises(type(error)):
+        router.chat.completions.create(model="m", messages=[])
+    assert secondary.client.chat.completions.calls == []
+    assert primary.consecutive_failures == 0 and primary.stats['errors'] == 0
+    assert primary.cooldown_until == 0.0
+
+
+def test_hedged_request_error_not_retried():
+    primary = make_backend("a", error=status_error(openai.BadRequestError, 400))
+    secondary = make_backend("b")
+    router = LLMRouter([primary, secondary], hedge_enabled=True, hedge_default_delay=1.0, probe_interval=0)
+
+    with pytest.raises(openai.BadRequestError):
+        router.chat.completions.create(model="m", messages=[])
+    assert secondary.client.chat.completions.calls == []
@@ -0,0 +1,77 @@
+import json
+import os
+import shutil
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+import XianyuAgent
+from XianyuAgent import XianyuReplyBot
+from bargain_engine import BargainEngine
+from context_builder import ConversationSummarizer
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+
+def rewrite(path, text):
+    """写入新内容并推后修改时间，保证轮询能发现变化"""
+    stat = os.stat(path)
+    path.write_text(text, encoding="utf-8")
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    shutil.copytree(REPO_ROOT / "prompts", tmp_path / "prompts")
+    shutil.copytree(REPO_ROOT / "keywords", tmp_path / "keywords")
+    monkeypatch.chdir(tmp_path)
+    client = SimpleNamespace(chat=SimpleNamespace(completions=None))
+    monkeypatch.setattr(XianyuAgent.LLMRouter, "from_env", classmethod(lambda cls: client))
+    return tmp_path
+
+
+def test_agents_swapped_before_versions_published(workdir):
+    bot = XianyuReplyBot(reply_cache=None)
+    before = bot.reply_prompt_versions
+    seen = []
+    build_versions = bot._build_reply_prompt_versions
+
+    def spy():
+        # 发布新版本时Agent应已使用新提示词
+        seen.append(bot.agents['default'].system_prompt)
+        return build_versions()
+    bot._build_reply_prompt_versions = spy
+
+    rewrite(workdir / "prompts" / "default_prompt.txt", "新的默认提示词")
+    assert bot.reload_prompts() == ['default']
+    assert seen == ["新的默认提示词"]
+    assert bot.reply_prompt_versions['default'] != before['default']
+    assert bot.reply_prompt_versions['price'] == before['price']
+
+
+def test_bargain_rules_and_summary_prompt_hot_reload(workdir):
+    engine = BargainEngine.load("prompts/bargain_rules.json")
+    bot = XianyuReplyBot(reply_cache=None, bargain_engine=engine)
+    summarizer = ConversationSummarizer(bot.client, None, prompt_registry=bot.prompt_registry)
+    versions = bot.reply_prompt_versions
+
+    rules = json.loads((workdir / "prompts" / "bargain_rules.json").read_text(encoding="utf-8"))
+    rules['items'] = {"i1": {"enabled": False}}
+    rewrite(workdir / "prompts" / "bargain_rules.json", json.dumps(rules, ensure_ascii=False))
+    rewrite(workdir / "prompts" / "summary_prompt.txt", "新的摘要提示词")
+
+    assert sorted(bot.reload_prompts()) == ['bargain_rules', 'summary']
+    assert engine.rule_for("i1", 100) is None
+    assert summarizer.prompt == "新的摘要提示词"
+    # 不影响回复的文件变化不会使缓存失效
+    assert bot.reply_prompt_versions == versions
+
+
+def test_invalid_bargain_rules_keep_old_rules(workdir):
+    engine = BargainEngine.load("prompts/bargain_rules.json")
+    bot = XianyuReplyBot(reply_cache=None, bargain_engine=engine)
+
+    rewrite(workdir / "prompts" / "bargain_rules.json", "{不是JSON")
+    bot.reload_prompts()
+    assert engine.rule_for("i1", 100) is not None
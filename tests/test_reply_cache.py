@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+import pytest
+
+import XianyuAgent
+from XianyuAgent import XianyuReplyBot
+from reply_cache import ReplyCache
+
+
+class FakeCompletions:
+    """意图分类返回default，回复生成返回带调用序号的回复"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def create(self, **kwargs):
+        if kwargs['max_tokens'] == 10:
+            content = "default"
+        else:
+            self.calls += 1
+            content = f"回复{self.calls}"
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+            usage=SimpleNamespace(prompt_tokens=100, completion_tokens=10, prompt_tokens_details=None),
+        )
+
+
+@pytest.fixture
+def bot(monkeypatch):
+    client = SimpleNamespace(chat=SimpleNamespace(completions=FakeCompletions()))
+    monkeypatch.setattr(XianyuAgent.LLMRouter, "from_env", classmethod(lambda cls: client))
+    return XianyuReplyBot(reply_cache=ReplyCache())
+
+
+HISTORY = [{"role": "user", "content": "在吗"}, {"role": "assistant", "content": "在的"}]
+
+
+def test_cacheable_short_follow_up_needs_first_turn():
+    cache = ReplyCache(min_length=6)
+    assert cache.cacheable("可以", has_prior_reply=False)
+    assert not cache.cacheable("可以！", has_prior_reply=True)
+    assert cache.cacheable("这个耳机支持降噪功能吗", has_prior_reply=True)
+
+
+def test_short_follow_up_not_shared_across_chats(bot):
+    first = bot.generate_reply("好的", "耳机", HISTORY, item_id="i1")
+    second = bot.generate_reply("好的", "耳机", HISTORY, item_id="i1")
+    assert first.text != second.text
+    assert bot.reply_cache.get_stats()['entries'] == 0
+
+
+def test_context_free_question_is_cached(bot):
+    first = bot.generate_reply("这个耳机支持降噪功能吗", "耳机", HISTORY, item_id="i1")
+    second = bot.generate_reply("这个耳机支持降噪功能吗", "耳机", HISTORY, item_id="i1")
+    assert (second.agent, second.text) == ("reply_cache", first.text)
+
+
+def test_price_messages_not_cached(bot):
+    bot.generate_reply("能便宜点吗", "耳机", [], item_id="i1")
+    result = bot.generate_reply("能便宜点吗", "耳机", [], item_id="i1")
+    assert result.agent != "reply_cache"
+    assert bot.reply_cache.get_stats()['entries'] == 0
@@ -0,0 +1,26 @@
+import pytest
+
+from XianyuAgent import ReplyResult, XianyuReplyBot
+from reply_index import ReplyIndex
+
+
+def test_answer_with_safety_reminder_not_indexed():
+    index = ReplyIndex()
+    assert not index.add("i1", "可以加微信吗", "好的。[安全提醒]请通过平台沟通。还有问题随时问~")
+    assert index.add("i1", "支持降噪吗", "支持主动降噪")
+
+
+@pytest.mark.parametrize("agent, intent, indexed", [
+    ("default", "default", True),
+    ("tech", "tech", True),
+    ("structured", "default", True),
+    ("structured", "price", False),
+    ("price", "price", False),
+    ("bargain_engine", "price", False),
+    ("reply_cache", "default", False),
+    ("reply_index", "default", False),
+    ("holding", "default", False),
+])
+def test_only_llm_answers_indexed(agent, intent, indexed):
+    result = ReplyResult("回复内容", intent, agent)
+    assert XianyuReplyBot.should_index(result) is indexed
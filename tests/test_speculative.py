@@ -0,0 +1,93 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+import XianyuAgent
+from XianyuAgent import GenerationCancelled, LLMScheduler, XianyuReplyBot
+
+
+def make_response(content):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(message=SimpleNamespace(content=content))],
+        usage=SimpleNamespace(prompt_tokens=100, completion_tokens=10, prompt_tokens_details=None),
+    )
+
+
+def make_chunk(content, finish_reason=None):
+    return SimpleNamespace(
+        choices=[SimpleNamespace(delta=SimpleNamespace(content=content), finish_reason=finish_reason)],
+        usage=None,
+    )
+
+
+class FakeCompletions:
+    """意图分类返回default；预生成按预设的finish_reason流式返回；完整生成返回固定回复"""
+
+    def __init__(self, speculative_finish="stop", speculative_error=None):
+        self.speculative_finish = speculative_finish
+        self.speculative_error = speculative_error
+        self.classify_calls = 0
+        self.stream_calls = 0
+        self.full_calls = 0
+
+    def create(self, **kwargs):
+        if kwargs.get('stream'):
+            self.stream_calls += 1
+            if self.speculative_error:
+                raise self.speculative_error
+            return iter([make_chunk("预生成的回复"), make_chunk("", self.speculative_finish)])
+        if kwargs['max_tokens'] == 10:
+            self.classify_calls += 1
+            return make_response("default")
+        self.full_calls += 1
+        return make_response("完整的回复")
+
+
+@pytest.fixture
+def make_bot(monkeypatch):
+    def factory(completions):
+        client = SimpleNamespace(chat=SimpleNamespace(completions=completions))
+        monkeypatch.setattr(XianyuAgent.LLMRouter, "from_env", classmethod(lambda cls: client))
+        return XianyuReplyBot(reply_cache=None, routing_strategy="speculative")
+    return factory
+
+
+def test_speculative_reply_used_when_complete(make_bot):
+    completions = FakeCompletions()
+    result = make_bot(completions).generate_reply("你好呀", "商品", [])
+    assert result.text == "预生成的回复"
+    assert (completions.classify_calls, completions.full_calls) == (1, 0)
+
+
+@pytest.mark.parametrize("completions", [
+    FakeCompletions(speculative_finish="length"),
+    FakeCompletions(speculative_error=ConnectionError("reset")),
+])
+def test_speculative_fallback_reuses_classified_intent(make_bot, completions):
+    bot = make_bot(completions)
+    result = bot.generate_reply("你好呀", "商品", [])
+    assert (result.intent, result.text) == ("default", "完整的回复")
+    assert (completions.classify_calls, completions.full_calls) == (1, 1)
+    assert bot.get_speculation_stats()['fallbacks'] == 1
+
+
+def test_cancelled_speculation_sends_no_request(make_bot):
+    completions = FakeCompletions()
+    bot = make_bot(completions)
+    cancel_event = threading.Event()
+    cancel_event.set()
+
+    with pytest.raises(GenerationCancelled):
+        bot.agents['default'].generate_speculative("你好", "商品", "", cancel_event=cancel_event, usage={})
+    assert completions.stream_calls == 0
+
+
+def test_scheduler_slot_gives_up_on_any_cancel_event():
+    scheduler = LLMScheduler(max_concurrent=1)
+    speculative_cancel = threading.Event()
+    with scheduler.slot('default'):
+        threading.Timer(0.05, speculative_cancel.set).start()
+        with pytest.raises(GenerationCancelled):
+            with scheduler.slot('default', cancel_event=[threading.Event(), speculative_cancel]):
+                pass
@@ -0,0 +1,240 @@
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from loguru import logger
+
+
+class AhoCorasickMatcher:
+    """
+    Aho-Corasick多模式匹配器
+
+    一次性编译所有关键词，单次遍历文本即可找出全部命中的关键词及其分类，
+    耗时与关键词数量无关。
+    """
+
+    def __init__(self, keywords: Iterable[Tuple[str, str]]):
+        """
+        Args:
+            keywords: (关键词, 分类)序列，同一关键词可属于多个分类
+        """
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[str, str]]] = [[]]
+        self.size = 0
+
+        for keyword, category in keywords:
+            if keyword:
+                self._add(keyword, category)
+        self._build_failure_links()
+
+    def _add(self, keyword: str, category: str):
+        state = 0
+        for char in keyword:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        if (keyword, category) not in self._output[state]:
+            self._output[state].append((keyword, category))
+            self.size += 1
+
+    def _build_failure_links(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                # 合并后缀状态的输出，匹配时无需再沿失败链回溯
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def find_all(self, text: str) -> List[Tuple[int, str, str]]:
+        """
+        查找文本中的所有关键词
+
+        Returns:
+            list: (起始位置, 关键词, 分类)列表
+        """
+        matches = []
+        goto, fail, output = self._goto, self._fail, self._output
+        state = 0
+        for pos, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            for keyword, category in output[state]:
+                matches.append((pos - len(keyword) + 1, keyword, category))
+        return matches
+
+
+class KeywordEngine:
+    """
+    关键词引擎
+
+    从关键词目录加载*.txt文件，文件名（不含扩展名）即分类名，每行一个关键词，
+    以#开头的行为注释，以re:开头的行为正则表达式。
+    所有关键词编译为一个Aho-Corasick匹配器，正则按分类合并编译；
+    文件修改后在下一次匹配时自动重新加载。
+    """
+
+    REGEX_PREFIX = "re:"
+
+    def __init__(self, keyword_dir: str = "keywords", check_interval: float = 2.0,
+                 extra_keywords: Optional[Dict[str, List[str]]] = None):
+        """
+        Args:
+            keyword_dir: 关键词文件目录
+            check_interval: 检查文件修改的最小间隔（秒）
+            extra_keywords: 额外的关键词（分类 -> 关键词行，格式与文件中的行相同），
+                如来自环境变量的配置，每次重新加载时与文件内容合并
+        """
+        self.keyword_dir = keyword_dir
+        self.check_interval = check_interval
+        self.extra_keywords = extra_keywords or {}
+        self._lock = threading.Lock()
+        self._mtimes: Dict[str, float] = {}
+        self._last_check = 0.0
+        self._matcher = AhoCorasickMatcher([])
+        self._patterns: Dict[str, re.Pattern] = {}
+        self._keywords: Dict[str, List[str]] = {}
+        self.reload()
+
+    def _scan_mtimes(self) -> Dict[str, float]:
+        if not os.path.isdir(self.keyword_dir):
+            return {}
+        mtimes = {}
+        for name in os.listdir(self.keyword_dir):
+            if name.endswith(".txt"):
+                path = os.path.join(self.keyword_dir, name)
+                mtimes[path] = os.path.getmtime(path)
+        return mtimes
+
+    def reload(self):
+        """重新加载全部关键词文件"""
+        with self._lock:
+            mtimes = self._scan_mtimes()
+            if not mtimes:
+                logger.warning(f"关键词目录 {self.keyword_dir} 不存在或为空")
+
+            lines: List[Tuple[str, str]] = []
+            for path in sorted(mtimes):
+                category = os.path.splitext(os.path.basename(path))[0]
+                with open(path, "r", encoding="utf-8") as f:
+                    lines.extend((category, line) for line in f)
+            lines.extend((category, line) for category, items in self.extra_keywords.items() for line in items)
+
+            keywords: Dict[str, List[str]] = {}
+            regexes: Dict[str, List[str]] = {}
+            for category, line in lines:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if line.startswith(self.REGEX_PREFIX):
+                    regexes.setdefault(category, []).append(line[len(self.REGEX_PREFIX):])
+                else:
+                    keywords.setdefault(category, []).append(line)
+
+            matcher = AhoCorasickMatcher(
+                (keyword, category) for category, words in keywords.items() for keyword in words
+            )
+            patterns = {
+                category: re.compile("|".join(f"(?:{p})" for p in items))
+                for category, items in regexes.items()
+            }
+
+            # 编译完成后整体替换，匹配线程始终看到一致的版本
+            self._matcher, self._patterns, self._keywords = matcher, patterns, keywords
+            self._mtimes = mtimes
+            self._last_check = time.monotonic()
+            logger.info(f"已加载关键词: {matcher.size} 个关键词, {len(patterns)} 组正则, 分类: {sorted(set(keywords) | set(patterns))}")
+
+    def _maybe_reload(self):
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        try:
+            if self._scan_mtimes() != self._mtimes:
+                logger.info("检测到关键词文件变更，重新加载")
+                self.reload()
+        except Exception as e:
+            logger.error(f"重新加载关键词文件时出错: {e}")
+
+    def match(self, text: str) -> Dict[str, List[str]]:
+        """
+        单次遍历匹配文本
+
+        Returns:
+            dict: 分类 -> 命中的关键词列表（正则命中时为匹配到的文本）
+        """
+        self._maybe_reload()
+        matcher, patterns = self._matcher, self._patterns
+        result: Dict[str, List[str]] = {}
+        for _, keyword, category in matcher.find_all(text):
+            result.setdefault(category, []).append(keyword)
+        for category, pattern in patterns.items():
+            found = pattern.search(text)
+            if found:
+                result.setdefault(category, []).append(found.group(0))
+        return result
+
+    def categories(self, text: str) -> Set[str]:
+        """返回文本命中的所有分类"""
+        return set(self.match(text))
+
+    def contains(self, text: str, category: str) -> bool:
+        """判断文本是否命中指定分类"""
+        return category in self.match(text)
+
+    def keywords(self, category: str) -> List[str]:
+        """获取指定分类的关键词列表"""
+        self._maybe_reload()
+        return list(self._keywords.get(category, []))
+
+
+def _benchmark(keyword_count: int = 5000, text_count: int = 2000, text_length: int = 60, seed: int = 0):
+    """对比逐个关键词in判断与Aho-Corasick匹配的耗时"""
+    import random
+
+    rng = random.Random(seed)
+    alphabet = [chr(code) for code in range(0x4e00, 0x4e00 + 800)]
+    keywords = list({"".join(rng.choices(alphabet, k=rng.randint(2, 4))) for _ in range(keyword_count)})
+    texts = ["".join(rng.choices(alphabet, k=text_length)) for _ in range(text_count)]
+    # 部分文本中埋入关键词，保证两种方法都有命中
+    for i in range(0, text_count, 3):
+        texts[i] = texts[i][:20] + rng.choice(keywords) + texts[i][20:]
+
+    start = time.perf_counter()
+    matcher = AhoCorasickMatcher((keyword, "bench") for keyword in keywords)
+    build_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    naive_hits = [sorted({kw for kw in keywords if kw in text}) for text in texts]
+    naive_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    ac_hits = [sorted({kw for _, kw, _ in matcher.find_all(text)}) for text in texts]
+    ac_ms = (time.perf_counter() - start) * 1000
+
+    assert naive_hits == ac_hits, "匹配结果不一致"
+    print(f"关键词数: {len(keywords)}, 文本数: {text_count}, 文本长度: ~{text_length}")
+    print(f"编译耗时: {build_ms:.1f}ms")
+    print(f"逐个in判断: {naive_ms:.1f}ms ({naive_ms * 1000 / text_count:.1f}us/条)")
+    print(f"Aho-Corasick: {ac_ms:.1f}ms ({ac_ms * 1000 / text_count:.1f}us/条)")
+
+
+if __name__ == "__main__":
+    import sys
+
+    _benchmark(*(int(arg) for arg in sys.argv[1:3]))